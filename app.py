@@ -1,60 +1,349 @@
+import os
+import socket
 import threading
 import time
-from datetime import datetime, timedelta, timezone
 
+import click
 import redis
 from flask import Flask
 from flask_cors import CORS
 
 from config import Config
 from models import db
-from models.active_user import ActiveUser  # Make sure you have this model
-from routes.chat_message import chat_message_api_bp, get_redis_connection
+from models.chat_session import ChatSession
+from routes.chat_message import chat_message_api_bp
 from routes.friendship import friendship_api_bp
 from routes.saved_movie import saved_movie_api_bp
 from routes.user import user_api_bp
-from routes import sync_redis_session_to_postgres
-from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm.exc import ObjectDeletedError
+from routes import (
+    backfill_chat_sessions,
+    create_missing_indexes,
+    persist_stream_entries,
+)
+from routes.cold_tier import run_tiering
+from routes.heartbeats import (
+    DIRTY_BACKFILL_KEY,
+    flush_heartbeats,
+    mark_all_sessions_dirty,
+    run_inactivity_sweep,
+    seed_heartbeats,
+)
+from routes.leader_lease import LeaderLease
+from routes.message_codec import migrate_message_encoding
+from routes.redis_client import create_redis_client
+from routes.search_index import rebuild_search_index
+from routes.session_index import migrate_all_session_indexes
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+
+
+def background_leader_election(app):
+    """
+    Keep acquiring or renewing the leader lease; singleton jobs only run
+    while this process holds it.
+    """
+    lease = app.leader_lease
+    while True:
+        was_leader = lease.is_leader
+        if lease.renew() != was_leader:
+            state = "acquired" if lease.is_leader else "lost"
+            print(f"Leader lease {state} by {lease.owner}")
+        time.sleep(lease.ttl_ms / 3000)
 
 
 def background_inactive_checker(app):
+    """
+    Due-time scheduler: every INACTIVE_CHECK_INTERVAL seconds, sync and
+    forget the users whose inactivity deadline has passed (leader only).
+    """
     while True:
-        time.sleep(300)
+        time.sleep(app.config["INACTIVE_CHECK_INTERVAL"])
+        if not app.leader_lease.is_leader:
+            continue
         with app.app_context():
             try:
-                cutoff = datetime.now(timezone.utc) - timedelta(minutes=15)
+                run_inactivity_sweep(
+                    app.redis,
+                    app.config["INACTIVE_AFTER_SECONDS"],
+                    app.config["INACTIVE_BATCH_SIZE"],
+                    keep_going=lambda: app.leader_lease.is_leader,
+                )
+
+            except OperationalError:
+                db.session.rollback()
+                db.engine.dispose()
+                print(
+                    "Detected stale DB connection, disposed engine and will retry."
+                )
+            except (redis.exceptions.RedisError, SQLAlchemyError) as e:
+                db.session.rollback()
+                print(f"Inactivity check failed, will retry: {e}")
+
 
-                inactive_records = ActiveUser.query.filter(
-                    ActiveUser.last_seen < cutoff
-                ).all()
+def background_heartbeat_flusher(app):
+    """
+    Periodically copy the heartbeats received since the last flush into
+    active_users (one bulk UPDATE + INSERT, leader only).
+    """
+    with app.app_context():
+        try:
+            seed_heartbeats(app.redis)
+        except (redis.exceptions.RedisError, SQLAlchemyError) as e:
+            db.session.rollback()
+            print(f"Could not seed heartbeats from active_users: {e}")
+    while True:
+        time.sleep(app.config["HEARTBEAT_FLUSH_INTERVAL"])
+        if not app.leader_lease.is_leader:
+            continue
+        with app.app_context():
+            try:
+                flush_heartbeats(app.redis)
+            except (redis.exceptions.RedisError, SQLAlchemyError) as e:
+                db.session.rollback()
+                print(f"Heartbeat flush failed, will retry: {e}")
 
-                for record in inactive_records:
-                    username = record.user.username
-                    r = get_redis_connection()
-                    session_list_key = f"bot-sessions-{username}"
-                    session_ids = r.smembers(session_list_key)
 
-                    for s_id in session_ids:
-                        sync_redis_session_to_postgres(username, s_id)
+def dead_letter_entries(
+    r, stream, group, entries, max_deliveries, dead_letter_stream
+):
+    """
+    Move entries already delivered more than max_deliveries times to the
+    dead-letter stream (with their entry id and delivery count), and
+    acknowledge and remove them. Returns the other entries.
+    """
+    if not entries:
+        return entries
+    pipe = r.pipeline(transaction=False)
+    for entry_id, _ in entries:
+        pipe.xpending_range(stream, group, min=entry_id, max=entry_id, count=1)
+    deliveries = {
+        pending[0]["message_id"]: pending[0]["times_delivered"]
+        for pending in pipe.execute()
+        if pending
+    }
 
-                    try:
-                        db.session.refresh(record)  # Ensure record exists
-                        db.session.delete(record)
-                        db.session.commit()  # Commit after each delete
-                    except ObjectDeletedError:
-                        db.session.rollback()
-                        continue
+    kept = []
+    poison = []
+    for entry_id, fields in entries:
+        if deliveries.get(entry_id, 0) > max_deliveries:
+            poison.append((entry_id, fields))
+        else:
+            kept.append((entry_id, fields))
+    if poison:
+        pipe = r.pipeline()
+        for entry_id, fields in poison:
+            pipe.xadd(
+                dead_letter_stream,
+                {
+                    **fields,
+                    "entry_id": entry_id,
+                    "deliveries": deliveries[entry_id],
+                },
+            )
+        poison_ids = [entry_id for entry_id, _ in poison]
+        pipe.xack(stream, group, *poison_ids)
+        pipe.xdel(stream, *poison_ids)
+        pipe.execute()
+        print(
+            f"Moved {len(poison)} write-behind entries to "
+            f"{dead_letter_stream}: {poison_ids}"
+        )
+    return kept
 
-            except OperationalError:
+
+def read_write_behind_batch(
+    r,
+    stream,
+    group,
+    consumer,
+    batch_size,
+    flush_ms,
+    claim_idle_ms,
+    max_deliveries,
+    dead_letter_stream,
+):
+    """
+    Collect up to batch_size stream entries, waiting at most flush_ms.
+    Entries left pending by a dead consumer (or by a failed batch) for
+    claim_idle_ms are claimed first; those delivered more than
+    max_deliveries times are dead-lettered instead.
+    """
+    claimed = r.xautoclaim(
+        stream, group, consumer, claim_idle_ms, "0-0", count=batch_size
+    )[1]
+    entries = dead_letter_entries(
+        r,
+        stream,
+        group,
+        [(entry_id, fields) for entry_id, fields in claimed if fields],
+        max_deliveries,
+        dead_letter_stream,
+    )
+
+    deadline = time.monotonic() + flush_ms / 1000
+    while len(entries) < batch_size:
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if remaining_ms <= 0:
+            break
+        response = r.xreadgroup(
+            group,
+            consumer,
+            {stream: ">"},
+            count=batch_size - len(entries),
+            block=remaining_ms,
+        )
+        for _, stream_entries in response or []:
+            entries.extend(stream_entries)
+    return entries
+
+
+def persist_write_behind_entries(app, stream, group, entries):
+    """
+    Persist entries, and only then acknowledge (and remove) them.
+    A batch the database rejects for its content (not a lost connection,
+    nor Redis) is split in halves, so a bad entry only holds back itself:
+    it stays pending until it is dead-lettered.
+    Returns the number of entries acknowledged.
+    """
+    with app.app_context():
+        try:
+            persist_stream_entries(entries)
+        except (OperationalError, redis.exceptions.RedisError):
+            raise
+        except Exception as e:
+            db.session.rollback()
+            if len(entries) == 1:
+                print(
+                    f"Write-behind entry {entries[0][0]} failed, "
+                    f"left pending: {e!r}"
+                )
+                return 0
+            half = len(entries) // 2
+            return persist_write_behind_entries(
+                app, stream, group, entries[:half]
+            ) + persist_write_behind_entries(
+                app, stream, group, entries[half:]
+            )
+
+    entry_ids = [entry_id for entry_id, _ in entries]
+    app.redis.xack(stream, group, *entry_ids)
+    app.redis.xdel(stream, *entry_ids)
+    return len(entries)
+
+
+def process_write_behind_batch(app, stream, group, consumer):
+    """
+    Read one batch and persist it (see persist_write_behind_entries).
+    Entries that fail stay pending and are claimed again later.
+    Returns the number of entries persisted.
+    """
+    entries = read_write_behind_batch(
+        app.redis,
+        stream,
+        group,
+        consumer,
+        app.config["WRITE_BEHIND_BATCH_SIZE"],
+        app.config["WRITE_BEHIND_FLUSH_MS"],
+        app.config["WRITE_BEHIND_CLAIM_IDLE_MS"],
+        app.config["WRITE_BEHIND_MAX_DELIVERIES"],
+        app.config["WRITE_BEHIND_DEAD_LETTER_STREAM"],
+    )
+    if not entries:
+        return 0
+    return persist_write_behind_entries(app, stream, group, entries)
+
+
+def background_write_behind_consumer(app):
+    """
+    Drain the write-behind stream into chat_messages with bulk inserts.
+    Entries are acknowledged (and removed) only after the batch commits.
+    """
+    stream = app.config["WRITE_BEHIND_STREAM"]
+    group = app.config["WRITE_BEHIND_GROUP"]
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+
+    try:
+        app.redis.xgroup_create(stream, group, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    while True:
+        try:
+            process_write_behind_batch(app, stream, group, consumer)
+        except OperationalError:
+            with app.app_context():
                 db.session.rollback()
                 db.engine.dispose()
-                print(
-                    "Detected stale DB connection, disposed engine and will retry."
+            print(
+                "Detected stale DB connection, disposed engine and will retry."
+            )
+            time.sleep(1)
+        except SQLAlchemyError as e:
+            with app.app_context():
+                db.session.rollback()
+            print(f"Write-behind batch failed, will retry: {e}")
+            time.sleep(1)
+        except redis.exceptions.RedisError as e:
+            # Unacknowledged entries are reclaimed on a later pass
+            print(f"Write-behind consumer error, will retry: {e}")
+            time.sleep(1)
+        except Exception as e:
+            # Never let one bad batch stop the consumer thread
+            print(f"Write-behind consumer error, will retry: {e!r}")
+            time.sleep(1)
+
+
+def background_encoding_migrator(app):
+    """
+    One pass of the message encoding migration, off the request path.
+    """
+    with app.app_context():
+        try:
+            migrate_message_encoding(app.redis, app.redis_raw)
+        except redis.exceptions.RedisError as e:
+            print(f"Message encoding migration failed: {e}")
+
+
+def background_session_index_migrator(app):
+    """
+    Convert legacy SET session indexes into recency ZSETs, off the request
+    path (they are also converted on first touch). On the first start with
+    dirty tracking, also mark every existing session dirty.
+    """
+    with app.app_context():
+        try:
+            migrated = migrate_all_session_indexes(app.redis)
+            if migrated:
+                print(f"Converted {migrated} session indexes to ZSETs")
+            if not app.redis.exists(DIRTY_BACKFILL_KEY):
+                marked = mark_all_sessions_dirty(app.redis)
+                print(f"Marked {marked} existing sessions dirty")
+        except redis.exceptions.RedisError as e:
+            print(f"Session index migration failed: {e}")
+
+
+def background_cold_tiering(app):
+    """
+    Periodically compress idle sessions into the Brotli cold tier (leader
+    only).
+    """
+    while True:
+        time.sleep(app.config["COLD_TIER_INTERVAL"])
+        if not app.leader_lease.is_leader:
+            continue
+        with app.app_context():
+            try:
+                run_tiering(
+                    app.redis,
+                    app.redis_raw,
+                    app.config["COLD_TIER_IDLE_SECONDS"],
+                    keep_going=lambda: app.leader_lease.is_leader,
                 )
+            except redis.exceptions.RedisError as e:
+                print(f"Cold tiering failed, will retry: {e}")
 
 
-def create_app():
+def create_app(start_jobs=None):
     app = Flask(__name__)
     CORS(app)
     app.config.from_object(Config)
@@ -63,21 +352,18 @@ def create_app():
     db.init_app(app)
     print("Engine options:", app.config.get("SQLALCHEMY_ENGINE_OPTIONS"))
 
-    # Create a robust Redis client
-    def create_robust_redis_client():
-        return redis.Redis(
-            host=Config.REDIS_HOST,
-            port=Config.REDIS_PORT,
-            db=Config.REDIS_DB,
-            decode_responses=Config.REDIS_DECODE_RESPONSES,
-            # The following help avoid stale connections in Redis:
-            socket_keepalive=True,
-            retry_on_timeout=True,
-            health_check_interval=30,
-            socket_connect_timeout=2,
-        )
-
-    app.redis = create_robust_redis_client()
+    # One pooled Redis client (with a circuit breaker) shared by all routes
+    app.redis = create_redis_client(app.config)
+    # Bytes client for binary values (msgpack conversation members)
+    app.redis_raw = create_redis_client(
+        app.config, decode_responses=False, breaker=app.redis.breaker
+    )
+    # Elects the one process that runs the singleton background jobs
+    app.leader_lease = LeaderLease(
+        app.redis,
+        app.config["LEADER_LEASE_KEY"],
+        app.config["LEADER_LEASE_TTL_MS"],
+    )
 
     # Register your Blueprints
     app.register_blueprint(chat_message_api_bp)
@@ -85,9 +371,100 @@ def create_app():
     app.register_blueprint(saved_movie_api_bp)
     app.register_blueprint(user_api_bp)
 
+    @app.cli.command("rebuild-search-index")
+    @click.argument("username", required=False)
+    def rebuild_search_index_command(username):
+        """Backfill the Redis search index (one user, or everyone)."""
+        if username:
+            usernames = [username]
+        else:
+            usernames = [
+                key[len("bot-sessions-") :]
+                for key in app.redis.scan_iter("bot-sessions-*")
+            ]
+        total = sum(rebuild_search_index(app.redis, u) for u in usernames)
+        click.echo(f"Indexed {total} messages for {len(usernames)} user(s).")
+
+    @app.cli.command("migrate-message-encoding")
+    def migrate_message_encoding_command():
+        """Re-encode legacy JSON conversation members as msgpack."""
+        sessions, migrated = migrate_message_encoding(
+            app.redis, app.redis_raw
+        )
+        click.echo(f"Re-encoded {migrated} messages in {sessions} sessions.")
+
+    @app.cli.command("migrate-session-index")
+    def migrate_session_index_command():
+        """Convert legacy SET session indexes into recency ZSETs."""
+        migrated = migrate_all_session_indexes(app.redis)
+        click.echo(f"Converted {migrated} session indexes.")
+
+    @app.cli.command("mark-sessions-dirty")
+    def mark_sessions_dirty_command():
+        """Mark every existing session dirty so the next sweep syncs it."""
+        marked = mark_all_sessions_dirty(app.redis)
+        click.echo(f"Marked {marked} sessions dirty.")
+
+    @app.cli.command("backfill-chat-sessions")
+    def backfill_chat_sessions_command():
+        """Add chat_sessions rows missing for existing chat_messages."""
+        click.echo(f"Added {backfill_chat_sessions()} chat sessions.")
+
+    @app.cli.command("create-indexes")
+    def create_indexes_command():
+        """Build missing indexes on existing tables (CONCURRENTLY)."""
+        created = create_missing_indexes()
+        click.echo(f"Created {len(created)} indexes: {', '.join(created)}")
+
+    @app.cli.command("compress-cold-sessions")
+    @click.option(
+        "--idle-seconds",
+        type=int,
+        default=None,
+        help="Override COLD_TIER_IDLE_SECONDS.",
+    )
+    def compress_cold_sessions_command(idle_seconds):
+        """Move idle sessions into the Brotli cold tier."""
+        stats = run_tiering(
+            app.redis,
+            app.redis_raw,
+            idle_seconds
+            if idle_seconds is not None
+            else app.config["COLD_TIER_IDLE_SECONDS"],
+        )
+        click.echo(
+            f"Compressed {stats['sessions']} sessions, "
+            f"saved {stats['bytes_saved']} bytes."
+        )
+
     # Ensure DB tables exist
     with app.app_context():
+        had_sessions_table = db.inspect(db.engine).has_table(
+            ChatSession.__tablename__
+        )
+        # Indexes added to existing tables: run `flask create-indexes`
         db.create_all()
+        # First start with chat_sessions: backfill it from the history
+        if not had_sessions_table:
+            print(f"Backfilled {backfill_chat_sessions()} chat sessions")
+
+    if start_jobs is None:
+        start_jobs = app.config["RUN_BACKGROUND_JOBS"]
+    if start_jobs:
+        start_background_jobs(app)
+
+    return app
+
+
+def start_background_jobs(app):
+    """
+    Start the background threads. Periodic singleton jobs are gated by the
+    leader lease, so every replica can run this safely; alternatively set
+    RUN_BACKGROUND_JOBS=False on the API replicas and run worker.py.
+    """
+    threading.Thread(
+        target=background_leader_election, args=(app,), daemon=True
+    ).start()
 
     # Start the background thread for inactive user cleanup
     thread = threading.Thread(
@@ -95,7 +472,33 @@ def create_app():
     )
     thread.start()
 
-    return app
+    # Write coalesced heartbeats to active_users
+    threading.Thread(
+        target=background_heartbeat_flusher, args=(app,), daemon=True
+    ).start()
+
+    # Convert legacy session indexes so background scans see them
+    threading.Thread(
+        target=background_session_index_migrator, args=(app,), daemon=True
+    ).start()
+
+    # Optionally re-encode legacy conversation members in the background
+    if app.config["MESSAGE_ENCODING_MIGRATE"]:
+        threading.Thread(
+            target=background_encoding_migrator, args=(app,), daemon=True
+        ).start()
+
+    # Optionally compress idle sessions into the cold tier
+    if app.config["COLD_TIER_ENABLED"]:
+        threading.Thread(
+            target=background_cold_tiering, args=(app,), daemon=True
+        ).start()
+
+    # Optionally persist messages in near real time from the stream
+    if app.config["WRITE_BEHIND_ENABLED"]:
+        threading.Thread(
+            target=background_write_behind_consumer, args=(app,), daemon=True
+        ).start()
 
 
 if __name__ == "__main__":
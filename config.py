@@ -32,6 +32,156 @@ class Config:
     REDIS_DECODE_RESPONSES = (
         os.getenv("REDIS_DECODE_RESPONSES", "True") == "True"
     )
+    # Encoding of new conversation ZSET members: "msgpack" (compact,
+    # prefixed binary) or "json" (legacy). Readers accept both.
+    MESSAGE_ENCODING = os.getenv("MESSAGE_ENCODING", "msgpack")
+    # Re-encode existing legacy members in a background thread at startup
+    MESSAGE_ENCODING_MIGRATE = (
+        os.getenv("MESSAGE_ENCODING_MIGRATE", "False") == "True"
+    )
+    # Shared connection pool size and per-command socket timeout (seconds)
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+    REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 2))
+    # Circuit breaker: open after N consecutive connection/timeout errors,
+    # probe again after the reset timeout (seconds)
+    REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", 5))
+    REDIS_BREAKER_RESET = float(os.getenv("REDIS_BREAKER_RESET", 10))
+
+    # --------------------------------------
+    # username -> user_id cache (in-process LRU, optionally shared)
+    # --------------------------------------
+    USER_ID_CACHE_SIZE = int(os.getenv("USER_ID_CACHE_SIZE", 10000))
+    USER_ID_CACHE_TTL = int(os.getenv("USER_ID_CACHE_TTL", 300))
+    # Also keep the mapping in the bot-user-ids Redis hash across replicas
+    USER_ID_CACHE_REDIS = os.getenv("USER_ID_CACHE_REDIS", "False") == "True"
+
+    # --------------------------------------
+    # Background jobs
+    # --------------------------------------
+    # Start the background threads inside every app process. Set to False
+    # on API replicas when running worker.py as a separate deployment.
+    RUN_BACKGROUND_JOBS = os.getenv("RUN_BACKGROUND_JOBS", "True") == "True"
+    # Only the holder of this Redis lease runs the singleton jobs; a dead
+    # holder is replaced within one TTL
+    LEADER_LEASE_KEY = os.getenv("LEADER_LEASE_KEY", "bot-leader-lease")
+    LEADER_LEASE_TTL_MS = int(os.getenv("LEADER_LEASE_TTL_MS", 15000))
+
+    # Threads syncing sessions to PostgreSQL in parallel (logout, inactivity
+    # sweep); each may hold one DB connection, so keep it below the
+    # SQLAlchemy pool size (5 + 10 overflow by default). 1 = sequential.
+    SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", 4))
+
+    # Prefetch of returning users: on a heartbeat (at most once per
+    # PREFETCH_COOLDOWN seconds after a successful run), rebuild an evicted
+    # session index and load the newest PREFETCH_MESSAGES messages of the
+    # PREFETCH_SESSIONS most recently active sessions into Redis, on its own
+    # pool of PREFETCH_WORKERS threads (prefetches are dropped while all of
+    # them are busy)
+    PREFETCH_ON_HEARTBEAT = (
+        os.getenv("PREFETCH_ON_HEARTBEAT", "True") == "True"
+    )
+    PREFETCH_SESSIONS = int(os.getenv("PREFETCH_SESSIONS", 5))
+    PREFETCH_MESSAGES = int(os.getenv("PREFETCH_MESSAGES", 50))
+    PREFETCH_COOLDOWN = int(os.getenv("PREFETCH_COOLDOWN", 300))
+    PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 2))
+
+    # --------------------------------------
+    # Active-user heartbeats
+    # --------------------------------------
+    # Seconds between bulk writes of the Redis heartbeats to active_users
+    HEARTBEAT_FLUSH_INTERVAL = int(os.getenv("HEARTBEAT_FLUSH_INTERVAL", 30))
+    # Users are synced and forgotten this long after their last heartbeat;
+    # the scheduler checks for due users every INACTIVE_CHECK_INTERVAL
+    # seconds and handles them INACTIVE_BATCH_SIZE at a time
+    INACTIVE_AFTER_SECONDS = int(os.getenv("INACTIVE_AFTER_SECONDS", 900))
+    INACTIVE_CHECK_INTERVAL = int(os.getenv("INACTIVE_CHECK_INTERVAL", 30))
+    INACTIVE_BATCH_SIZE = int(os.getenv("INACTIVE_BATCH_SIZE", 100))
+
+    # --------------------------------------
+    # Redis -> PostgreSQL sync
+    # --------------------------------------
+    # Rows per INSERT ... ON CONFLICT DO NOTHING statement when flushing
+    # a chat session from Redis into chat_messages.
+    SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", 500))
+
+    # Optional write-behind: send_message also XADDs every message to a
+    # Redis Stream, and a consumer-group worker bulk-inserts them into
+    # chat_messages in batches of N messages or T milliseconds.
+    WRITE_BEHIND_ENABLED = (
+        os.getenv("WRITE_BEHIND_ENABLED", "False") == "True"
+    )
+    WRITE_BEHIND_STREAM = os.getenv("WRITE_BEHIND_STREAM", "bot-chat-stream")
+    WRITE_BEHIND_GROUP = os.getenv("WRITE_BEHIND_GROUP", "chat-persisters")
+    WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 200))
+    WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", 500))
+    # Entries left unacknowledged this long by a dead consumer are claimed
+    WRITE_BEHIND_CLAIM_IDLE_MS = int(
+        os.getenv("WRITE_BEHIND_CLAIM_IDLE_MS", 60000)
+    )
+    # Entries delivered this many times without being persisted (a row the
+    # database keeps rejecting) are moved to the dead-letter stream
+    WRITE_BEHIND_MAX_DELIVERIES = int(
+        os.getenv("WRITE_BEHIND_MAX_DELIVERIES", 5)
+    )
+    WRITE_BEHIND_DEAD_LETTER_STREAM = os.getenv(
+        "WRITE_BEHIND_DEAD_LETTER_STREAM", "bot-chat-stream-dead"
+    )
+    # How long a deleted session's tombstone keeps the consumer from
+    # persisting stream entries sent before the delete (seconds)
+    WRITE_BEHIND_TOMBSTONE_TTL = int(
+        os.getenv("WRITE_BEHIND_TOMBSTONE_TTL", 86400)
+    )
+
+    # --------------------------------------
+    # Redis cache repopulation (after a miss falls back to PostgreSQL)
+    # --------------------------------------
+    # TTL in seconds for conversations rebuilt from PostgreSQL (0 = never
+    # expire; session indexes never do). Writes to a rehydrated key make it
+    # persistent again.
+    REDIS_REHYDRATE_TTL = int(os.getenv("REDIS_REHYDRATE_TTL", 86400))
+    # Members per ZADD/SADD command inside the repopulation pipeline
+    REDIS_REHYDRATE_CHUNK_SIZE = int(
+        os.getenv("REDIS_REHYDRATE_CHUNK_SIZE", 1000)
+    )
+    # Single-flight lock: how long the rebuilding request may hold it, and
+    # how long concurrent requests wait for it before reading PostgreSQL
+    REDIS_REHYDRATE_LOCK_TIMEOUT = int(
+        os.getenv("REDIS_REHYDRATE_LOCK_TIMEOUT", 10)
+    )
+    REDIS_REHYDRATE_WAIT = float(os.getenv("REDIS_REHYDRATE_WAIT", 2))
+
+    # Hot window: keep at most the newest N messages of a session in Redis
+    # (0 = no limit). Older ones are trimmed once synced to PostgreSQL and
+    # read back from there.
+    REDIS_HOT_WINDOW = int(os.getenv("REDIS_HOT_WINDOW", 0))
+
+    # --------------------------------------
+    # Brotli cold-session tier
+    # --------------------------------------
+    # Periodically collapse sessions whose newest message is older than
+    # COLD_TIER_IDLE_SECONDS into one compressed blob key
+    COLD_TIER_ENABLED = os.getenv("COLD_TIER_ENABLED", "False") == "True"
+    COLD_TIER_IDLE_SECONDS = int(os.getenv("COLD_TIER_IDLE_SECONDS", 86400))
+    COLD_TIER_INTERVAL = int(os.getenv("COLD_TIER_INTERVAL", 3600))
+    COLD_TIER_BROTLI_QUALITY = int(os.getenv("COLD_TIER_BROTLI_QUALITY", 5))
+
+    # --------------------------------------
+    # Message reads
+    # --------------------------------------
+    # Upper bound for the 'limit' parameter of paginated message reads
+    MESSAGES_MAX_PAGE_SIZE = int(os.getenv("MESSAGES_MAX_PAGE_SIZE", 200))
+    # Most sessions one POST /botchat/messages/batch request may read
+    MESSAGES_BATCH_MAX_SESSIONS = int(
+        os.getenv("MESSAGES_BATCH_MAX_SESSIONS", 50)
+    )
+    # Most messages one POST /botchat/messages/batch-send request may add
+    MESSAGES_BATCH_SEND_MAX = int(os.getenv("MESSAGES_BATCH_SEND_MAX", 1000))
+    # Characters of the last message kept in each session's metadata
+    SESSION_PREVIEW_LENGTH = int(os.getenv("SESSION_PREVIEW_LENGTH", 100))
+    # Most recent hits returned by /botchat/search
+    SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", 200))
+    # Most indexed terms the last (partial) word of a search expands to
+    SEARCH_PREFIX_EXPANSIONS = int(os.getenv("SEARCH_PREFIX_EXPANSIONS", 50))
 
     # --------------------------------------
     # Flask Secret Key
@@ -3,6 +3,11 @@ from datetime import datetime, timezone
 from . import db
 
 
+# Text search configuration shared by the GIN index and the search queries;
+# the query expression has to match the index expression to use it.
+SEARCH_CONFIG = db.literal_column("'english'::regconfig")
+
+
 class ChatMessage(db.Model):
     __tablename__ = "chat_messages"
     user_id = db.Column(db.Integer, primary_key=True)
@@ -17,5 +22,16 @@ class ChatMessage(db.Model):
         default=lambda: datetime.now(timezone.utc),
     )
 
+    __table_args__ = (
+        # Time-range reads across a user's sessions
+        db.Index("ix_chat_messages_user_timestamp", user_id, timestamp),
+        # Full-text search over messages (GIN expression index, PostgreSQL)
+        db.Index(
+            "ix_chat_messages_message_fts",
+            db.func.to_tsvector(SEARCH_CONFIG, message),
+            postgresql_using="gin",
+        ).ddl_if(dialect="postgresql"),
+    )
+
     def __repr__(self):
         return f"<ChatMessage user_id={self.user_id}, session_id={self.session_id}, sender={self.sender}, message={self.message}, timestamp={self.timestamp}>"
@@ -0,0 +1,23 @@
+from datetime import datetime
+
+from . import db
+
+
+class ChatSession(db.Model):
+    __tablename__ = "chat_sessions"
+    user_id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Text, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    # Latest persisted message (creation time until the first sync)
+    last_activity = db.Column(
+        db.DateTime, nullable=False, default=datetime.now
+    )
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Session lists of a user, most recently active first
+    __table_args__ = (
+        db.Index("ix_chat_sessions_user_activity", user_id, last_activity),
+    )
+
+    def __repr__(self):
+        return f"<ChatSession user_id={self.user_id}, session_id={self.session_id}, last_activity={self.last_activity}, message_count={self.message_count}>"
@@ -1,11 +1,20 @@
 from flask import Blueprint, jsonify, current_app
 
 from datetime import datetime
-import json
 
+import redis
+from sqlalchemy.dialects import postgresql, sqlite
+
+from config import Config
 from models import db
 from models.chat_message import ChatMessage
+from models.chat_session import ChatSession
 from models.user import User
+from routes.message_codec import decode_message, get_raw_redis_connection
+from routes.redis_client import get_redis_connection
+from routes.search_index import posting_member, term_key, tokenize
+from routes.settings import get_setting
+from routes.user_cache import UserIdCache
 
 
 other_api_bp = Blueprint("other", __name__)
@@ -21,60 +30,554 @@ def health_check():
 # =================================
 
 
+user_id_cache = UserIdCache(
+    Config.USER_ID_CACHE_SIZE, Config.USER_ID_CACHE_TTL
+)
+
+
 def get_user_id(username):
     """
     Helper to retrieve the user_id given a username.
+    Served from the in-process LRU cache (and, if enabled, the shared
+    bot-user-ids Redis hash) before falling back to the users table.
+    The shared hash is skipped while Redis is down or its breaker open.
     """
+    user_id = user_id_cache.get(username)
+    if user_id is not None:
+        return user_id
+
+    shared = get_setting("USER_ID_CACHE_REDIS")
+    if shared:
+        try:
+            user_id = get_redis_connection().hget("bot-user-ids", username)
+        except redis.exceptions.RedisError:
+            shared = False
+        if user_id is not None:
+            user_id = int(user_id)
+            user_id_cache.set(username, user_id)
+            return user_id
+
     user = User.query.filter_by(username=username).first()
-    return user.id if user else None
+    if not user:
+        return None
+    user_id_cache.set(username, user.id)
+    if shared:
+        try:
+            current_app.redis.hset("bot-user-ids", username, user.id)
+        except redis.exceptions.RedisError:
+            pass  # Only a cache, the next lookup fills it
+    return user.id
+
+
+def invalidate_user_id(username):
+    """
+    Forget a cached username -> user_id mapping (user created or deleted).
+    Other replicas drop their local copy when its TTL runs out.
+    """
+    user_id_cache.invalidate(username)
+    if get_setting("USER_ID_CACHE_REDIS"):
+        current_app.redis.hdel("bot-user-ids", username)
+
+
+def rehydration_lock(key):
+    """
+    Single-flight guard for rebuilding a Redis key from PostgreSQL, so
+    concurrent cache misses on the same key don't all rebuild it.
+    """
+    return current_app.redis.lock(
+        f"bot-lock-{key}",
+        timeout=get_setting("REDIS_REHYDRATE_LOCK_TIMEOUT"),
+        blocking_timeout=get_setting("REDIS_REHYDRATE_WAIT"),
+    )
+
+
+def expire_rehydrated(pipe, key):
+    """
+    Queue the configured TTL for a key rebuilt from PostgreSQL.
+    """
+    ttl = get_setting("REDIS_REHYDRATE_TTL")
+    if ttl > 0:
+        pipe.expire(key, ttl)
+
+
+def parse_message_timestamp(msg_obj, score):
+    """
+    Turn a decoded Redis message into the timestamp stored in Postgres.
+    The 'time' field is canonical; the ZSET score is the fallback.
+    """
+    try:
+        return datetime.strptime(msg_obj.get("time"), "%Y-%m-%d %H:%M:%S")
+    except Exception:
+        return datetime.fromtimestamp(score)
+
+
+def row_key(msg_obj, score):
+    """
+    The (timestamp, sender) a decoded Redis message has in chat_messages,
+    the rows' own keyset order.
+    """
+    return parse_message_timestamp(msg_obj, score), msg_obj.get("sender", "")
+
+
+def format_row_key(key):
+    at, sender = key
+    return f"{at.isoformat()}|{sender}"
+
+
+def parse_row_key(value):
+    at, _, sender = value.partition("|")
+    return datetime.fromisoformat(at), sender
+
+
+def trimmed_rows_key(username):
+    return f"bot-trimmed-rows-{username}"
+
+
+def raise_trimmed_row(r, username, session_id, key):
+    """
+    Move the (timestamp, sender) of the newest row trimmed out of a
+    session's hot window up to key; it never moves backwards.
+    """
+    hash_key = trimmed_rows_key(username)
+    while True:
+        with r.pipeline() as pipe:
+            try:
+                pipe.watch(hash_key)
+                current = pipe.hget(hash_key, session_id)
+                if current is not None and parse_row_key(current) >= key:
+                    return
+                pipe.multi()
+                pipe.hset(hash_key, session_id, format_row_key(key))
+                pipe.execute()
+                return
+            except redis.exceptions.WatchError:
+                continue
+
+
+def build_message_row(user_id, session_id, msg_obj, score):
+    """
+    Build a chat_messages row (as a dict) from a decoded Redis message.
+    """
+    return {
+        "user_id": user_id,
+        "session_id": session_id,
+        "sender": msg_obj.get("sender", ""),
+        "message": msg_obj.get("text", ""),
+        "timestamp": parse_message_timestamp(msg_obj, score),
+    }
+
+
+def dialect_insert():
+    """
+    The insert() of the session's dialect, for ON CONFLICT clauses.
+    """
+    if db.session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
+def insert_chat_messages(rows):
+    """
+    Bulk insert chat_messages rows in chunks, skipping rows whose composite
+    primary key already exists (INSERT ... ON CONFLICT DO NOTHING).
+    Returns the (user_id, session_id, timestamp) of the rows actually
+    inserted. Does not commit.
+    """
+    if not rows:
+        return []
+
+    insert = dialect_insert()
+    batch_size = get_setting("SYNC_BATCH_SIZE")
+    inserted = []
+    for start in range(0, len(rows), batch_size):
+        chunk = rows[start : start + batch_size]
+        stmt = (
+            insert(ChatMessage.__table__)
+            .values(chunk)
+            .on_conflict_do_nothing()
+            .returning(
+                ChatMessage.user_id,
+                ChatMessage.session_id,
+                ChatMessage.timestamp,
+            )
+        )
+        inserted += db.session.execute(stmt).all()
+    return inserted
+
+
+def create_chat_session(user_id, session_id):
+    """
+    Record a new session in chat_sessions (kept if it already exists).
+    Does not commit.
+    """
+    stmt = (
+        dialect_insert()(ChatSession.__table__)
+        .values(
+            user_id=user_id,
+            session_id=session_id,
+            created_at=datetime.now(),
+            last_activity=datetime.now(),
+            message_count=0,
+        )
+        .on_conflict_do_nothing()
+    )
+    db.session.execute(stmt)
+
+
+def refresh_chat_sessions(inserted):
+    """
+    Add freshly inserted messages to the chat_sessions rows of their
+    sessions (upserting missing ones), from the (user_id, session_id,
+    timestamp) returned by insert_chat_messages(): the count grows by the
+    rows inserted and last_activity only moves forward, so the history
+    already persisted is never re-read. Does not commit.
+    """
+    sessions = {}
+    for user_id, session_id, timestamp in inserted:
+        count, first, last = sessions.get(
+            (user_id, session_id), (0, timestamp, timestamp)
+        )
+        sessions[(user_id, session_id)] = (
+            count + 1,
+            min(first, timestamp),
+            max(last, timestamp),
+        )
+    if not sessions:
+        return
+
+    table = ChatSession.__table__
+    stmt = dialect_insert()(table).values(
+        [
+            {
+                "user_id": user_id,
+                "session_id": session_id,
+                "created_at": first,
+                "last_activity": last,
+                "message_count": count,
+            }
+            for (user_id, session_id), (count, first, last) in sessions.items()
+        ]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "session_id"],
+        set_={
+            "last_activity": db.case(
+                (
+                    stmt.excluded.last_activity > table.c.last_activity,
+                    stmt.excluded.last_activity,
+                ),
+                else_=table.c.last_activity,
+            ),
+            "message_count": table.c.message_count
+            + stmt.excluded.message_count,
+        },
+    )
+    db.session.execute(stmt)
+
+
+def backfill_chat_sessions():
+    """
+    Create the chat_sessions rows missing for history that predates the
+    table, from one grouped pass over chat_messages. Commits.
+    Returns the number of sessions added.
+    """
+    aggregates = (
+        db.session.query(
+            ChatMessage.user_id,
+            ChatMessage.session_id,
+            db.func.min(ChatMessage.timestamp),
+            db.func.max(ChatMessage.timestamp),
+            db.func.count(),
+        )
+        .group_by(ChatMessage.user_id, ChatMessage.session_id)
+        .subquery()
+    )
+    stmt = (
+        dialect_insert()(ChatSession.__table__)
+        .from_select(
+            [
+                "user_id",
+                "session_id",
+                "created_at",
+                "last_activity",
+                "message_count",
+            ],
+            # WHERE keeps SQLite from parsing ON CONFLICT as a join
+            db.select(aggregates).where(db.true()),
+        )
+        .on_conflict_do_nothing()
+    )
+    added = db.session.execute(stmt).rowcount
+    db.session.commit()
+    return added
+
+
+def create_missing_indexes():
+    """
+    Build the indexes create_all() skips on tables that already exist.
+    On PostgreSQL they are built CONCURRENTLY, so writes keep flowing; an
+    interrupted build leaves an INVALID index behind: drop it and rerun.
+    Returns the names of the indexes created.
+    """
+    def index_names(conn, table):
+        return {ix["name"] for ix in db.inspect(conn).get_indexes(table.name)}
+
+    created = []
+    with db.engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as conn:
+        for table in db.metadata.sorted_tables:
+            if not db.inspect(conn).has_table(table.name):
+                continue
+            existing = index_names(conn, table)
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                options = index.dialect_options["postgresql"]
+                options["concurrently"] = True
+                try:
+                    index.create(conn)
+                finally:
+                    options["concurrently"] = False
+            # Only report what was built: ddl_if() skips PostgreSQL-only
+            # indexes on other databases
+            created += sorted(index_names(conn, table) - existing)
+    return created
+
+
+# Advance a session's watermark (it never moves backwards) and clear its
+# dirty mark, unless a message newer than the watermark arrived while the
+# sync was running.
+# KEYS: conversation zset, watermark hash, dirty set
+# ARGV: session_id, new watermark ('' to leave it unchanged)
+MARK_SYNCED_SCRIPT = """
+local mark = redis.call('HGET', KEYS[2], ARGV[1])
+if ARGV[2] ~= '' and (not mark or tonumber(ARGV[2]) > tonumber(mark)) then
+    mark = ARGV[2]
+    redis.call('HSET', KEYS[2], ARGV[1], mark)
+end
+mark = mark or '-inf'
+if redis.call('ZCOUNT', KEYS[1], '(' .. mark, '+inf') == 0 then
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+"""
+
+
+# Advance a session's watermark after write-behind persisted some of its
+# messages, but only when they are all the messages above the watermark
+# (messages that never went through the stream keep it where it is until
+# a regular sync reads them), then clear the dirty mark as MARK_SYNCED does.
+# KEYS: conversation zset, watermark hash, dirty set
+# ARGV: session_id, scores of the persisted messages...
+MARK_STREAMED_SCRIPT = """
+local mark = redis.call('HGET', KEYS[2], ARGV[1])
+local newest, above = nil, 0
+for i = 2, #ARGV do
+    local score = tonumber(ARGV[i])
+    if not mark or score > tonumber(mark) then
+        above = above + 1
+        if not newest or score > tonumber(newest) then
+            newest = ARGV[i]
+        end
+    end
+end
+if newest and redis.call(
+    'ZCOUNT', KEYS[1], mark and '(' .. mark or '-inf', newest
+) == above then
+    mark = newest
+    redis.call('HSET', KEYS[2], ARGV[1], mark)
+end
+mark = mark or '-inf'
+if redis.call('ZCOUNT', KEYS[1], '(' .. mark, '+inf') == 0 then
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+"""
+
+
+# Trim a session's conversation ZSET down to the hot window, removing only
+# members at or below the watermark (already in PostgreSQL). Records the
+# highest trimmed score as the session's trimmed-through mark.
+# KEYS: conversation zset, watermark hash, trimmed-through hash
+# ARGV: session_id, window size
+# Returns the trimmed members and scores (flat, oldest first).
+TRIM_HOT_WINDOW_SCRIPT = """
+local mark = redis.call('HGET', KEYS[2], ARGV[1])
+if not mark then
+    return {}
+end
+local n = math.min(
+    redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[2]),
+    redis.call('ZCOUNT', KEYS[1], '-inf', mark)
+)
+if n <= 0 then
+    return {}
+end
+local trimmed = redis.call('ZRANGE', KEYS[1], 0, n - 1, 'WITHSCORES')
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, n - 1)
+local through = redis.call('HGET', KEYS[3], ARGV[1])
+if not through or tonumber(trimmed[#trimmed]) > tonumber(through) then
+    redis.call('HSET', KEYS[3], ARGV[1], trimmed[#trimmed])
+end
+return trimmed
+"""
+
+
+def trim_hot_window(username, session_id):
+    """
+    Cap a synced session at REDIS_HOT_WINDOW messages in Redis and drop
+    the search postings of the trimmed ones.
+    Returns the number of messages trimmed.
+    """
+    window = get_setting("REDIS_HOT_WINDOW")
+    if not window:
+        return 0
+    raw = get_raw_redis_connection()
+    trim = raw.register_script(TRIM_HOT_WINDOW_SCRIPT)
+    trimmed = trim(
+        keys=[
+            f"bot-{username}-{session_id}",
+            f"bot-synced-{username}",
+            f"bot-trimmed-{username}",
+        ],
+        args=[session_id, window],
+    )
+    if not trimmed:
+        return 0
+
+    pipe = current_app.redis.pipeline(transaction=False)
+    newest = None
+    for member, score in zip(trimmed[::2], trimmed[1::2]):
+        msg_obj = decode_message(member)
+        posting = posting_member(session_id, float(score))
+        for term in tokenize(msg_obj.get("text", "")):
+            pipe.zrem(term_key(username, term), posting)
+        key = row_key(msg_obj, float(score))
+        if newest is None or key > newest:
+            newest = key
+    pipe.execute()
+    # PostgreSQL rows carry the client 'time', not the score, so readers
+    # stitch the trimmed history back on by row key.
+    raise_trimmed_row(current_app.redis, username, session_id, newest)
+    return len(trimmed) // 2
 
 
 def sync_redis_session_to_postgres(username, session_id):
     """
-    Reads all messages for (username, session_id) from Redis,
-    writes them into the chat_messages table (if not already present).
+    Reads the messages for (username, session_id) that arrived in Redis
+    since the last successful sync and writes them into the chat_messages
+    table (if not already present).
+    The high-water mark (last synced ZSET score) of each session lives in
+    the bot-synced-{username} hash, next to the session list, and the
+    session is removed from the bot-dirty-{username} set once synced, and
+    then trimmed to the hot window.
+    Returns {"inserted": n, "skipped": m}.
     """
+    result = {"inserted": 0, "skipped": 0}
     user_id = get_user_id(username)
     if not user_id:
-        return  # No such user in DB
+        return result  # No such user in DB
 
     conversation_key = f"bot-{username}-{session_id}"
-    raw_data = current_app.redis.zrange(
-        conversation_key, 0, -1, withscores=True
+    watermark_key = f"bot-synced-{username}"
+    mark_synced = current_app.redis.register_script(MARK_SYNCED_SCRIPT)
+    mark_keys = [conversation_key, watermark_key, f"bot-dirty-{username}"]
+    watermark = current_app.redis.hget(watermark_key, session_id)
+    raw_data = get_raw_redis_connection().zrangebyscore(
+        conversation_key,
+        f"({watermark}" if watermark else "-inf",
+        "+inf",
+        withscores=True,
     )
+    if not raw_data:
+        mark_synced(keys=mark_keys, args=[session_id, ""])
+        return result
 
+    # Decode the new tail once and de-duplicate on the primary key in memory
+    rows = {}
     for msg_json, score in raw_data:
-        msg_obj = json.loads(msg_json)
-        sender = msg_obj.get("sender", "")
-        text = msg_obj.get("text", "")
-        # If 'time' was your canonical timestamp, parse it; otherwise use 'score'.
-        # Example uses the 'time' field:
-        ts_str = msg_obj.get("time")
-        try:
-            # Attempt to parse the original timestamp string:
-            timestamp = datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-        except Exception:
-            # Fallback: Use 'score' to create a timestamp
-            timestamp = datetime.fromtimestamp(score)
-
-        # Insert only if not exists (simple approach: try-except for duplicates):
-        existing = ChatMessage.query.filter_by(
-            user_id=user_id,
-            session_id=session_id,
-            sender=sender,
-            message=text,
-            timestamp=timestamp,
-        ).first()
-        if existing:
-            continue
-
-        chat_msg = ChatMessage(
-            user_id=user_id,
-            session_id=session_id,
-            sender=sender,
-            message=text,
-            timestamp=timestamp,
+        row = build_message_row(
+            user_id, session_id, decode_message(msg_json), score
+        )
+        rows.setdefault((row["sender"], row["timestamp"]), row)
+
+    inserted = insert_chat_messages(list(rows.values()))
+    refresh_chat_sessions(inserted)
+    db.session.commit()
+
+    # Only advance the mark once the rows are safely committed
+    mark_synced(keys=mark_keys, args=[session_id, repr(raw_data[-1][1])])
+    trim_hot_window(username, session_id)
+
+    result["inserted"] = len(inserted)
+    result["skipped"] = len(raw_data) - len(inserted)
+    return result
+
+
+def tombstone_key(username, session_id):
+    return f"bot-deleted-{username}-{session_id}"
+
+
+def persist_stream_entries(entries):
+    """
+    Write a batch of write-behind stream entries into chat_messages with one
+    bulk insert, then advance the watermark of the sessions whose unsynced
+    messages the batch covers entirely.
+    Entries of sessions deleted after they were sent (see delete_session's
+    tombstone) are dropped.
+    entries: list of (entry_id, fields) as returned by XREADGROUP.
+    Returns the number of rows inserted. The caller acknowledges the
+    entries once this returns.
+    """
+    user_ids = {}
+    sessions = {}
+    for _, fields in entries:
+        username = fields["username"]
+        if username not in user_ids:
+            user_ids[username] = get_user_id(username)
+        if not user_ids[username]:
+            continue  # User was deleted, nothing to persist
+        sessions.setdefault((username, fields["session_id"]), []).append(
+            fields
         )
-        db.session.add(chat_msg)
 
+    keys = list(sessions)
+    pipe = current_app.redis.pipeline(transaction=False)
+    for username, session_id in keys:
+        pipe.get(tombstone_key(username, session_id))
+    deleted_at = dict(zip(keys, pipe.execute()))
+
+    rows = {}
+    scores = {}
+    for (username, session_id), session_entries in sessions.items():
+        for fields in session_entries:
+            score = float(fields["score"])
+            tombstone = deleted_at[(username, session_id)]
+            if tombstone is not None and score <= float(tombstone):
+                continue  # Sent before the session was deleted
+            row = build_message_row(
+                user_ids[username], session_id, fields, score
+            )
+            rows.setdefault(
+                (row["user_id"], session_id, row["sender"], row["timestamp"]),
+                row,
+            )
+            scores.setdefault((username, session_id), []).append(
+                fields["score"]
+            )
+
+    inserted = insert_chat_messages(list(rows.values()))
+    refresh_chat_sessions(inserted)
     db.session.commit()
+
+    mark_streamed = current_app.redis.register_script(MARK_STREAMED_SCRIPT)
+    for (username, session_id), session_scores in scores.items():
+        mark_streamed(
+            keys=[
+                f"bot-{username}-{session_id}",
+                f"bot-synced-{username}",
+                f"bot-dirty-{username}",
+            ],
+            args=[session_id, *session_scores],
+        )
+        trim_hot_window(username, session_id)
+    return len(inserted)
@@ -1,53 +1,99 @@
 from datetime import datetime, timezone
-from flask import Blueprint, request, jsonify, current_app
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    jsonify,
+    request,
+    stream_with_context,
+)
 from sqlalchemy.exc import SQLAlchemyError
 import redis
-import json
 import time
-import random
 
 from models import db
-
-# Look up the User by username
-from models.user import User
-from models.active_user import ActiveUser
 from models.chat_message import ChatMessage
-from . import get_user_id
-from routes import sync_redis_session_to_postgres
+from models.chat_session import ChatSession
+from . import (
+    expire_rehydrated,
+    get_setting,
+    get_user_id,
+    rehydration_lock,
+    user_id_cache,
+)
+from routes import (
+    create_chat_session,
+    format_row_key,
+    parse_message_timestamp,
+    parse_row_key,
+    raise_trimmed_row,
+    row_key,
+    sync_redis_session_to_postgres,
+    tombstone_key,
+    trimmed_rows_key,
+)
+from routes.cold_tier import (
+    cold_key,
+    inflate_cold_blob,
+    last_tiering_run,
+    load_cold_session,
+    promote_session,
+)
+from routes.heartbeats import (
+    last_inactivity_sweep,
+    record_heartbeat,
+    scheduler_lag,
+)
+from routes.message_codec import (
+    decode_message,
+    encode_message,
+    get_raw_redis_connection,
+)
+from routes.redis_client import get_redis_connection, redis_status
+from routes.search_index import (
+    drop_postings,
+    index_message,
+    remove_session_from_index,
+    search_index,
+    search_postgres,
+    session_terms_key,
+    term_dictionary_key,
+    term_key,
+    tokenize,
+)
+from routes.session_index import (
+    all_session_ids,
+    format_session_cursor,
+    page_sessions,
+    parse_session_cursor,
+    migrate_session_index,
+    session_score,
+    with_index_migration,
+)
+from routes.sync_executor import (
+    submit_prefetch,
+    sync_dirty_sessions,
+    sync_timings,
+)
+from routes.time_range import (
+    merge_tiers,
+    parse_time_arg,
+    postgres_range,
+    redis_range,
+    stream_messages,
+)
+from routes.unix_time import parse_unix_time
+from routes.session_meta import (
+    backfill_session_meta,
+    fetch_session_meta,
+    meta_key,
+    preview,
+)
 
 
 chat_message_api_bp = Blueprint("chat_message", __name__)
 
 
-def get_redis_connection():
-    """
-    Returns a valid Redis connection. If the existing connection
-    is stale/closed, re-initialize and retry once.
-    """
-    for attempt in range(2):
-        try:
-            current_app.redis.ping()
-            print("Debug: Successfully pinged")
-            # If ping succeeds, return it
-            return current_app.redis
-        except redis.exceptions.RedisError:
-            print(
-                f"Debug: Unsuccessfully pinged, re-initialising redis client, {attempt = }"
-            )
-            # Re-init just the Redis client, NOT the entire Flask app
-            current_app.redis = redis.Redis(
-                host=current_app.config["REDIS_HOST"],
-                port=current_app.config["REDIS_PORT"],
-                db=current_app.config["REDIS_DB"],
-                decode_responses=current_app.config["REDIS_DECODE_RESPONSES"],
-                socket_keepalive=True,
-                retry_on_timeout=True,
-                health_check_interval=30,
-                socket_connect_timeout=2,
-            )
-    raise redis.exceptions.ConnectionError("Could not reconnect to Redis.")
-
-
 # =================================
 #    Chat Message Endpoints
 # =================================
@@ -76,17 +122,24 @@ def new_session():
 
     r = get_redis_connection()  # <-- Ensure valid Redis connection
     session_list_key = f"bot-sessions-{username}"
-    # Check uniqueness (case-insensitive)
-    existing_sessions = {s.lower() for s in r.smembers(session_list_key)}
-    if session_name in existing_sessions:
+    # Check uniqueness (names are stored lowercased, so this is one ZSCORE)
+    if session_score(r, username, session_name) is not None:
         return jsonify(
             {
                 "error": f"Session '{session_name}' already exists for user '{username}'."
             }
         ), 400
 
-    # Add session to Redis
-    r.sadd(session_list_key, session_name)
+    # Add session to Redis (clearing the TTL older versions gave rebuilt
+    # session lists)
+    pipe = r.pipeline()
+    pipe.zadd(session_list_key, {session_name: time.time()}, nx=True)
+    pipe.persist(session_list_key)
+    pipe.execute()
+
+    # Durable record, so the session survives Redis before any message
+    create_chat_session(user_id, session_name)
+    db.session.commit()
 
     return jsonify({"message": f"New session '{session_name}' created!"}), 201
 
@@ -96,19 +149,44 @@ def get_sessions(username):
     """
     Return all session IDs for a given user.
     1) Check Redis first with a timeout limit.
-    2) If Redis is empty or times out, fallback to PostgreSQL (chat_messages).
+    2) If Redis is empty or times out, fallback to PostgreSQL (chat_sessions).
     3) Repopulate Redis for faster future requests.
+    With details=true, also return each session's metadata (message count,
+    first/last time, last message preview and sender) in one pipelined
+    fetch; sort=activity orders sessions by last activity, newest first.
+    With limit (and the next_cursor of the previous page as cursor), return
+    one page of sessions, most recently active first.
     """
     session_list_key = f"bot-sessions-{username}"
-    r = get_redis_connection()
+    r = None
     redis_timeout_limit = 1  # Max 1 seconds for Redis to respond
 
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor")
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    try:
+        cursor = parse_session_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({"error": "cursor must be a next_cursor value"}), 400
+    by_activity = limit is not None or request.args.get("sort") == "activity"
+
     session_ids = []
+    next_cursor = None
+    from_redis = False
 
     try:
+        # Fails fast while the circuit breaker is open
+        r = get_redis_connection()
+
         # Time-bound Redis request to avoid cold start delay
         start_time = time.time()
-        redis_sessions = r.smembers(session_list_key)
+        if limit is not None:
+            session_ids, next_cursor = page_sessions(
+                r, username, limit, cursor
+            )
+        else:
+            session_ids = all_session_ids(r, username, newest_first=True)
         elapsed_time = time.time() - start_time
 
         if elapsed_time > redis_timeout_limit:
@@ -116,8 +194,8 @@ def get_sessions(username):
                 f"Redis request took too long ({elapsed_time:.2f}s)"
             )
 
-        if redis_sessions:
-            session_ids = sorted(list(redis_sessions))
+        if session_ids or cursor is not None:
+            from_redis = True
             current_app.logger.info(
                 f"Fetched sessions from Redis for {username} in {elapsed_time:.2f}s"
             )
@@ -130,25 +208,50 @@ def get_sessions(username):
             f"Redis unavailable or slow for {username}, falling back to PostgreSQL: {str(e)}"
         )
 
-    if not session_ids:
+    if not from_redis:
         # Fallback to PostgreSQL
         user_id = get_user_id(username)
         if not user_id:
             return jsonify({"sessions": []}), 200
 
         try:
-            # Query distinct session_ids from chat_messages
-            session_records = (
-                db.session.query(ChatMessage.session_id)
-                .filter_by(user_id=user_id)
-                .distinct()
-                .all()
+            # Bounded scan of ix_chat_sessions_user_activity, newest first
+            # (ties by id, descending, like the Redis index)
+            query = ChatSession.query.filter_by(user_id=user_id).order_by(
+                ChatSession.last_activity.desc(), ChatSession.session_id.desc()
             )
-            session_ids = [row.session_id for row in session_records]
+            if limit is not None:
+                if cursor is not None:
+                    score, after_id = cursor
+                    at = datetime.fromtimestamp(score)
+                    older = ChatSession.last_activity < at
+                    if after_id is not None:
+                        older = db.or_(
+                            older,
+                            db.and_(
+                                ChatSession.last_activity == at,
+                                ChatSession.session_id < after_id,
+                            ),
+                        )
+                    query = query.filter(older)
+                query = query.limit(limit + 1)
+            session_records = query.all()
+            scores = {
+                row.session_id: row.last_activity.timestamp()
+                for row in session_records
+            }
+            session_ids = list(scores)
+            if limit is not None and len(session_ids) > limit:
+                session_ids = session_ids[:limit]
+                next_cursor = format_session_cursor(
+                    scores[session_ids[-1]], session_ids[-1]
+                )
 
-            # Repopulate Redis so future requests are faster
-            for sid in session_ids:
-                r.sadd(session_list_key, sid)
+            # Repopulate Redis so future requests are faster (only with
+            # the full list, a page would pass for the whole index). The
+            # index gets no TTL: sends and deletes check sessions in it.
+            if scores and r is not None and limit is None:
+                r.zadd(session_list_key, scores)
 
             current_app.logger.info(
                 f"Repopulated Redis with sessions for {username}"
@@ -160,13 +263,223 @@ def get_sessions(username):
             )
             return jsonify({"error": "Database error"}), 500
 
-    return jsonify({"sessions": session_ids}), 200
+    if not by_activity:
+        session_ids.sort()
+    response = {"sessions": session_ids}
+    if limit is not None:
+        response["next_cursor"] = next_cursor
+
+    want_details = request.args.get("details", "").lower() == "true"
+    if want_details and r is not None:
+        details = fetch_session_meta(
+            r, get_raw_redis_connection(), username, session_ids
+        )
+        response["details"] = [details[sid] for sid in session_ids]
+    return jsonify(response), 200
+
+
+# Store messages of one session and all their bookkeeping in a single
+# round trip. Scores come from the Redis clock, kept above the session's
+# newest score and its sync watermark, so a message never lands below a
+# watermark that a sync already advanced (concurrent sends, replica clock
+# skew). When the conversation ZSET is gone (a rebuilt key expired, or it
+# was evicted), everything up to the watermark only lives in PostgreSQL:
+# the session is marked trimmed through it, so reads stitch it back in
+# (the caller records the row boundary, see after_store()).
+# KEYS: session index, conversation, cold blob, metadata hash, dirty set,
+#       session terms set, write-behind stream, watermark hash,
+#       trimmed-through hash, term dictionary, then one posting key per
+#       distinct term
+# ARGV: session_id, username, write-behind ('1' or ''), message count n,
+#       n x (member, sender, preview, text, time),
+#       n x (term count c, c indexes into KEYS),
+#       then the distinct terms (aligned with KEYS[11..])
+# Returns {was_cold, had_meta, rebased}, or a NOSESSION error if the session
+# doesn't exist (before anything is written).
+SEND_MESSAGE_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return redis.error_reply('NOSESSION ' .. ARGV[1])
+end
+-- Replicate the writes, not the script: TIME is not deterministic
+redis.replicate_commands()
+local was_cold = redis.call('EXISTS', KEYS[3])
+local had_meta = redis.call('EXISTS', KEYS[4])
+local n = tonumber(ARGV[4])
+local function field(i, f)
+    return ARGV[4 + (i - 1) * 5 + f]
+end
+
+-- Python's repr() of a float, so postings match posting_member()
+local function float_repr(x)
+    for digits = 10, 17 do
+        local s = string.format('%.' .. digits .. 'g', x)
+        if tonumber(s) == x and not string.find(s, 'e') then
+            if not string.find(s, '%.') then
+                s = s .. '.0'
+            end
+            return s
+        end
+    end
+    return string.format('%.17g', x)
+end
+
+local now = redis.call('TIME')
+local base = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local newest = redis.call('ZREVRANGE', KEYS[2], 0, 0, 'WITHSCORES')[2]
+if newest and tonumber(newest) + 0.000001 > base then
+    base = tonumber(newest) + 0.000001
+end
+local mark = redis.call('HGET', KEYS[8], ARGV[1])
+if mark and tonumber(mark) + 0.000001 > base then
+    base = tonumber(mark) + 0.000001
+end
+local rebased = 0
+if mark and not newest and was_cold == 0 then
+    rebased = 1
+    local through = redis.call('HGET', KEYS[9], ARGV[1])
+    if not through or tonumber(mark) > tonumber(through) then
+        redis.call('HSET', KEYS[9], ARGV[1], mark)
+    end
+end
+local scores = {}
+for i = 1, n do
+    scores[i] = float_repr(base + (i - 1) * 0.000001)
+end
+
+-- ZADD in chunks, to stay clear of Lua's unpack() limit
+local members = {}
+for i = 1, n do
+    members[#members + 1] = scores[i]
+    members[#members + 1] = field(i, 1)
+    if #members == 1000 or i == n then
+        redis.call('ZADD', KEYS[2], unpack(members))
+        members = {}
+    end
+end
+-- Unsynced messages must never expire with a rehydrated key
+redis.call('PERSIST', KEYS[2])
+redis.call('PERSIST', KEYS[1])
+redis.call('ZADD', KEYS[1], 'XX', scores[n], ARGV[1])
+redis.call('SADD', KEYS[5], ARGV[1])
+
+local pos = 5 + n * 5
+for i = 1, n do
+    local posting = ARGV[1] .. '\\0' .. scores[i]
+    for j = 1, tonumber(ARGV[pos]) do
+        redis.call('ZADD', KEYS[tonumber(ARGV[pos + j])], scores[i], posting)
+    end
+    pos = pos + tonumber(ARGV[pos]) + 1
+end
+for k = 11, #KEYS do
+    redis.call('SADD', KEYS[6], ARGV[pos + k - 11])
+    redis.call('ZADD', KEYS[10], 0, ARGV[pos + k - 11])
+end
+
+redis.call('HINCRBY', KEYS[4], 'count', n)
+redis.call('HSETNX', KEYS[4], 'first_ts', scores[1])
+redis.call('HSET', KEYS[4], 'last_ts', scores[n],
+    'last_sender', field(n, 2), 'last_preview', field(n, 3))
+if ARGV[3] == '1' then
+    for i = 1, n do
+        redis.call('XADD', KEYS[7], '*', 'username', ARGV[2],
+            'session_id', ARGV[1], 'score', scores[i],
+            'sender', field(i, 2), 'text', field(i, 4),
+            'time', field(i, 5))
+    end
+end
+return {was_cold, had_meta, rebased}
+"""
+
+
+def store_messages(raw, username, session_id, messages, client=None):
+    """
+    Run SEND_MESSAGE_SCRIPT (EVALSHA, loaded on first use) for messages of
+    one session, given oldest first: the conversation ZSET, session
+    recency, dirty mark, search postings, metadata and the optional
+    write-behind entries. The script assigns the scores.
+    Returns (was_cold, had_meta, rebased); raises
+    ResponseError("NOSESSION ...").
+    Pass a pipeline as client to queue the call instead.
+    """
+    term_index = {}
+    args = [
+        session_id,
+        username,
+        "1" if get_setting("WRITE_BEHIND_ENABLED") else "",
+        len(messages),
+    ]
+    message_terms = []
+    for message_data in messages:
+        args += [
+            encode_message(message_data),
+            message_data["sender"],
+            preview(message_data["text"]),
+            message_data["text"],
+            message_data["time"],
+        ]
+        terms = sorted(tokenize(message_data["text"]))
+        for term in terms:
+            # KEYS index (1-based) of the term's posting key
+            term_index.setdefault(term, 11 + len(term_index))
+        message_terms.append([len(terms)] + [term_index[t] for t in terms])
+    for entry in message_terms:
+        args += entry
+    args += list(term_index)
+
+    keys = [
+        f"bot-sessions-{username}",
+        f"bot-{username}-{session_id}",
+        cold_key(username, session_id),
+        meta_key(username, session_id),
+        f"bot-dirty-{username}",
+        session_terms_key(username, session_id),
+        get_setting("WRITE_BEHIND_STREAM"),
+        f"bot-synced-{username}",
+        f"bot-trimmed-{username}",
+        term_dictionary_key(username),
+    ] + [term_key(username, term) for term in term_index]
+    send = raw.register_script(SEND_MESSAGE_SCRIPT)
+    if client is not None:
+        return send(keys=keys, args=args, client=client)
+    was_cold, had_meta, rebased = send(keys=keys, args=args)
+    return was_cold, had_meta, rebased
+
+
+def after_store(raw, username, session_id, was_cold, had_meta, rebased):
+    """
+    The rare follow-ups of a store that the script can't do itself.
+    """
+    if rebased:
+        # The lost conversation only lives in PostgreSQL now: stitch reads
+        # back on after its newest row
+        user_id = get_user_id(username)
+        newest = user_id and keyset_order(
+            ChatMessage.query.filter_by(
+                user_id=user_id, session_id=session_id
+            ),
+            backwards=True,
+        ).first()
+        if newest:
+            raise_trimmed_row(
+                current_app.redis,
+                username,
+                session_id,
+                (newest.timestamp, newest.sender),
+            )
+    if was_cold:
+        # A session in the cold tier gets promoted back now this landed
+        promote_session(raw, username, session_id)
+    if not had_meta:
+        # First message since metadata tracking: count the whole session
+        backfill_session_meta(current_app.redis, raw, username, session_id)
 
 
 @chat_message_api_bp.route("/botchat/messages", methods=["POST"])
 def send_message():
     """
     Add a new message to a session in Redis.
+    The existence check and all bookkeeping run server-side in one
+    round trip (SEND_MESSAGE_SCRIPT).
     """
     data = request.get_json()
     username = data.get("username", "").strip()
@@ -183,28 +496,611 @@ def send_message():
             {"error": "username, session_id, and message are required."}
         ), 400
 
-    # Ensure session exists in Redis
-    session_list_key = f"bot-sessions-{username}"
-    if not current_app.redis.sismember(session_list_key, session_id):
+    # Store in Redis
+    message_data = {"sender": sender, "text": message, "time": timestamp}
+
+    raw = get_raw_redis_connection()
+    try:
+        reply = with_index_migration(
+            current_app.redis,
+            username,
+            lambda: store_messages(raw, username, session_id, [message_data]),
+        )
+    except redis.exceptions.ResponseError as e:
+        if not str(e).startswith("NOSESSION"):
+            raise
         return jsonify(
             {
                 "error": f"Session '{session_id}' does not exist for user '{username}'."
             }
         ), 400
 
-    # Store in Redis
-    conversation_key = f"bot-{username}-{session_id}"
-    message_data = {"sender": sender, "text": message, "time": timestamp}
-
-    # Use (time.time() + random fraction) for the ZSET score
-    score = time.time() + random.random() / 10000
-    current_app.redis.zadd(conversation_key, {json.dumps(message_data): score})
+    after_store(raw, username, session_id, *reply)
 
     return jsonify(
         {"message": "Message stored successfully!", "time": timestamp}
     ), 201
 
 
+@chat_message_api_bp.route("/botchat/messages/batch-send", methods=["POST"])
+def send_messages_batch():
+    """
+    Add many messages (e.g. a replayed transcript) in one request.
+    Body: {"username", "messages": [{"session_id", "sender", "message",
+    "time"}, ...]}. Each session is checked and written once, by one
+    SEND_MESSAGE_SCRIPT call carrying all of its messages, and all calls
+    share one pipeline. A bad item or unknown session only fails its own
+    items.
+    Returns {"results": [{"index", "status", ...}], "stored", "failed"}.
+    """
+    data = request.get_json() or {}
+    username = (data.get("username") or "").strip()
+    items = data.get("messages")
+    max_items = get_setting("MESSAGES_BATCH_SEND_MAX")
+    if not username or not isinstance(items, list) or not items:
+        return jsonify({"error": "username and messages are required."}), 400
+    if len(items) > max_items:
+        return jsonify(
+            {"error": f"At most {max_items} messages per batch."}
+        ), 400
+
+    results = [None] * len(items)
+    sessions = {}
+    for index, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        session_id = str(item.get("session_id") or "").strip().lower()
+        message = str(item.get("message") or "").strip()
+        if not session_id or not message:
+            results[index] = {
+                "index": index,
+                "status": "error",
+                "error": "session_id and message are required.",
+            }
+            continue
+        timestamp = str(item.get("time") or "").strip() or time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime()
+        )
+        message_data = {
+            "sender": str(item.get("sender") or username).strip(),
+            "text": message,
+            "time": timestamp,
+        }
+        # The script scores them in batch order, like sequential sends
+        sessions.setdefault(session_id, []).append((index, message_data))
+
+    raw = get_raw_redis_connection()
+
+    def store_all(session_ids):
+        pipe = raw.pipeline(transaction=False)
+        for session_id in session_ids:
+            messages = [msg for _, msg in sessions[session_id]]
+            store_messages(raw, username, session_id, messages, client=pipe)
+        return dict(zip(session_ids, pipe.execute(raise_on_error=False)))
+
+    replies = store_all(list(sessions))
+    legacy = [
+        session_id
+        for session_id, reply in replies.items()
+        if isinstance(reply, redis.exceptions.ResponseError)
+        and "WRONGTYPE" in str(reply)
+    ]
+    if legacy and migrate_session_index(current_app.redis, username):
+        replies.update(store_all(legacy))
+
+    for session_id, reply in replies.items():
+        error = None
+        if isinstance(reply, Exception):
+            if str(reply).startswith("NOSESSION"):
+                error = f"Session '{session_id}' does not exist for user '{username}'."
+            else:
+                # Only this session's items fail, the rest are stored
+                current_app.logger.warning(
+                    f"Batch send to {username}/{session_id} failed: {reply}"
+                )
+                error = f"Could not store messages in session '{session_id}'."
+        else:
+            after_store(raw, username, session_id, *reply)
+        for index, message_data in sessions[session_id]:
+            if error:
+                results[index] = {
+                    "index": index,
+                    "status": "error",
+                    "error": error,
+                }
+            else:
+                results[index] = {
+                    "index": index,
+                    "status": "stored",
+                    "time": message_data["time"],
+                }
+
+    stored = sum(result["status"] == "stored" for result in results)
+    return jsonify(
+        {
+            "results": results,
+            "stored": stored,
+            "failed": len(results) - stored,
+        }
+    ), 200
+
+
+def message_from_record(record):
+    """
+    Convert a ChatMessage row into (message_obj, ZSET score).
+    """
+    message_obj = {
+        "sender": record.sender,
+        "text": record.message,
+        "time": record.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    return message_obj, record.timestamp.timestamp()
+
+
+def format_cursor(message_obj, score):
+    """
+    The page cursor after a message: its score, which bounds Redis reads,
+    plus its row key (timestamp, sender), which bounds PostgreSQL ones.
+    """
+    return f"{score!r}:{format_row_key(row_key(message_obj, score))}"
+
+
+def parse_cursor(value):
+    """
+    Split a cursor into (score, sender, timestamp). Older cursors carry
+    no timestamp ('score:sender') or only the score. Raises ValueError on
+    bad input.
+    """
+    score, separator, rest = value.partition(":")
+    score = parse_unix_time(score)
+    if not separator:
+        return score, None, None
+    if "|" in rest:
+        try:
+            at, sender = parse_row_key(rest)
+            return score, sender, at
+        except ValueError:
+            pass
+    return score, rest, None
+
+
+def keyset_filter(query, before=None, after=None):
+    """
+    Restrict a chat_messages query to the rows strictly between two
+    cursors, in (timestamp, sender) order. Older cursors without a
+    timestamp use their score's, and without a sender compare on the
+    timestamp only.
+    """
+    for cursor, newer in ((before, False), (after, True)):
+        if cursor is None:
+            continue
+        score, sender, at = cursor
+        if at is None:
+            at = datetime.fromtimestamp(score)
+            if sender is None:
+                query = query.filter(
+                    ChatMessage.timestamp > at
+                    if newer
+                    else ChatMessage.timestamp < at
+                )
+                continue
+            # Row timestamps have one-second resolution
+            at = at.replace(microsecond=0)
+        if newer:
+            past = db.or_(
+                ChatMessage.timestamp > at,
+                db.and_(
+                    ChatMessage.timestamp == at, ChatMessage.sender > sender
+                ),
+            )
+        else:
+            past = db.or_(
+                ChatMessage.timestamp < at,
+                db.and_(
+                    ChatMessage.timestamp == at, ChatMessage.sender < sender
+                ),
+            )
+        query = query.filter(past)
+    return query
+
+
+def keyset_order(query, backwards=False):
+    """
+    Order a chat_messages query by (timestamp, sender), the keyset order.
+    """
+    if backwards:
+        return query.order_by(
+            ChatMessage.timestamp.desc(), ChatMessage.sender.desc()
+        )
+    return query.order_by(
+        ChatMessage.timestamp.asc(), ChatMessage.sender.asc()
+    )
+
+
+def trim_mark(score, row):
+    """
+    Pair the raw trimmed-through score and row key of a session, or None.
+    """
+    if score is None:
+        return None
+    return float(score), parse_row_key(row) if row is not None else None
+
+
+def trimmed_through(username, session_id):
+    """
+    Where a session was trimmed out of its Redis hot window (older
+    messages only live in PostgreSQL): (score, row key) of the newest
+    trimmed message, or None. The row key is None for sessions trimmed
+    before it was recorded.
+    """
+    pipe = current_app.redis.pipeline(transaction=False)
+    pipe.hget(f"bot-trimmed-{username}", session_id)
+    pipe.hget(trimmed_rows_key(username), session_id)
+    return trim_mark(*pipe.execute())
+
+
+def trimmed_history(
+    username,
+    session_id,
+    through,
+    kept,
+    before=None,
+    after=None,
+    limit=None,
+    backwards=False,
+):
+    """
+    Read the part of a session trimmed out of Redis from PostgreSQL:
+    rows up to the trimmed-through row key (see trimmed_through()),
+    strictly between the before/after cursors (see parse_cursor) that
+    point into it.
+    Rows of the messages still in Redis ('kept', decoded (message_obj,
+    score) pairs) that sort before the boundary are skipped: client times
+    need not follow the order of the scores.
+    Returns [(message_obj, score), ...] in the direction of the read, all
+    scored at the trimmed-through score, so a cursor taken from them
+    bounds Redis reads below everything still in Redis.
+    """
+    user_id = get_user_id(username)
+    if not user_id:
+        return []
+
+    score, boundary = through
+    in_window = {
+        row_key(msg_obj, kept_score)
+        for msg_obj, kept_score in kept
+        if boundary is None or row_key(msg_obj, kept_score) <= boundary
+    }
+    query = ChatMessage.query.filter_by(
+        user_id=user_id, session_id=session_id
+    )
+    if boundary is None:
+        query = query.filter(
+            ChatMessage.timestamp <= datetime.fromtimestamp(score)
+        )
+    else:
+        at, sender = boundary
+        query = query.filter(
+            db.or_(
+                ChatMessage.timestamp < at,
+                db.and_(
+                    ChatMessage.timestamp == at, ChatMessage.sender <= sender
+                ),
+            )
+        )
+    # Cursors into the Redis part of the session are past all of it
+    if before is not None and before[0] > score:
+        before = None
+    query = keyset_order(keyset_filter(query, before, after), backwards)
+    if limit is not None:
+        query = query.limit(limit + len(in_window))
+    entries = [
+        (message_from_record(record)[0], score)
+        for record in query.all()
+        if (record.timestamp, record.sender) not in in_window
+    ]
+    return entries[:limit] if limit is not None else entries
+
+
+def stitch_trimmed_history(username, session_id, raw_data):
+    """
+    Decode a whole conversation read from Redis, preceded by the history
+    trimmed out of its hot window (if any). Returns the message dicts.
+    """
+    entries = [(decode_message(member), score) for member, score in raw_data]
+    through = trimmed_through(username, session_id)
+    if through is not None:
+        entries = (
+            trimmed_history(username, session_id, through, entries) + entries
+        )
+    return [message_obj for message_obj, _ in entries]
+
+
+def spread_ties(entries):
+    """
+    Give entries persisted in the same second distinct scores, a
+    microsecond apart, keeping their (timestamp, sender) order.
+    """
+    spread = []
+    previous = None
+    for message_obj, score in entries:
+        if previous is not None and score <= previous:
+            score = previous + 0.000001
+        spread.append((message_obj, score))
+        previous = score
+    return spread
+
+
+def repopulate_conversation(username, session_id, entries, window=None):
+    """
+    Rebuild a conversation ZSET from PostgreSQL rows in one pipeline,
+    with chunked ZADDs and the rehydration TTL. The rebuilt messages are
+    already in PostgreSQL, so the session watermark is set as well.
+    Only the newest 'window' (default REDIS_HOT_WINDOW) messages are
+    loaded, if set; the rest is marked as trimmed. Entries must be in
+    keyset order; rows of one second are spread apart so that Redis pages
+    break ties like PostgreSQL ones.
+    """
+    conversation_key = f"bot-{username}-{session_id}"
+    chunk_size = get_setting("REDIS_REHYDRATE_CHUNK_SIZE")
+    if window is None:
+        window = get_setting("REDIS_HOT_WINDOW")
+    trimmed_key = f"bot-trimmed-{username}"
+
+    entries = spread_ties(entries)
+    pipe = get_raw_redis_connection().pipeline()
+    rows_key = trimmed_rows_key(username)
+    if window and len(entries) > window:
+        message_obj, score = entries[-window - 1]
+        pipe.hset(trimmed_key, session_id, repr(score))
+        pipe.hset(
+            rows_key, session_id, format_row_key(row_key(message_obj, score))
+        )
+        entries = entries[-window:]
+    else:
+        pipe.hdel(trimmed_key, session_id)
+        pipe.hdel(rows_key, session_id)
+    for start in range(0, len(entries), chunk_size):
+        pipe.zadd(
+            conversation_key,
+            {
+                encode_message(message_obj): score
+                for message_obj, score in entries[start : start + chunk_size]
+            },
+        )
+    # Postings left from before the key was lost point at old scores;
+    # searches prune them as they come across them
+    for message_obj, score in entries:
+        index_message(pipe, username, session_id, message_obj["text"], score)
+    expire_rehydrated(pipe, conversation_key)
+    pipe.hset(f"bot-synced-{username}", session_id, repr(entries[-1][1]))
+    pipe.execute()
+
+
+def prefetch_user(username):
+    """
+    Warm Redis for a returning user: rebuild the session index from
+    chat_sessions if it was evicted, then load the newest PREFETCH_MESSAGES
+    messages of the PREFETCH_SESSIONS most recently active sessions that
+    are neither in Redis nor in the cold tier (older messages stay behind
+    a trimmed-through mark). Keys that are already warm are left alone.
+    Returns {"sessions_indexed": n, "conversations_loaded": m}.
+    """
+    stats = {"sessions_indexed": 0, "conversations_loaded": 0}
+    user_id = get_user_id(username)
+    if not user_id:
+        return stats
+
+    r = current_app.redis
+    index_key = f"bot-sessions-{username}"
+    if not r.exists(index_key):
+        scores = {
+            row.session_id: row.last_activity.timestamp()
+            for row in ChatSession.query.filter_by(user_id=user_id)
+        }
+        if scores:
+            # No TTL, like get_sessions(): sends check sessions in it
+            r.zadd(index_key, scores)
+        stats["sessions_indexed"] = len(scores)
+
+    recent, _ = page_sessions(r, username, get_setting("PREFETCH_SESSIONS"))
+    pipe = r.pipeline(transaction=False)
+    for session_id in recent:
+        pipe.exists(
+            f"bot-{username}-{session_id}", cold_key(username, session_id)
+        )
+    cold = [sid for sid, warm in zip(recent, pipe.execute()) if not warm]
+
+    limit = get_setting("PREFETCH_MESSAGES")
+    window = min(limit, get_setting("REDIS_HOT_WINDOW") or limit)
+    for session_id in cold:
+        conversation_key = f"bot-{username}-{session_id}"
+        lock = rehydration_lock(conversation_key)
+        if not lock.acquire(blocking=False):
+            continue  # A cache miss is rebuilding it right now
+        try:
+            if r.exists(conversation_key):
+                continue
+            # One row more than we load, to know if older ones exist
+            query = ChatMessage.query.filter_by(
+                user_id=user_id, session_id=session_id
+            )
+            records = (
+                keyset_order(query, backwards=True).limit(limit + 1).all()
+            )
+            if records:
+                entries = [message_from_record(r) for r in reversed(records)]
+                repopulate_conversation(username, session_id, entries, window)
+                stats["conversations_loaded"] += 1
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                pass  # Lock expired while loading
+    return stats
+
+
+def prefetch_in_background(username):
+    """
+    Pool task: prefetch_user() unless another process is already on it,
+    then start the user's cooldown (only after a successful run, so a
+    failed one is retried on the next heartbeat).
+    """
+    r = current_app.redis
+    cooldown = get_setting("PREFETCH_COOLDOWN")
+    running_key = f"bot-prefetching-{username}"
+    try:
+        if not r.set(running_key, 1, nx=True, ex=cooldown):
+            return None
+        try:
+            stats = prefetch_user(username)
+        finally:
+            r.delete(running_key)
+        r.set(f"bot-prefetched-{username}", 1, ex=cooldown)
+    except (SQLAlchemyError, redis.exceptions.RedisError) as e:
+        current_app.logger.warning(f"Prefetch failed for {username}: {e}")
+        return None
+    if stats["sessions_indexed"] or stats["conversations_loaded"]:
+        current_app.logger.info(
+            f"Prefetched {username}: {stats['sessions_indexed']} sessions "
+            f"indexed, {stats['conversations_loaded']} conversations loaded"
+        )
+    return stats
+
+
+def schedule_prefetch(username):
+    """
+    Start prefetch_user() on the prefetch pool, unless it ran for this
+    user in the last PREFETCH_COOLDOWN seconds or the pool is busy.
+    Returns the Future, or None when nothing was started.
+    """
+    if get_redis_connection().exists(f"bot-prefetched-{username}"):
+        return None
+    return submit_prefetch(prefetch_in_background, username)
+
+
+def parse_page_args():
+    """
+    Read the limit/before/after cursor parameters of a message read.
+    Cursors are the next_cursor of a previous page (see format_cursor).
+    Returns (limit, before, after); raises ValueError on bad input.
+    """
+    limit = request.args.get("limit")
+    before = request.args.get("before")
+    after = request.args.get("after")
+
+    max_limit = get_setting("MESSAGES_MAX_PAGE_SIZE")
+    limit = int(limit) if limit else max_limit
+    if limit < 1:
+        raise ValueError(limit)
+    limit = min(limit, max_limit)
+    before = parse_cursor(before) if before else None
+    after = parse_cursor(after) if after else None
+    return limit, before, after
+
+
+def get_messages_page(username, session_id, limit, before, after):
+    """
+    Keyset-paginated read of a session.
+    Pages walk backwards from 'before' (or from the newest message), unless
+    only 'after' is given, in which case they walk forwards from it.
+    Messages are always returned oldest first, with the cursor to pass as
+    'before'/'after' for the next page (None when there is nothing left).
+    """
+    conversation_key = f"bot-{username}-{session_id}"
+    backwards = before is not None or after is None
+    # Redis scores are unique per message, the score alone is the key
+    upper = f"({before[0]!r}" if before is not None else "+inf"
+    lower = f"({after[0]!r}" if after is not None else "-inf"
+
+    raw = get_raw_redis_connection()
+    pipe = raw.pipeline(transaction=False)
+    pipe.exists(conversation_key)
+    if backwards:
+        pipe.zrevrangebyscore(
+            conversation_key, upper, lower, 0, limit + 1, withscores=True
+        )
+    else:
+        pipe.zrangebyscore(
+            conversation_key, lower, upper, 0, limit + 1, withscores=True
+        )
+    exists, raw_data = pipe.execute()
+    cold = None if exists else load_cold_session(raw, username, session_id)
+
+    if exists or cold is not None:
+        if exists:
+            page = [
+                (decode_message(member), score) for member, score in raw_data
+            ]
+        else:
+            # Inflate the cold blob and apply the same bounds in memory
+            if backwards:
+                cold.reverse()
+            page = [
+                (decode_message(member), score)
+                for member, score in cold
+                if (before is None or score < before[0])
+                and (after is None or score > after[0])
+            ][: limit + 1]
+
+        # Continue into the history trimmed out of the hot window
+        through = trimmed_through(username, session_id)
+        if through is not None and (after is None or after[0] <= through[0]):
+            window = get_setting("REDIS_HOT_WINDOW")
+            kept = [
+                (decode_message(member), score)
+                for member, score in raw.zrangebyscore(
+                    conversation_key,
+                    f"({through[0]!r}",
+                    "+inf",
+                    0 if window else None,
+                    window or None,
+                    withscores=True,
+                )
+            ]
+            if backwards and len(page) <= limit:
+                page += trimmed_history(
+                    username,
+                    session_id,
+                    through,
+                    kept,
+                    before=before,
+                    after=after,
+                    limit=limit + 1 - len(page),
+                    backwards=True,
+                )
+            elif not backwards:
+                page = trimmed_history(
+                    username,
+                    session_id,
+                    through,
+                    kept,
+                    after=after,
+                    limit=limit + 1,
+                ) + page
+                page = page[: limit + 1]
+    else:
+        # Keyset query against PostgreSQL
+        user_id = get_user_id(username)
+        if not user_id:
+            return [], None
+
+        # Rows of one second are told apart by sender, like the PK
+        query = ChatMessage.query.filter_by(
+            user_id=user_id, session_id=session_id
+        )
+        query = keyset_order(keyset_filter(query, before, after), backwards)
+        records = query.limit(limit + 1).all()
+        page = [message_from_record(r) for r in records]
+
+    # The extra row only tells us whether another page exists
+    has_more = len(page) > limit
+    page = page[:limit]
+    next_cursor = format_cursor(*page[-1]) if has_more else None
+    if backwards:
+        page.reverse()
+    return [msg for msg, _ in page], next_cursor
+
+
 @chat_message_api_bp.route(
     "/botchat/messages/<username>/<session_id>", methods=["GET"]
 )
@@ -212,44 +1108,350 @@ def get_messages(username, session_id):
     """
     Retrieve messages for (username, session_id) from Redis first.
     If Redis is empty, fallback to PostgreSQL and repopulate Redis.
+    With limit/before/after, return one keyset page plus a next_cursor.
+    With since/until, stream the messages in that time range.
     """
     session_id = session_id.lower()
+    if {"since", "until"} & request.args.keys():
+        return get_messages_in_range(username, session_id)
+    if {"limit", "before", "after"} & request.args.keys():
+        try:
+            limit, before, after = parse_page_args()
+        except ValueError:
+            return jsonify(
+                {
+                    "error": "limit must be a positive integer and before/after numeric cursors."
+                }
+            ), 400
+
+        messages, next_cursor = get_messages_page(
+            username, session_id, limit, before, after
+        )
+        return jsonify(
+            {"messages": messages, "next_cursor": next_cursor}
+        ), 200
+
     conversation_key = f"bot-{username}-{session_id}"
-    raw_data = current_app.redis.zrange(
-        conversation_key, 0, -1, withscores=True
-    )
+    raw = get_raw_redis_connection()
+    raw_data = raw.zrange(conversation_key, 0, -1, withscores=True)
+
+    if not raw_data:
+        # Sessions idle long enough live compressed in the cold tier
+        raw_data = load_cold_session(raw, username, session_id)
 
     if raw_data:
         # Found in Redis
-        messages = [json.loads(msg_json) for msg_json, _ in raw_data]
+        messages = stitch_trimmed_history(username, session_id, raw_data)
     else:
         # Fallback to PostgreSQL
         user_id = get_user_id(username)
         if not user_id:
             return jsonify({"messages": []}), 200
 
-        records = (
-            ChatMessage.query.filter_by(user_id=user_id, session_id=session_id)
-            .order_by(ChatMessage.timestamp.asc())
-            .all()
+        lock = rehydration_lock(conversation_key)
+        rebuild = lock.acquire()
+        try:
+            # Another request may have rebuilt it while we waited
+            if rebuild:
+                raw_data = raw.zrange(conversation_key, 0, -1, withscores=True)
+            if raw_data:
+                messages = stitch_trimmed_history(
+                    username, session_id, raw_data
+                )
+            else:
+                records = keyset_order(
+                    ChatMessage.query.filter_by(
+                        user_id=user_id, session_id=session_id
+                    )
+                ).all()
+                entries = [message_from_record(r) for r in records]
+                messages = [message_obj for message_obj, _ in entries]
+
+                # Re-insert into Redis for future lookups, unless we timed
+                # out waiting for whoever is already doing that
+                if entries and rebuild:
+                    repopulate_conversation(username, session_id, entries)
+        finally:
+            if rebuild:
+                try:
+                    lock.release()
+                except redis.exceptions.LockError:
+                    pass  # Lock expired while rebuilding
+
+    return jsonify({"messages": messages}), 200
+
+
+def parse_range_args():
+    """
+    Read the since/until parameters of a time-range read.
+    Returns (since, until); raises ValueError on bad input.
+    """
+    since = parse_time_arg(request.args.get("since"))
+    until = parse_time_arg(request.args.get("until"))
+    if since is None and until is None:
+        raise ValueError("since or until is required")
+    if since is not None and until is not None and since > until:
+        raise ValueError(since, until)
+    return since, until
+
+
+RANGE_ARGS_ERROR = (
+    "since/until must be finite Unix times or 'YYYY-MM-DD HH:MM:SS', "
+    "with since <= until."
+)
+
+
+def get_messages_in_range(username, session_id):
+    """
+    Messages of one session between since and until (inclusive), streamed
+    in timestamp order. PostgreSQL is only read when Redis may not hold
+    the whole range (session not in Redis, or trimmed into the range).
+    """
+    try:
+        since, until = parse_range_args()
+    except ValueError:
+        return jsonify({"error": RANGE_ARGS_ERROR}), 400
+
+    entries, present = redis_range(username, [session_id], since, until)
+    through = trimmed_through(username, session_id)
+    if through is not None:
+        # On the message clock, like the range (older marks: the score)
+        score, boundary = through
+        through = boundary[0].timestamp() if boundary else score
+    persisted = []
+    if not present or (
+        through is not None and (since is None or since <= through)
+    ):
+        user_id = get_user_id(username)
+        if user_id:
+            persisted = postgres_range(user_id, since, until, session_id)
+
+    messages = merge_tiers(entries, persisted)
+    return Response(
+        stream_with_context(stream_messages(messages)),
+        mimetype="application/json",
+    )
+
+
+@chat_message_api_bp.route("/botchat/messages/<username>", methods=["GET"])
+def get_user_messages_in_range(username):
+    """
+    Messages of every session of a user between since and until
+    (inclusive), each with its session_id, streamed in timestamp order.
+    Redis and PostgreSQL results are merged and de-duplicated.
+    """
+    try:
+        since, until = parse_range_args()
+    except ValueError:
+        return jsonify({"error": RANGE_ARGS_ERROR}), 400
+
+    # Session activity is on the Redis clock, message times need not be:
+    # every session is looked at
+    session_ids = all_session_ids(get_redis_connection(), username)
+    entries, _ = redis_range(username, session_ids, since, until)
+    user_id = get_user_id(username)
+    persisted = postgres_range(user_id, since, until) if user_id else []
+
+    messages = merge_tiers(entries, persisted)
+    return Response(
+        stream_with_context(stream_messages(messages, with_session=True)),
+        mimetype="application/json",
+    )
+
+
+def parse_batch_args(data):
+    """
+    Read the body of a batch read.
+    Returns (username, {session_id: limit or None}); raises ValueError on
+    bad input.
+    """
+    username = (data.get("username") or "").strip()
+    session_ids = data.get("session_ids")
+    limits = data.get("limits") or {}
+    if not username or not isinstance(session_ids, list) or not session_ids:
+        raise ValueError("username and session_ids are required")
+    if len(session_ids) > get_setting("MESSAGES_BATCH_MAX_SESSIONS"):
+        raise ValueError("too many sessions")
+    if not isinstance(limits, dict):
+        raise ValueError(limits)
+
+    limits = {str(sid).strip().lower(): n for sid, n in limits.items()}
+    max_limit = get_setting("MESSAGES_MAX_PAGE_SIZE")
+    wanted = {}
+    for session_id in session_ids:
+        session_id = str(session_id).strip().lower()
+        limit = limits.get(session_id, data.get("limit"))
+        if limit is not None:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError(limit)
+            limit = min(limit, max_limit)
+        wanted[session_id] = limit
+    return username, wanted
+
+
+def postgres_batch(username, wanted):
+    """
+    Read the sessions that missed Redis with one IN query, keeping at most
+    limit + 1 rows per limited session (ROW_NUMBER over each session).
+    Returns {session_id: [(message_obj, score), ...]} oldest first.
+    """
+    entries = {session_id: [] for session_id in wanted}
+    user_id = get_user_id(username)
+    if not user_id:
+        return entries
+
+    row_number = (
+        db.func.row_number()
+        .over(
+            partition_by=ChatMessage.session_id,
+            order_by=(ChatMessage.timestamp.desc(), ChatMessage.sender.desc()),
+        )
+        .label("row_number")
+    )
+    ranked = (
+        db.select(
+            ChatMessage.session_id,
+            ChatMessage.sender,
+            ChatMessage.message,
+            ChatMessage.timestamp,
+            row_number,
         )
-        messages = []
-        for r in records:
-            message_obj = {
-                "sender": r.sender,
-                "text": r.message,
-                "time": r.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        .where(
+            ChatMessage.user_id == user_id,
+            ChatMessage.session_id.in_(list(wanted)),
+        )
+        .subquery()
+    )
+    query = db.select(ranked)
+    if None not in wanted.values():
+        query = query.where(ranked.c.row_number <= max(wanted.values()) + 1)
+    query = query.order_by(
+        ranked.c.session_id, ranked.c.timestamp.asc(), ranked.c.sender.asc()
+    )
+
+    for row in db.session.execute(query):
+        limit = wanted[row.session_id]
+        if limit is None or row.row_number <= limit + 1:
+            entries[row.session_id].append(message_from_record(row))
+    return entries
+
+
+def batch_page(entries, limit):
+    """
+    Shape one session of a batch read: the newest 'limit' of its entries
+    (all when None, oldest first), plus the cursor for GET paging.
+    """
+    if limit is None or len(entries) <= limit:
+        return {
+            "messages": [message_obj for message_obj, _ in entries],
+            "next_cursor": None,
+        }
+    page = entries[-limit:]
+    return {
+        "messages": [message_obj for message_obj, _ in page],
+        "next_cursor": format_cursor(*page[0]),
+    }
+
+
+def cache_batch_read(username, session_id, entries):
+    """
+    Put a full session read from PostgreSQL back into Redis, under the
+    same single-flight lock as get_messages. The rows are already in hand,
+    so a rebuild in progress elsewhere isn't waited for, and a key that
+    came back meanwhile (a rebuild, a send, the cold tier) is left alone.
+    """
+    conversation_key = f"bot-{username}-{session_id}"
+    lock = rehydration_lock(conversation_key)
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        if not current_app.redis.exists(
+            conversation_key, cold_key(username, session_id)
+        ):
+            repopulate_conversation(username, session_id, entries)
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            pass  # Lock expired while rebuilding
+
+
+@chat_message_api_bp.route("/botchat/messages/batch", methods=["POST"])
+def get_messages_batch():
+    """
+    Read several sessions of a user in one request.
+    Body: {"username", "session_ids": [...], "limit": n (optional default),
+    "limits": {session_id: n} (optional)}. A limited session returns its
+    newest n messages and a next_cursor to keep paging with 'before'.
+    Redis answers in one pipeline; sessions it doesn't hold are read from
+    PostgreSQL with one query (and full reads are cached again).
+    Returns {"sessions": {session_id: {"messages", "next_cursor"}}}.
+    """
+    try:
+        username, wanted = parse_batch_args(request.get_json() or {})
+    except (AttributeError, TypeError, ValueError):
+        return jsonify(
+            {
+                "error": "username and a list of at most "
+                f"{get_setting('MESSAGES_BATCH_MAX_SESSIONS')} session_ids "
+                "are required; limits must be positive integers."
             }
-            messages.append(message_obj)
+        ), 400
 
-            # Re-insert into Redis for future lookups
-            # Use the Unix timestamp as the ZSET score (or add small random fraction to break ties)
-            score = r.timestamp.timestamp()
-            current_app.redis.zadd(
-                conversation_key, {json.dumps(message_obj): score}
+    raw = get_raw_redis_connection()
+    pipe = raw.pipeline(transaction=False)
+    for session_id, limit in wanted.items():
+        conversation_key = f"bot-{username}-{session_id}"
+        if limit is None:
+            pipe.zrange(conversation_key, 0, -1, withscores=True)
+        else:
+            pipe.zrevrange(conversation_key, 0, limit, withscores=True)
+        pipe.get(cold_key(username, session_id))
+    pipe.hmget(f"bot-trimmed-{username}", list(wanted))
+    pipe.hmget(trimmed_rows_key(username), list(wanted))
+    replies = pipe.execute()
+    rows = [row and row.decode() for row in replies.pop()]
+    marks = [trim_mark(*mark) for mark in zip(replies.pop(), rows)]
+
+    results = {}
+    misses = {}
+    for i, (session_id, limit) in enumerate(wanted.items()):
+        members, blob = replies[2 * i], replies[2 * i + 1]
+        if limit is not None:
+            members.reverse()
+        if not members and blob is not None:
+            members = inflate_cold_blob(blob)
+            if limit is not None:
+                members = members[-limit - 1 :]
+        if not members:
+            misses[session_id] = limit
+            continue
+
+        entries = [
+            (decode_message(member), score) for member, score in members
+        ]
+        # Continue into the history trimmed out of the hot window
+        if marks[i] is not None and (limit is None or len(entries) <= limit):
+            older = trimmed_history(
+                username,
+                session_id,
+                marks[i],
+                entries,
+                limit=None if limit is None else limit + 1 - len(entries),
+                backwards=True,
             )
+            entries = older[::-1] + entries
+        results[session_id] = batch_page(entries, limit)
 
-    return jsonify({"messages": messages}), 200
+    if misses:
+        for session_id, entries in postgres_batch(username, misses).items():
+            limit = misses[session_id]
+            if limit is None and entries:
+                cache_batch_read(username, session_id, entries)
+            results[session_id] = batch_page(entries, limit)
+
+    return jsonify({"sessions": results}), 200
 
 
 @chat_message_api_bp.route(
@@ -259,28 +1461,50 @@ def delete_session(username, session_id):
     """
     Delete a specific session (and its messages) from Redis.
     If you also want to remove from PostgreSQL, do it here or on sync.
+    A tombstone makes the write-behind consumer drop the session's pending
+    stream entries.
     """
     session_id = session_id.lower()
     session_list_key = f"bot-sessions-{username}"
 
     # Ensure the session belongs to the user
-    if not current_app.redis.sismember(session_list_key, session_id):
+    if session_score(current_app.redis, username, session_id) is None:
         return jsonify(
             {
                 "error": f"Session '{session_id}' not found for user '{username}'."
             }
         ), 404
 
+    # Write-behind entries sent up to now must not bring it back
+    seconds, micros = current_app.redis.time()
+    current_app.redis.set(
+        tombstone_key(username, session_id),
+        repr(seconds + micros / 1000000),
+        ex=get_setting("WRITE_BEHIND_TOMBSTONE_TTL"),
+    )
+
     # Remove from Redis
-    current_app.redis.srem(session_list_key, session_id)
+    current_app.redis.zrem(session_list_key, session_id)
     conversation_key = f"bot-{username}-{session_id}"
-    current_app.redis.delete(conversation_key)
+    current_app.redis.delete(
+        conversation_key,
+        cold_key(username, session_id),
+        meta_key(username, session_id),
+    )
+    current_app.redis.hdel(f"bot-synced-{username}", session_id)
+    current_app.redis.hdel(f"bot-trimmed-{username}", session_id)
+    current_app.redis.hdel(trimmed_rows_key(username), session_id)
+    current_app.redis.srem(f"bot-dirty-{username}", session_id)
+    remove_session_from_index(current_app.redis, username, session_id)
 
     user_id = get_user_id(username)
     if user_id:
         ChatMessage.query.filter_by(
             user_id=user_id, session_id=session_id
         ).delete()
+        ChatSession.query.filter_by(
+            user_id=user_id, session_id=session_id
+        ).delete()
         db.session.commit()
 
     return jsonify(
@@ -288,59 +1512,126 @@ def delete_session(username, session_id):
     ), 200
 
 
+def read_search_hits(raw, username, hits):
+    """
+    Read the messages behind (session_id, score) search hits, from the
+    conversation ZSETs or the cold tier.
+    Returns ([(session_id, score, members)], [stale hits]): a hit is stale
+    when its message is gone from Redis (e.g. an evicted session).
+    """
+    pipe = raw.pipeline(transaction=False)
+    for session_id, score in hits:
+        conversation_key = f"bot-{username}-{session_id}"
+        pipe.zrangebyscore(conversation_key, score, score)
+    found = []
+    stale = []
+    cold_sessions = {}
+    for (session_id, score), members in zip(hits, pipe.execute()):
+        if not members:
+            # The session may be in the cold tier; inflate it once
+            if session_id not in cold_sessions:
+                cold_sessions[session_id] = (
+                    load_cold_session(raw, username, session_id) or []
+                )
+            members = [
+                member
+                for member, member_score in cold_sessions[session_id]
+                if member_score == score
+            ]
+        if members:
+            found.append((session_id, score, members))
+        else:
+            stale.append((session_id, score))
+    return found, stale
+
+
 @chat_message_api_bp.route("/botchat/search/<username>", methods=["GET"])
 def search_messages(username):
     """
-    Fuzzy search across all chat sessions for the specified user in Redis only.
-    If not found in Redis, optionally fallback to PostgreSQL (you decide).
+    Search across all chat sessions for the specified user.
+    Redis (hot, recent data) is searched first: messages must contain every
+    term of the query, and the token index gives the matching (session,
+    score) pairs so only those messages are read. When Redis can't fill the
+    page, PostgreSQL full-text search adds ranked hits from the persisted
+    history, de-duplicated against the Redis ones.
+    Paginated with limit/offset; next_offset is None on the last page.
     """
     query = request.args.get("query", "").strip().lower()
     if not query:
         return jsonify({"error": "No query provided."}), 400
+    try:
+        max_limit = get_setting("SEARCH_MAX_RESULTS")
+        limit = min(int(request.args.get("limit", max_limit)), max_limit)
+        offset = int(request.args.get("offset", 0))
+        if limit < 1 or offset < 0:
+            raise ValueError(limit, offset)
+    except ValueError:
+        return jsonify(
+            {"error": "limit must be positive and offset non-negative."}
+        ), 400
+
+    # One extra hit tells us whether there is a next page
+    wanted = offset + limit + 1
 
     r = get_redis_connection()  # <-- Ensure a valid Redis connection
-    session_list_key = f"bot-sessions-{username}"
-    session_ids = r.smembers(session_list_key)
-    results = []
+    raw = get_raw_redis_connection()
+    hits = search_index(r, username, query, wanted)
+    found, stale = read_search_hits(raw, username, hits)
+    if stale:
+        # Postings outlived their messages: drop them, then rank again
+        drop_postings(r, username, query, stale)
+        hits = search_index(r, username, query, wanted)
+        found, _ = read_search_hits(raw, username, hits)
 
-    for session_id in session_ids:
-        conversation_key = f"bot-{username}-{session_id}"
-        messages_with_score = r.zrange(
-            conversation_key, 0, -1, withscores=True
-        )
-        for msg_json, score in messages_with_score:
-            msg_obj = json.loads(msg_json)
-            if query in msg_obj.get("text", "").lower():
-                msg_time = time.strftime(
-                    "%Y-%m-%d %H:%M:%S", time.localtime(score)
+    results = []
+    seen = set()
+    for session_id, score, members in found:
+        for member in members:
+            msg_obj = decode_message(member)
+            msg_time = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(score)
+            )
+            results.append(
+                {
+                    "session_id": session_id,
+                    "sender": msg_obj.get("sender", "unknown"),
+                    "text": msg_obj.get("text", ""),
+                    "time": msg_time,
+                }
+            )
+            # Same key as the chat_messages primary key
+            seen.add(
+                (
+                    session_id,
+                    msg_obj.get("sender", ""),
+                    parse_message_timestamp(msg_obj, score),
                 )
+            )
+
+    # Fall back to PostgreSQL full-text search for the cold history
+    if len(results) < wanted:
+        user_id = get_user_id(username)
+        if user_id:
+            for rcd in search_postgres(user_id, query, wanted):
+                if (rcd.session_id, rcd.sender, rcd.timestamp) in seen:
+                    continue
                 results.append(
                     {
-                        "session_id": session_id,
-                        "sender": msg_obj.get("sender", "unknown"),
-                        "text": msg_obj.get("text", ""),
-                        "time": msg_time,
+                        "session_id": rcd.session_id,
+                        "sender": rcd.sender,
+                        "text": rcd.message,
+                        "time": rcd.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
                     }
                 )
 
-    # (Optional) Fallback to PostgreSQL if nothing found:
-    # if not results:
-    #     user_id = get_user_id(username)
-    #     if user_id:
-    #         # Simple LIKE query:
-    #         records = ChatMessage.query.filter(
-    #             ChatMessage.user_id == user_id,
-    #             ChatMessage.message.ilike(f"%{query}%")
-    #         ).all()
-    #         for rcd in records:
-    #             results.append({
-    #                 "session_id": rcd.session_id,
-    #                 "sender": rcd.sender,
-    #                 "text": rcd.message,
-    #                 "time": rcd.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-    #             })
-
-    return jsonify({"results": results, "query": query}), 200
+    next_offset = offset + limit if len(results) > offset + limit else None
+    return jsonify(
+        {
+            "results": results[offset : offset + limit],
+            "query": query,
+            "next_offset": next_offset,
+        }
+    ), 200
 
 
 # =================================
@@ -356,40 +1647,52 @@ def sync_session(username, session_id):
     Force a single session to be synced from Redis to PostgreSQL.
     """
     session_id = session_id.lower()
-    sync_redis_session_to_postgres(username, session_id)
+    counts = sync_redis_session_to_postgres(username, session_id)
     return jsonify(
-        {"message": f"Session '{session_id}' synced to Postgres."}
+        {"message": f"Session '{session_id}' synced to Postgres.", **counts}
     ), 200
 
 
 @chat_message_api_bp.route("/botchat/logout/<username>", methods=["POST"])
 def logout_user(username):
     """
-    Example endpoint that syncs all sessions for a user, then (optionally) clears them from Redis.
+    Example endpoint that syncs the user's changed sessions, then (optionally) clears them from Redis.
     """
-    # 1) Sync each session individually
-    r = get_redis_connection()  # <-- Use the helper to ensure valid Redis conn
-    session_list_key = f"bot-sessions-{username}"
-    session_ids = r.smembers(session_list_key)  # fetch sessions from Redis
-
-    for session_id in session_ids:
-        sync_redis_session_to_postgres(username, session_id)
+    # 1) Sync the sessions that changed since their last sync, in parallel
+    totals = sync_dirty_sessions(username)
 
     # 2) (Optional) Clear them from Redis if you want to remove them after syncing
+    # r = get_redis_connection()
+    # session_list_key = f"bot-sessions-{username}"
+    # session_ids = r.smembers(session_list_key)
     # for session_id in session_ids:
     #     conversation_key = f"bot-{username}-{session_id}"
     #     r.delete(conversation_key)
     # r.delete(session_list_key)
 
+    if totals["failed"]:
+        return jsonify(
+            {
+                "error": f"{totals['failed']} sessions of '{username}' "
+                "failed to sync.",
+                **totals,
+            }
+        ), 500
     return jsonify(
-        {"message": f"All sessions for user '{username}' synced to Postgres."}
+        {
+            "message": f"All sessions for user '{username}' synced to Postgres.",
+            **totals,
+        }
     ), 200
 
 
 @chat_message_api_bp.route("/botchat/update_session_expiry", methods=["POST"])
 def update_session_expiry():
     """
-    Update active-user record in DB with last_seen or session_expiry.
+    Record a client heartbeat (last_seen) for the active-user tracking.
+    It is one ZADD to bot-heartbeats; a background flusher writes the
+    changes to active_users in bulk. Also schedules the Redis prefetch of
+    the user's recent sessions (see prefetch_user).
     """
     data = request.get_json()
     username = data.get("username")
@@ -398,19 +1701,59 @@ def update_session_expiry():
     if not username or exp is None:
         return jsonify({"error": "username and exp are required."}), 400
 
-    last_seen_dt = datetime.now(timezone.utc)
-
-    user = User.query.filter_by(username=username).first()
-    if not user:
+    # Cached lookup, so no database round trip for known users
+    if not get_user_id(username):
         return jsonify({"error": f"User '{username}' not found."}), 404
 
-    # Update or create the ActiveUser entry
-    active_record = ActiveUser.query.filter_by(user_id=user.id).first()
-    if not active_record:
-        active_record = ActiveUser(user_id=user.id)
-        db.session.add(active_record)
-
-    active_record.last_seen = last_seen_dt
-    db.session.commit()
+    last_seen = record_heartbeat(get_redis_connection(), username)
+    last_seen_dt = datetime.fromtimestamp(last_seen, timezone.utc)
+    # A returning user's keys may have been evicted: warm them up before
+    # the first real read
+    if get_setting("PREFETCH_ON_HEARTBEAT"):
+        schedule_prefetch(username)
 
     return jsonify({"status": "updated", "last_seen": str(last_seen_dt)}), 200
+
+
+@chat_message_api_bp.route("/botchat/prefetch/<username>", methods=["POST"])
+def prefetch_sessions(username):
+    """
+    Warm Redis with the user's session list and recent conversations in
+    the background (e.g. right after login).
+    """
+    if not get_user_id(username):
+        return jsonify({"error": f"User '{username}' not found."}), 404
+    if schedule_prefetch(username) is None:
+        return jsonify({"status": "recently prefetched or busy"}), 200
+    return jsonify({"status": "scheduled"}), 202
+
+
+@chat_message_api_bp.route("/botchat/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Runtime state for monitoring (Redis pool and circuit breaker,
+    username -> user_id cache, last cold-tier run, inactivity scheduler,
+    per-session sync durations, leader lease of this process).
+    inactivity.lag is how long the most overdue user has been waiting,
+    right now; alert when it keeps growing.
+    """
+    return jsonify(
+        {
+            "redis": redis_status(),
+            "user_id_cache": user_id_cache.snapshot(),
+            "cold_tier": last_tiering_run or None,
+            "inactivity": {
+                "lag": scheduler_lag(
+                    get_redis_connection(),
+                    get_setting("INACTIVE_AFTER_SECONDS"),
+                ),
+                "last_sweep": last_inactivity_sweep or None,
+            },
+            "sync": sync_timings.snapshot(),
+            "leader": (
+                current_app.leader_lease.snapshot()
+                if hasattr(current_app, "leader_lease")
+                else None
+            ),
+        }
+    ), 200
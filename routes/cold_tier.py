@@ -0,0 +1,145 @@
+import time
+
+import brotli
+import msgpack
+import redis
+from flask import current_app
+
+from routes.settings import get_setting
+
+
+# =================================
+#   Brotli Cold-Session Tier
+# =================================
+#
+# A session whose newest message is older than COLD_TIER_IDLE_SECONDS, and
+# which has nothing left to sync, is collapsed from its conversation ZSET
+# into one bot-cold-{username}-{session_id} string:
+#   brotli(msgpack([[member, score], ...]))
+# Reads inflate it on demand; the next message promotes it back to a ZSET.
+
+# Stats of the most recent tiering run, for /botchat/metrics
+last_tiering_run = {}
+
+
+def cold_key(username, session_id):
+    return f"bot-cold-{username}-{session_id}"
+
+
+def load_cold_session(raw, username, session_id):
+    """
+    Inflate a cold session into [(member, score), ...] (oldest first),
+    or None if the session isn't in the cold tier.
+    """
+    blob = raw.get(cold_key(username, session_id))
+    if blob is None:
+        return None
+    return inflate_cold_blob(blob)
+
+
+def inflate_cold_blob(blob):
+    """
+    Decode a cold-tier blob into [(member, score), ...] (oldest first).
+    """
+    return [
+        (member, score)
+        for member, score in msgpack.unpackb(brotli.decompress(blob))
+    ]
+
+
+def promote_session(raw, username, session_id):
+    """
+    Move a cold session back into its live ZSET (merging with anything
+    already written there). Returns the number of members restored.
+    """
+    conversation_key = f"bot-{username}-{session_id}"
+    key = cold_key(username, session_id)
+    while True:
+        with raw.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                blob = pipe.get(key)
+                if blob is None:
+                    return 0
+                entries = msgpack.unpackb(brotli.decompress(blob))
+                pipe.multi()
+                if entries:
+                    pipe.zadd(
+                        conversation_key,
+                        {member: score for member, score in entries},
+                    )
+                pipe.delete(key)
+                pipe.execute()
+                return len(entries)
+            except redis.exceptions.WatchError:
+                continue
+
+
+def compress_session(raw, username, session_id, idle_before):
+    """
+    Collapse one session into the cold tier if its newest message is older
+    than idle_before and it isn't waiting to be synced.
+    Returns (bytes before, bytes after), or None if it was left alone.
+    """
+    conversation_key = f"bot-{username}-{session_id}"
+    dirty_key = f"bot-dirty-{username}"
+    with raw.pipeline() as pipe:
+        try:
+            # A concurrent send touches both keys and aborts the swap
+            pipe.watch(conversation_key, dirty_key)
+            newest = pipe.zrange(conversation_key, -1, -1, withscores=True)
+            if not newest or newest[0][1] >= idle_before:
+                return None
+            if pipe.sismember(dirty_key, session_id):
+                return None
+
+            bytes_before = pipe.memory_usage(conversation_key) or 0
+            entries = pipe.zrange(conversation_key, 0, -1, withscores=True)
+            blob = brotli.compress(
+                msgpack.packb([[member, score] for member, score in entries]),
+                quality=get_setting("COLD_TIER_BROTLI_QUALITY"),
+            )
+            pipe.multi()
+            pipe.set(cold_key(username, session_id), blob)
+            pipe.delete(conversation_key)
+            pipe.execute()
+        except redis.exceptions.WatchError:
+            return None
+
+    bytes_after = raw.memory_usage(cold_key(username, session_id)) or 0
+    return bytes_before, bytes_after
+
+
+def run_tiering(r, raw, idle_seconds, keep_going=None):
+    """
+    One tiering pass over every user's sessions.
+    keep_going (e.g. the leader lease check) is asked before each user;
+    the pass stops once it returns False.
+    Returns (and records for monitoring) the sessions compressed and the
+    Redis bytes saved.
+    """
+    started = time.time()
+    idle_before = started - idle_seconds
+    stats = {"sessions": 0, "bytes_before": 0, "bytes_after": 0}
+    # Legacy SET indexes are converted at startup or on first touch
+    for session_list_key in r.scan_iter("bot-sessions-*", _type="zset"):
+        if keep_going is not None and not keep_going():
+            break
+        username = session_list_key[len("bot-sessions-") :]
+        for session_id in r.zrange(session_list_key, 0, -1):
+            sizes = compress_session(raw, username, session_id, idle_before)
+            if sizes:
+                stats["sessions"] += 1
+                stats["bytes_before"] += sizes[0]
+                stats["bytes_after"] += sizes[1]
+
+    stats["bytes_saved"] = stats["bytes_before"] - stats["bytes_after"]
+    stats["finished_at"] = time.time()
+    stats["duration"] = stats["finished_at"] - started
+    last_tiering_run.clear()
+    last_tiering_run.update(stats)
+    current_app.logger.info(
+        f"Cold tier: compressed {stats['sessions']} sessions, "
+        f"saved {stats['bytes_saved']} bytes"
+    )
+    return stats
@@ -0,0 +1,273 @@
+import time
+from datetime import datetime, timezone
+
+from flask import current_app
+
+from models import db
+from models.active_user import ActiveUser
+from models.user import User
+from routes import get_user_id
+from routes.session_index import all_session_ids
+from routes.sync_executor import sync_dirty_users
+
+
+# =================================
+#     Coalesced User Heartbeats
+# =================================
+#
+# bot-heartbeats          ZSET username -> last_seen (Unix time), one ZADD
+#                         per heartbeat
+# bot-heartbeats-flushed  STRING, last_seen scores up to this one are
+#                         already in active_users
+# A periodic flusher copies what changed into active_users in bulk. The
+# ZSET doubles as the inactivity schedule: a user's deadline is last_seen
+# + INACTIVE_AFTER_SECONDS, so due users are one ZRANGEBYSCORE away.
+# last_seen, the flush mark and the sweep cutoff all come from the Redis
+# clock (TIME), so replicas with skewed clocks neither skip heartbeats
+# nor sweep users early.
+
+HEARTBEATS_KEY = "bot-heartbeats"
+FLUSHED_KEY = "bot-heartbeats-flushed"
+# Set once every pre-existing session was marked dirty
+DIRTY_BACKFILL_KEY = "bot-dirty-backfilled"
+
+# Stats of the most recent inactivity sweep, for /botchat/metrics
+last_inactivity_sweep = {}
+
+# Score a heartbeat with the Redis clock
+# KEYS: heartbeats zset
+# ARGV: username
+# Returns the score.
+RECORD_HEARTBEAT_SCRIPT = """
+-- Replicate the write, not the script: TIME is not deterministic
+redis.replicate_commands()
+local now = redis.call('TIME')
+local seen = now[1] .. '.' .. string.format('%06d', tonumber(now[2]))
+redis.call('ZADD', KEYS[1], seen, ARGV[1])
+return seen
+"""
+
+# The heartbeats not flushed yet, up to now on the Redis clock; atomic, so
+# a heartbeat is either in this flush or scored after its mark
+# KEYS: heartbeats zset, flushed mark
+# Returns {upto, username, score, username, score, ...}.
+UNFLUSHED_HEARTBEATS_SCRIPT = """
+local now = redis.call('TIME')
+local upto = now[1] .. '.' .. string.format('%06d', tonumber(now[2]))
+local flushed = redis.call('GET', KEYS[2]) or '0'
+local changed = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '(' .. flushed, upto, 'WITHSCORES')
+table.insert(changed, 1, upto)
+return changed
+"""
+
+# Forget users' heartbeats only if they are still the idle ones we saw
+# KEYS: heartbeats zset
+# ARGV: cutoff, usernames...
+# Returns the usernames removed.
+FORGET_IF_IDLE_SCRIPT = """
+local dropped = {}
+for i = 2, #ARGV do
+    local seen = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if seen and tonumber(seen) < tonumber(ARGV[1]) then
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        dropped[#dropped + 1] = ARGV[i]
+    end
+end
+return dropped
+"""
+
+
+def redis_time(r):
+    """
+    Unix time on the Redis clock, the one heartbeats are scored with.
+    """
+    seconds, microseconds = r.time()
+    return seconds + microseconds / 1000000
+
+
+def record_heartbeat(r, username):
+    """
+    Note that a user is active now. Returns the last_seen recorded.
+    """
+    record = r.register_script(RECORD_HEARTBEAT_SCRIPT)
+    return float(record(keys=[HEARTBEATS_KEY], args=[username]))
+
+
+def flush_heartbeats(r):
+    """
+    Write the heartbeats received since the last flush into active_users:
+    one executemany UPDATE for users that have a row, one bulk INSERT for
+    the others. Returns the number of users written.
+    """
+    unflushed = r.register_script(UNFLUSHED_HEARTBEATS_SCRIPT)
+    upto, *changed = unflushed(keys=[HEARTBEATS_KEY, FLUSHED_KEY])
+    last_seen = {}
+    for username, score in zip(changed[::2], changed[1::2]):
+        user_id = get_user_id(username)
+        if user_id:
+            last_seen[user_id] = datetime.fromtimestamp(
+                float(score), timezone.utc
+            )
+
+    if last_seen:
+        table = ActiveUser.__table__
+        existing = {
+            row.user_id
+            for row in db.session.query(ActiveUser.user_id).filter(
+                ActiveUser.user_id.in_(list(last_seen))
+            )
+        }
+        if existing:
+            db.session.execute(
+                table.update()
+                .where(table.c.user_id == db.bindparam("b_user_id"))
+                .values(last_seen=db.bindparam("b_last_seen")),
+                [
+                    {"b_user_id": user_id, "b_last_seen": last_seen[user_id]}
+                    for user_id in existing
+                ],
+            )
+        missing = [
+            {"user_id": user_id, "last_seen": seen}
+            for user_id, seen in last_seen.items()
+            if user_id not in existing
+        ]
+        if missing:
+            db.session.execute(table.insert(), missing)
+        db.session.commit()
+
+    r.set(FLUSHED_KEY, upto)
+    return len(last_seen)
+
+
+def seed_heartbeats(r):
+    """
+    Load the last_seen of active_users into the ZSET (without overwriting
+    newer heartbeats), so users active before the switch still get their
+    inactivity sync. Returns the number of users loaded.
+    """
+    rows = (
+        db.session.query(User.username, ActiveUser.last_seen)
+        .join(User, User.id == ActiveUser.user_id)
+        .all()
+    )
+    scores = {}
+    for username, seen in rows:
+        if seen.tzinfo is None:
+            seen = seen.replace(tzinfo=timezone.utc)
+        scores[username] = max(seen.timestamp(), scores.get(username, 0))
+    if scores:
+        r.zadd(HEARTBEATS_KEY, scores, nx=True)
+    return len(scores)
+
+
+def due_users(r, cutoff, limit):
+    """
+    Up to 'limit' users whose deadline has passed (last heartbeat older
+    than cutoff), most overdue first, as (username, last_seen) pairs.
+    """
+    return r.zrangebyscore(
+        HEARTBEATS_KEY, "-inf", f"({cutoff!r}", 0, limit, withscores=True
+    )
+
+
+def forget_users(r, usernames, cutoff):
+    """
+    Drop the heartbeats and active_users rows of idle users, with one
+    DELETE for the batch. A heartbeat that arrived meanwhile keeps its
+    user active. Returns the usernames dropped.
+    """
+    forget = r.register_script(FORGET_IF_IDLE_SCRIPT)
+    dropped = forget(keys=[HEARTBEATS_KEY], args=[repr(cutoff), *usernames])
+    user_ids = [get_user_id(username) for username in dropped]
+    user_ids = [user_id for user_id in user_ids if user_id]
+    if user_ids:
+        ActiveUser.query.filter(ActiveUser.user_id.in_(user_ids)).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+    return dropped
+
+
+def scheduler_lag(r, idle_seconds):
+    """
+    Seconds the most overdue deadline has been waiting (0 if none is due).
+    """
+    oldest = r.zrange(HEARTBEATS_KEY, 0, 0, withscores=True)
+    if not oldest:
+        return 0.0
+    return max(0.0, redis_time(r) - (oldest[0][1] + idle_seconds))
+
+
+def run_inactivity_sweep(r, idle_seconds, batch_size, keep_going=None):
+    """
+    Process every user past their inactivity deadline, in batches of
+    batch_size: sync their changed sessions (on the sync pool), then
+    forget the users whose sessions all synced. Users with a failed sync
+    keep their deadline, so the next sweep retries them.
+    keep_going (e.g. the leader lease check) is asked before each batch;
+    the sweep stops once it returns False.
+    Returns (and records for monitoring) the users processed, the users
+    that failed and the lag found when the sweep started.
+    """
+    started = time.time()
+    cutoff = redis_time(r) - idle_seconds
+    stats = {
+        "users": 0,
+        "failed": 0,
+        "batches": 0,
+        "lag": scheduler_lag(r, idle_seconds),
+    }
+    failed = set()
+    while keep_going is None or keep_going():
+        # Users that failed in this sweep are still due: step over them
+        due = due_users(r, cutoff, batch_size + len(failed))
+        batch = [user for user, _ in due if user not in failed][:batch_size]
+        if not batch:
+            break
+        # Only sessions that changed since their last sync, all users of
+        # the batch in parallel
+        totals = sync_dirty_users(batch)
+        synced = [user for user in batch if not totals[user]["failed"]]
+        failed.update(user for user in batch if totals[user]["failed"])
+        if synced:
+            stats["users"] += len(forget_users(r, synced, cutoff))
+        stats["batches"] += 1
+    stats["failed"] = len(failed)
+
+    stats["finished_at"] = time.time()
+    stats["duration"] = stats["finished_at"] - started
+    last_inactivity_sweep.clear()
+    last_inactivity_sweep.update(stats)
+    if stats["users"] or stats["failed"]:
+        current_app.logger.info(
+            f"Inactivity sweep: {stats['users']} users in "
+            f"{stats['batches']} batches, {stats['failed']} failed, "
+            f"lag {stats['lag']:.1f}s"
+        )
+    return stats
+
+
+def mark_all_sessions_dirty(r):
+    """
+    One-off migration for sessions written before dirty tracking, whose
+    unsynced messages no sweep or logout would otherwise persist: add every
+    session to its user's bot-dirty-{username} set and schedule every user
+    for an immediate sweep (real heartbeats are kept). A session with
+    nothing new costs one empty read on its next sync.
+    Returns the number of sessions marked.
+    """
+    marked = 0
+    for key in r.scan_iter("bot-sessions-*"):
+        username = key[len("bot-sessions-") :]
+        session_ids = all_session_ids(r, username)
+        if not session_ids:
+            continue
+        pipe = r.pipeline(transaction=False)
+        pipe.sadd(f"bot-dirty-{username}", *session_ids)
+        pipe.zadd(HEARTBEATS_KEY, {username: 0}, nx=True)
+        pipe.execute()
+        marked += len(session_ids)
+    r.set(DIRTY_BACKFILL_KEY, 1)
+    return marked
@@ -0,0 +1,104 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+import redis
+
+
+# =================================
+#   Leader Election (Redis lease)
+# =================================
+#
+# Singleton background jobs (inactivity sweep, heartbeat flush, cold
+# tiering) only run in the process holding the lease key. The holder
+# renews it every ttl/3; if it dies, the key expires and another process
+# takes over within one ttl.
+
+# Take the lease if it is free, or extend it if we already hold it
+# KEYS: lease key
+# ARGV: owner, ttl in milliseconds
+ACQUIRE_OR_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# Give the lease up, only if we still hold it
+# KEYS: lease key
+# ARGV: owner
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderLease:
+    """
+    A Redis lease (SET NX PX) held by at most one process at a time.
+    is_leader is only trusted until the last successful renewal's TTL runs
+    out locally, so a stalled holder stops acting before anyone else can
+    take over.
+    """
+
+    def __init__(self, r, key, ttl_ms):
+        self.r = r
+        self.key = key
+        self.ttl_ms = ttl_ms
+        self.owner = (
+            f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        )
+        self._lock = threading.Lock()
+        self._valid_until = 0.0
+        self.acquisitions = 0
+
+    @property
+    def is_leader(self):
+        with self._lock:
+            return time.monotonic() < self._valid_until
+
+    def renew(self):
+        """
+        Acquire or extend the lease. Returns True while we hold it.
+        """
+        started = time.monotonic()
+        try:
+            acquire = self.r.register_script(ACQUIRE_OR_RENEW_SCRIPT)
+            held = acquire(keys=[self.key], args=[self.owner, self.ttl_ms])
+        except redis.exceptions.RedisError:
+            held = False
+        with self._lock:
+            if held and time.monotonic() >= self._valid_until:
+                self.acquisitions += 1
+            self._valid_until = (
+                started + self.ttl_ms / 1000 if held else 0.0
+            )
+        return bool(held)
+
+    def release(self):
+        """
+        Give the lease up (e.g. on shutdown) so a standby takes over now.
+        """
+        with self._lock:
+            self._valid_until = 0.0
+        try:
+            release = self.r.register_script(RELEASE_SCRIPT)
+            release(keys=[self.key], args=[self.owner])
+        except redis.exceptions.RedisError:
+            pass  # It expires on its own
+
+    def snapshot(self):
+        return {
+            "key": self.key,
+            "owner": self.owner,
+            "is_leader": self.is_leader,
+            "acquisitions": self.acquisitions,
+        }
@@ -0,0 +1,117 @@
+import json
+
+import msgpack
+import redis
+from flask import current_app
+
+from routes.redis_client import get_redis_connection
+from routes.settings import get_setting
+
+
+# =================================
+#      Chat Message Encoding
+# =================================
+#
+# Members of the bot-{username}-{session_id} ZSETs are versioned by their
+# first byte:
+#   b"\x01" + msgpack([sender, text, time])   current encoding
+#   b"{" ...                                   legacy json.dumps(message)
+# They are binary, so conversation ZSETs are read and written through the
+# raw (decode_responses=False) client.
+
+MSGPACK_V1 = b"\x01"
+
+
+def encode_message(msg_obj):
+    """
+    Encode a {"sender", "text", "time"} message as a ZSET member.
+    """
+    if get_setting("MESSAGE_ENCODING") == "json":
+        return json.dumps(msg_obj)
+    return MSGPACK_V1 + msgpack.packb(
+        [msg_obj.get("sender"), msg_obj.get("text"), msg_obj.get("time")]
+    )
+
+
+def decode_message(member):
+    """
+    Decode a ZSET member back into a message dict, whatever its encoding.
+    """
+    if isinstance(member, bytes) and member[:1] == MSGPACK_V1:
+        sender, text, msg_time = msgpack.unpackb(member[1:])
+        return {"sender": sender, "text": text, "time": msg_time}
+    return json.loads(member)
+
+
+def get_raw_redis_connection():
+    """
+    Returns the bytes-in/bytes-out Redis client used for conversation
+    ZSETs. Apps built by create_app have one sharing the main client's
+    circuit breaker; other apps (tests) get one derived from app.redis.
+    """
+    client = get_redis_connection()
+    raw = getattr(current_app, "redis_raw", None)
+    if raw is None:
+        pool = client.connection_pool
+        kwargs = dict(pool.connection_kwargs, decode_responses=False)
+        raw = redis.Redis(
+            connection_pool=redis.ConnectionPool(
+                connection_class=pool.connection_class, **kwargs
+            )
+        )
+        current_app.redis_raw = raw
+    return raw
+
+
+def migrate_session_encoding(raw, conversation_key):
+    """
+    Re-encode the legacy JSON members of one conversation ZSET, keeping
+    their scores. Retries if the key changes underneath (WATCH).
+    Returns the number of members re-encoded.
+    """
+    while True:
+        with raw.pipeline() as pipe:
+            try:
+                pipe.watch(conversation_key)
+                legacy = [
+                    (member, score)
+                    for member, score in pipe.zrange(
+                        conversation_key, 0, -1, withscores=True
+                    )
+                    if member[:1] != MSGPACK_V1
+                ]
+                if not legacy:
+                    return 0
+                pipe.multi()
+                pipe.zrem(conversation_key, *[m for m, _ in legacy])
+                pipe.zadd(
+                    conversation_key,
+                    {
+                        encode_message(decode_message(member)): score
+                        for member, score in legacy
+                    },
+                )
+                pipe.execute()
+                return len(legacy)
+            except redis.exceptions.WatchError:
+                continue
+
+
+def migrate_message_encoding(r, raw):
+    """
+    Background migrator: re-encode every user's conversation ZSETs.
+    Returns (sessions visited, members re-encoded).
+    """
+    sessions = 0
+    migrated = 0
+    for session_list_key in r.scan_iter("bot-sessions-*", _type="zset"):
+        username = session_list_key[len("bot-sessions-") :]
+        for session_id in r.zrange(session_list_key, 0, -1):
+            migrated += migrate_session_encoding(
+                raw, f"bot-{username}-{session_id}"
+            )
+            sessions += 1
+    current_app.logger.info(
+        f"Message encoding migration: {migrated} members in {sessions} sessions"
+    )
+    return sessions, migrated
@@ -0,0 +1,176 @@
+import threading
+import time
+
+import redis
+from flask import current_app
+
+
+# =================================
+#     Pooled Redis + Breaker
+# =================================
+
+
+class CircuitBreaker:
+    """
+    Passive Redis health tracking.
+    'closed' while commands succeed; 'open' after failure_threshold
+    consecutive connection/timeout errors, during which callers fail fast;
+    'half_open' once reset_timeout has passed, letting commands through
+    again as probes.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        return self.state != "open"
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            # A failed probe re-opens the breaker straight away
+            if (
+                self._failures >= self.failure_threshold
+                or self._state() == "half_open"
+            ):
+                if self._state() != "open":
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self._state(),
+                "consecutive_failures": self._failures,
+                "trips": self.trips,
+            }
+
+
+# Errors that say something about Redis health (not e.g. WRONGTYPE)
+HEALTH_ERRORS = (
+    redis.exceptions.ConnectionError,
+    redis.exceptions.TimeoutError,
+)
+
+
+class BreakerPipeline(redis.client.Pipeline):
+    breaker = None
+
+    def execute(self, raise_on_error=True):
+        try:
+            result = super().execute(raise_on_error)
+        except HEALTH_ERRORS:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+
+class BreakerRedis(redis.Redis):
+    """
+    Redis client that reports every command's outcome to a CircuitBreaker.
+    """
+
+    breaker = None
+
+    def execute_command(self, *args, **options):
+        try:
+            result = super().execute_command(*args, **options)
+        except HEALTH_ERRORS:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = BreakerPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint,
+        )
+        pipe.breaker = self.breaker
+        return pipe
+
+
+def create_redis_client(config, decode_responses=None, breaker=None):
+    """
+    Build the shared, ConnectionPool-backed Redis client for an app.
+    Pass decode_responses=False (and the main client's breaker) for the
+    raw client used with binary values.
+    """
+    if decode_responses is None:
+        decode_responses = config["REDIS_DECODE_RESPONSES"]
+    pool = redis.ConnectionPool(
+        host=config["REDIS_HOST"],
+        port=config["REDIS_PORT"],
+        db=config["REDIS_DB"],
+        decode_responses=decode_responses,
+        max_connections=config["REDIS_MAX_CONNECTIONS"],
+        # The following help avoid stale connections in Redis:
+        socket_keepalive=True,
+        retry_on_timeout=True,
+        health_check_interval=30,
+        socket_connect_timeout=2,
+        socket_timeout=config["REDIS_SOCKET_TIMEOUT"],
+    )
+    client = BreakerRedis(connection_pool=pool)
+    client.breaker = breaker or CircuitBreaker(
+        config["REDIS_BREAKER_FAILURES"], config["REDIS_BREAKER_RESET"]
+    )
+    return client
+
+
+def get_redis_connection():
+    """
+    Returns the app's shared Redis client without a round trip.
+    Raises ConnectionError right away while the circuit breaker is open,
+    so callers can go straight to their PostgreSQL fallback.
+    """
+    client = current_app.redis
+    breaker = getattr(client, "breaker", None)
+    if breaker is not None and not breaker.allow():
+        raise redis.exceptions.ConnectionError(
+            "Redis circuit breaker is open."
+        )
+    return client
+
+
+def redis_status():
+    """
+    Pool and breaker state of the app's Redis client, for monitoring.
+    """
+    client = current_app.redis
+    pool = client.connection_pool
+    breaker = getattr(client, "breaker", None)
+    return {
+        "breaker": breaker.snapshot() if breaker else None,
+        "pool": {
+            "max_connections": pool.max_connections,
+            "created": pool._created_connections,
+            "in_use": len(pool._in_use_connections),
+            "available": len(pool._available_connections),
+        },
+    }
@@ -0,0 +1,226 @@
+import re
+
+from flask import current_app
+
+from models import db
+from models.chat_message import SEARCH_CONFIG, ChatMessage
+from routes.cold_tier import load_cold_session
+from routes.message_codec import decode_message, get_raw_redis_connection
+from routes.session_index import all_session_ids
+from routes.settings import get_setting
+
+
+# =================================
+#      Redis Search Index
+# =================================
+#
+# bot-idx-{username}-{term}          ZSET of postings scored by message
+#                                    score, so Redis ranks hits newest
+#                                    first: "{session_id}\x00{score}"
+# bot-idx-terms-{username}-{session} SET of the terms indexed for a session,
+#                                    used to drop its postings on delete
+# bot-idx-dict-{username}            ZSET of every term indexed for the
+#                                    user, all scored 0: ZRANGEBYLEX finds
+#                                    the terms a partial last word of a
+#                                    query can complete to
+#
+# Postings whose message left Redis without them (an expired or evicted
+# conversation, or one rebuilt with new scores) are pruned by the searches
+# that come across them.
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """
+    Normalize text into the set of terms stored in the index.
+    """
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+
+def term_key(username, term):
+    return f"bot-idx-{username}-{term}"
+
+
+def session_terms_key(username, session_id):
+    return f"bot-idx-terms-{username}-{session_id}"
+
+
+def term_dictionary_key(username):
+    return f"bot-idx-dict-{username}"
+
+
+def posting_member(session_id, score):
+    return f"{session_id}\x00{score!r}"
+
+
+def glob_escape(value):
+    return "".join(f"\\{c}" if c in "*?[]\\" else c for c in value)
+
+
+def parse_posting(member):
+    """
+    Split a posting member back into (session_id, score).
+    """
+    session_id, _, score = member.rpartition("\x00")
+    return session_id, float(score)
+
+
+def index_message(pipe, username, session_id, text, score):
+    """
+    Queue the index updates for one message on a pipeline.
+    """
+    terms = tokenize(text)
+    if not terms:
+        return
+    member = posting_member(session_id, score)
+    for term in terms:
+        pipe.zadd(term_key(username, term), {member: score})
+    pipe.sadd(session_terms_key(username, session_id), *terms)
+    pipe.zadd(term_dictionary_key(username), dict.fromkeys(terms, 0))
+
+
+def remove_session_from_index(r, username, session_id):
+    """
+    Drop every posting that points into a session.
+    """
+    terms_key = session_terms_key(username, session_id)
+    terms = r.smembers(terms_key)
+    pattern = f"{glob_escape(session_id)}\x00*"
+    pipe = r.pipeline()
+    for term in terms:
+        key = term_key(username, term)
+        members = [m for m, _ in r.zscan_iter(key, match=pattern)]
+        if members:
+            pipe.zrem(key, *members)
+    pipe.delete(terms_key)
+    pipe.execute()
+
+
+def query_terms(r, username, query):
+    """
+    Split a query into the terms a message must contain and the terms
+    its last word stands for: the word itself (postings indexed before
+    the dictionary existed have no entry in it), plus up to
+    SEARCH_PREFIX_EXPANSIONS indexed terms it completes to.
+    Returns (terms, completions).
+    """
+    words = TOKEN_PATTERN.findall(query.lower())
+    if not words:
+        return set(), []
+    prefix = words[-1]
+    completions = [prefix] + [
+        term
+        for term in r.zrangebylex(
+            term_dictionary_key(username),
+            f"[{prefix}",
+            f"({prefix}\U0010ffff",
+            0,
+            get_setting("SEARCH_PREFIX_EXPANSIONS"),
+        )
+        if term != prefix
+    ]
+    return set(words[:-1]) - {prefix}, completions
+
+
+def search_index(r, username, query, max_results):
+    """
+    Return up to max_results (session_id, score) pairs for the messages
+    that contain every term of the query, the last one possibly as a
+    prefix, newest first. Redis ranks the intersection, only the top hits
+    are transferred.
+    """
+    terms, completions = query_terms(r, username, query)
+    if not completions:
+        return []
+    keys = [term_key(username, term) for term in sorted(terms)]
+    if not keys and len(completions) == 1:
+        members = r.zrevrange(
+            term_key(username, completions[0]), 0, max_results - 1
+        )
+    else:
+        # MULTI, so the scratch keys never outlive the query
+        prefix_key = f"bot-idx-prefix-{username}"
+        result_key = f"bot-idx-query-{username}"
+        pipe = r.pipeline()
+        pipe.zunionstore(
+            prefix_key,
+            [term_key(username, term) for term in completions],
+            aggregate="MAX",
+        )
+        pipe.zinterstore(result_key, keys + [prefix_key], aggregate="MAX")
+        pipe.zrevrange(result_key, 0, max_results - 1)
+        pipe.delete(prefix_key, result_key)
+        members = pipe.execute()[2]
+    return [parse_posting(member) for member in members]
+
+
+def drop_postings(r, username, query, hits):
+    """
+    Remove the postings of (session_id, score) hits whose message is gone
+    from the posting lists of the query terms (and completions).
+    """
+    members = [posting_member(session_id, score) for session_id, score in hits]
+    terms, completions = query_terms(r, username, query)
+    pipe = r.pipeline(transaction=False)
+    for term in terms.union(completions):
+        pipe.zrem(term_key(username, term), *members)
+    pipe.execute()
+
+
+def rebuild_search_index(r, username):
+    """
+    Re-index every session of a user from the conversation ZSETs.
+    Returns the number of messages indexed.
+    """
+    raw = get_raw_redis_connection()
+    indexed = 0
+    # Terms of messages gone meanwhile leave the dictionary too
+    r.delete(term_dictionary_key(username))
+    for session_id in all_session_ids(r, username):
+        remove_session_from_index(r, username, session_id)
+        raw_data = raw.zrange(
+            f"bot-{username}-{session_id}", 0, -1, withscores=True
+        ) or (load_cold_session(raw, username, session_id) or [])
+        pipe = r.pipeline()
+        for msg_json, score in raw_data:
+            text = decode_message(msg_json).get("text", "")
+            index_message(pipe, username, session_id, text, score)
+        pipe.execute()
+        indexed += len(raw_data)
+    current_app.logger.info(
+        f"Rebuilt search index for {username}: {indexed} messages"
+    )
+    return indexed
+
+
+# =================================
+#   PostgreSQL Full-Text Search
+# =================================
+
+
+def search_postgres(user_id, query, limit):
+    """
+    Search the user's persisted history, best matches first.
+    On PostgreSQL this is a ts_rank-ordered match served by the GIN index
+    on to_tsvector(message), the last word matching as a prefix (like the
+    Redis index); other databases (tests) fall back to ILIKE.
+    Returns ChatMessage rows.
+    """
+    base = ChatMessage.query.filter(ChatMessage.user_id == user_id)
+    words = TOKEN_PATTERN.findall(query.lower())
+    if words and db.session.get_bind().dialect.name == "postgresql":
+        document = db.func.to_tsvector(SEARCH_CONFIG, ChatMessage.message)
+        # Words are \w+ tokens, safe to put into tsquery syntax
+        ts_query = db.func.to_tsquery(
+            SEARCH_CONFIG, " & ".join(words[:-1] + [f"{words[-1]}:*"])
+        )
+        base = base.filter(document.op("@@")(ts_query)).order_by(
+            db.func.ts_rank(document, ts_query).desc(),
+            ChatMessage.timestamp.desc(),
+        )
+    else:
+        base = base.filter(ChatMessage.message.ilike(f"%{query}%")).order_by(
+            ChatMessage.timestamp.desc()
+        )
+    return base.limit(limit).all()
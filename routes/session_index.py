@@ -0,0 +1,178 @@
+import redis
+
+from routes.message_codec import get_raw_redis_connection
+from routes.session_meta import meta_key
+from routes.unix_time import parse_unix_time
+
+
+# =================================
+#   Recency-Ordered Session Index
+# =================================
+#
+# bot-sessions-{username} is a ZSET of session ids scored by last activity
+# (creation time, bumped by every message). It used to be a plain SET;
+# legacy SETs are converted on first touch.
+
+
+def session_list_key(username):
+    return f"bot-sessions-{username}"
+
+
+def legacy_session_scores(r, username, session_ids):
+    """
+    Score sessions of a legacy SET index by their last message (metadata,
+    else the conversation ZSET). Returns {session_id: score}.
+    """
+    pipe = r.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hget(meta_key(username, session_id), "last_ts")
+    last_seen = pipe.execute()
+
+    raw_pipe = get_raw_redis_connection().pipeline(transaction=False)
+    for session_id in session_ids:
+        raw_pipe.zrange(
+            f"bot-{username}-{session_id}", -1, -1, withscores=True
+        )
+    newest = raw_pipe.execute()
+
+    scores = {}
+    for i, session_id in enumerate(session_ids):
+        if last_seen[i]:
+            scores[session_id] = float(last_seen[i])
+        elif newest[i]:
+            scores[session_id] = newest[i][0][1]
+        else:
+            # Empty sessions: keep scores distinct so cursors can't skip
+            scores[session_id] = i / 1000000
+    return scores
+
+
+def migrate_session_index(r, username):
+    """
+    Convert a legacy SET session index into the recency ZSET, scoring each
+    session by its last message. The SET is watched, so a session added
+    meanwhile (or another replica converting it first) restarts the check.
+    Returns True if a conversion happened here.
+    """
+    key = session_list_key(username)
+    while True:
+        with r.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.type(key) != "set":
+                    return False
+                session_ids = sorted(pipe.smembers(key))
+                scores = legacy_session_scores(r, username, session_ids)
+                pipe.multi()
+                pipe.delete(key)
+                if scores:
+                    pipe.zadd(key, scores)
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                continue
+
+
+def with_index_migration(r, username, call):
+    """
+    Run call(), converting a legacy SET index and retrying once if it hits
+    one (WRONGTYPE).
+    """
+    try:
+        return call()
+    except redis.exceptions.ResponseError as e:
+        if "WRONGTYPE" not in str(e) or not migrate_session_index(
+            r, username
+        ):
+            raise
+        return call()
+
+
+def session_score(r, username, session_id):
+    """
+    The session's last-activity score, or None if it doesn't exist (O(1)).
+    """
+    key = session_list_key(username)
+    return with_index_migration(r, username, lambda: r.zscore(key, session_id))
+
+
+def all_session_ids(r, username, newest_first=False):
+    """
+    Every session id of a user, by last activity.
+    """
+    key = session_list_key(username)
+    if newest_first:
+        return with_index_migration(
+            r, username, lambda: r.zrevrange(key, 0, -1)
+        )
+    return with_index_migration(r, username, lambda: r.zrange(key, 0, -1))
+
+
+def format_session_cursor(score, session_id):
+    """
+    The cursor after a session: its score, plus its id to break ties
+    between sessions last active at the same time.
+    """
+    return f"{score!r}:{session_id}"
+
+
+def parse_session_cursor(value):
+    """
+    Split a session cursor into (score, session_id). A bare score (older
+    clients) has no id. Raises ValueError on bad input.
+    """
+    score, separator, session_id = value.partition(":")
+    return parse_unix_time(score), session_id if separator else None
+
+
+def page_sessions(r, username, limit, cursor=None):
+    """
+    One page of session ids, most recently active first (ties by id,
+    descending, the ZSET's own order), strictly after the cursor (see
+    parse_session_cursor).
+    Returns (session_ids, next_cursor or None).
+    """
+    key = session_list_key(username)
+    if cursor is None:
+        score, after_id = None, None
+        upper = "+inf"
+    else:
+        score, after_id = cursor
+        upper = f"({score!r}"
+
+    def read():
+        pipe = r.pipeline(transaction=False)
+        if after_id is not None:
+            # The rest of the cursor's tie, then everything older
+            pipe.zrevrangebyscore(key, repr(score), repr(score))
+        pipe.zrevrangebyscore(
+            key, upper, "-inf", 0, limit + 1, withscores=True
+        )
+        return pipe.execute()
+
+    replies = with_index_migration(r, username, read)
+    rows = replies.pop()
+    if replies:
+        rows = [
+            (session_id, score)
+            for session_id in replies[0]
+            if session_id < after_id
+        ] + rows
+    page = rows[:limit]
+    next_cursor = (
+        format_session_cursor(page[-1][1], page[-1][0])
+        if len(rows) > limit
+        else None
+    )
+    return [session_id for session_id, _ in page], next_cursor
+
+
+def migrate_all_session_indexes(r):
+    """
+    Convert every legacy SET session index. Returns how many changed.
+    """
+    migrated = 0
+    for key in r.scan_iter("bot-sessions-*", _type="set"):
+        if migrate_session_index(r, key[len("bot-sessions-") :]):
+            migrated += 1
+    return migrated
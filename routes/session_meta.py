@@ -0,0 +1,145 @@
+import time
+
+from models import db
+from models.chat_message import ChatMessage
+from models.chat_session import ChatSession
+from models.user import User
+from routes.cold_tier import load_cold_session
+from routes.message_codec import decode_message
+from routes.settings import get_setting
+
+
+# =================================
+#     Per-Session Metadata
+# =================================
+#
+# bot-meta-{username}-{session_id} HASH
+#   count        number of messages
+#   first_ts     score of the first message
+#   last_ts      score of the latest message
+#   last_sender  sender of the latest message
+#   last_preview first SESSION_PREVIEW_LENGTH characters of it
+# send_message keeps it current (SEND_MESSAGE_SCRIPT). A session without
+# any message has just {count: 0}.
+
+
+def meta_key(username, session_id):
+    return f"bot-meta-{username}-{session_id}"
+
+
+def preview(text):
+    return text[: get_setting("SESSION_PREVIEW_LENGTH")]
+
+
+def meta_from_entries(entries):
+    """
+    Build a metadata mapping from [(message_obj, score), ...], oldest first.
+    """
+    last_obj, last_score = entries[-1]
+    return {
+        "count": len(entries),
+        "first_ts": repr(entries[0][1]),
+        "last_ts": repr(last_score),
+        "last_sender": last_obj.get("sender", ""),
+        "last_preview": preview(last_obj.get("text", "")),
+    }
+
+
+def persisted_session(username, session_id):
+    """
+    The session's chat_sessions row and newest chat_messages row, or
+    (None, None) if it has never been persisted.
+    """
+    session = (
+        db.session.query(ChatSession)
+        .join(User, User.id == ChatSession.user_id)
+        .filter(User.username == username)
+        .filter(ChatSession.session_id == session_id)
+        .first()
+    )
+    if session is None or not session.message_count:
+        return None, None
+    latest = (
+        ChatMessage.query.filter_by(
+            user_id=session.user_id, session_id=session_id
+        )
+        .order_by(ChatMessage.timestamp.desc(), ChatMessage.sender.desc())
+        .first()
+    )
+    return session, latest
+
+
+def backfill_session_meta(r, raw, username, session_id):
+    """
+    Build the metadata of a session written before it was tracked, from
+    its conversation ZSET (or cold blob). When part of the session only
+    lives in PostgreSQL (trimmed, or the conversation was evicted), the
+    count comes from chat_sessions plus the unsynced messages in Redis.
+    A session with no messages anywhere is cached as {"count": 0}.
+    Returns the stored mapping.
+    """
+    members = raw.zrange(
+        f"bot-{username}-{session_id}", 0, -1, withscores=True
+    ) or (load_cold_session(raw, username, session_id) or [])
+    entries = [(decode_message(member), score) for member, score in members]
+    trimmed = r.hget(f"bot-trimmed-{username}", session_id)
+
+    meta = meta_from_entries(entries) if entries else {"count": 0}
+    if trimmed is not None or not entries:
+        session, latest = persisted_session(username, session_id)
+        if session is not None:
+            mark = r.hget(f"bot-synced-{username}", session_id)
+            unsynced = [
+                entry
+                for entry in entries
+                if mark is None or entry[1] > float(mark)
+            ]
+            meta["count"] = session.message_count + len(unsynced)
+            meta["first_ts"] = repr(session.created_at.timestamp())
+            if not entries and latest is not None:
+                meta.update(
+                    last_ts=repr(latest.timestamp.timestamp()),
+                    last_sender=latest.sender,
+                    last_preview=preview(latest.message),
+                )
+    r.hset(meta_key(username, session_id), mapping=meta)
+    return meta
+
+
+def format_meta(session_id, meta):
+    """
+    Shape a metadata hash for the API.
+    """
+
+    def fmt(ts):
+        if not ts:
+            return None
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(ts)))
+
+    last_ts = meta.get("last_ts")
+    return {
+        "session_id": session_id,
+        "message_count": int(meta.get("count", 0)),
+        "first_time": fmt(meta.get("first_ts")),
+        "last_time": fmt(last_ts),
+        "last_activity": float(last_ts) if last_ts else None,
+        "last_sender": meta.get("last_sender"),
+        "last_message": meta.get("last_preview"),
+    }
+
+
+def fetch_session_meta(r, raw, username, session_ids):
+    """
+    Metadata for many sessions in one pipelined round trip (sessions that
+    predate metadata tracking are backfilled, and cached, on the way).
+    Returns {session_id: formatted metadata}.
+    """
+    pipe = r.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hgetall(meta_key(username, session_id))
+    details = {}
+    for session_id, meta in zip(session_ids, pipe.execute()):
+        if not meta:
+            meta = backfill_session_meta(r, raw, username, session_id)
+        details[session_id] = format_meta(session_id, meta)
+    return details
@@ -0,0 +1,11 @@
+from flask import current_app
+
+from config import Config
+
+
+def get_setting(name):
+    """
+    Read a tunable from the app config, falling back to the default in
+    Config (test apps don't load the Config object).
+    """
+    return current_app.config.get(name, getattr(Config, name))
@@ -0,0 +1,257 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+
+from models import db
+from routes import get_setting, sync_redis_session_to_postgres
+
+
+# =================================
+#      Parallel Session Syncs
+# =================================
+#
+# Logout and the inactivity sweep sync many sessions at once. Each sync is
+# a Redis read followed by PostgreSQL writes, so they run on a bounded pool
+# of SYNC_WORKERS threads. Every task gets its own app context, hence its
+# own SQLAlchemy session (and pooled DB connection); Redis clients are
+# shared and thread-safe. SYNC_WORKERS + PREFETCH_WORKERS (the separate,
+# best-effort pool warming Redis for returning users) therefore cap the
+# PostgreSQL connections used by background work: keep them below the
+# engine's pool size. A failed session sync is logged and counted per
+# user; it doesn't stop the others.
+
+
+class SyncTimings:
+    """
+    Thread-safe counters of per-session sync durations.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sessions = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.slowest = None
+
+    def record(self, username, session_id, seconds, failed=False):
+        with self._lock:
+            self.sessions += 1
+            self.errors += int(failed)
+            self.total_seconds += seconds
+            if seconds >= self.max_seconds:
+                self.max_seconds = seconds
+                self.slowest = {
+                    "username": username,
+                    "session_id": session_id,
+                    "seconds": seconds,
+                }
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "sessions": self.sessions,
+                "errors": self.errors,
+                "avg_seconds": (
+                    self.total_seconds / self.sessions
+                    if self.sessions
+                    else None
+                ),
+                "max_seconds": self.max_seconds,
+                "slowest": self.slowest,
+            }
+
+
+sync_timings = SyncTimings()
+
+_executor = None
+_executor_lock = threading.Lock()
+_prefetch_executor = None
+_prefetch_slots = None
+
+
+def get_sync_executor(workers):
+    """
+    The shared sync pool, created on first use with 'workers' threads.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="session-sync"
+            )
+        return _executor
+
+
+def timed_sync(username, session_id):
+    """
+    Sync one session, recording how long it took.
+    Returns (counts, seconds).
+    """
+    started = time.perf_counter()
+    try:
+        counts = sync_redis_session_to_postgres(username, session_id)
+    except Exception:
+        sync_timings.record(
+            username, session_id, time.perf_counter() - started, failed=True
+        )
+        raise
+    seconds = time.perf_counter() - started
+    sync_timings.record(username, session_id, seconds)
+    return counts, seconds
+
+
+def in_app_context(app, func, *args):
+    """
+    Pool task: run func(*args) in a fresh app context, then hand the
+    worker's DB connection back to the pool.
+    """
+    with app.app_context():
+        try:
+            return func(*args)
+        finally:
+            db.session.remove()
+
+
+def submit_background(func, *args):
+    """
+    Run func(*args) on the shared pool, in its own app context.
+    Returns the Future.
+    """
+    app = current_app._get_current_object()
+    executor = get_sync_executor(get_setting("SYNC_WORKERS"))
+    return executor.submit(in_app_context, app, func, *args)
+
+
+def submit_prefetch(func, *args):
+    """
+    Run func(*args) on the prefetch pool, in its own app context, unless
+    all of its PREFETCH_WORKERS threads are busy: prefetches are only
+    worth doing right away, so they never queue up.
+    Returns the Future, or None when the task was dropped.
+    """
+    global _prefetch_executor, _prefetch_slots
+    with _executor_lock:
+        if _prefetch_executor is None:
+            workers = get_setting("PREFETCH_WORKERS")
+            _prefetch_executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="prefetch"
+            )
+            _prefetch_slots = threading.BoundedSemaphore(workers)
+    if not _prefetch_slots.acquire(blocking=False):
+        return None
+    app = current_app._get_current_object()
+    try:
+        future = _prefetch_executor.submit(in_app_context, app, func, *args)
+    except Exception:
+        _prefetch_slots.release()
+        raise
+    future.add_done_callback(lambda _: _prefetch_slots.release())
+    return future
+
+
+def empty_totals():
+    return {
+        "sessions": 0,
+        "inserted": 0,
+        "skipped": 0,
+        "failed": 0,
+        "max_session_seconds": 0.0,
+    }
+
+
+def shares_one_connection():
+    """
+    Whether every thread would use the same DB connection (SQLite in
+    tests), so syncs can't run in parallel.
+    """
+    return isinstance(db.engine.pool, (StaticPool, SingletonThreadPool))
+
+
+def sync_inline(username, session_id):
+    """
+    timed_sync() on the caller's own session, rolled back if it fails.
+    """
+    try:
+        return timed_sync(username, session_id)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def sync_sessions(pairs):
+    """
+    Sync the (username, session_id) pairs, up to SYNC_WORKERS at a time,
+    and wait for all of them. A session that fails to sync is logged and
+    counted in its user's "failed" total; the others still go through.
+    Returns {username: {"sessions", "inserted", "skipped", "failed",
+    "max_session_seconds"}}.
+    """
+    totals = {username: empty_totals() for username, _ in pairs}
+
+    workers = get_setting("SYNC_WORKERS")
+    outcomes = []
+    if workers <= 1 or len(pairs) <= 1 or shares_one_connection():
+        for username, session_id in pairs:
+            try:
+                outcomes.append((sync_inline(username, session_id), None))
+            except Exception as e:
+                outcomes.append((None, e))
+    else:
+        futures = [
+            submit_background(timed_sync, username, session_id)
+            for username, session_id in pairs
+        ]
+        for future in futures:
+            error = future.exception()
+            outcomes.append((None if error else future.result(), error))
+
+    for (username, session_id), (result, error) in zip(pairs, outcomes):
+        user_totals = totals[username]
+        if error is not None:
+            user_totals["failed"] += 1
+            current_app.logger.warning(
+                f"Sync of session {username}/{session_id} failed: {error!r}"
+            )
+            continue
+        counts, seconds = result
+        user_totals["sessions"] += 1
+        user_totals["inserted"] += counts["inserted"]
+        user_totals["skipped"] += counts["skipped"]
+        user_totals["max_session_seconds"] = max(
+            user_totals["max_session_seconds"], seconds
+        )
+    return totals
+
+
+def sync_dirty_users(usernames):
+    """
+    Sync, in parallel, the sessions of these users that received messages
+    since their last sync (the bot-dirty-{username} sets filled by
+    send_message). Returns the per-user totals of sync_sessions().
+    """
+    pipe = current_app.redis.pipeline(transaction=False)
+    for username in usernames:
+        pipe.smembers(f"bot-dirty-{username}")
+    pairs = [
+        (username, session_id)
+        for username, dirty in zip(usernames, pipe.execute())
+        for session_id in sorted(dirty)
+    ]
+    totals = sync_sessions(pairs)
+    return {
+        username: totals.get(username) or empty_totals()
+        for username in usernames
+    }
+
+
+def sync_dirty_sessions(username):
+    """
+    Sync only the sessions of one user that changed since their last sync.
+    Returns {"sessions": n, "inserted": n, "skipped": m, "failed": f,
+    "max_session_seconds": s}.
+    """
+    return sync_dirty_users([username])[username]
@@ -0,0 +1,138 @@
+import heapq
+import json
+from datetime import datetime
+
+from models.chat_message import ChatMessage
+from routes import parse_message_timestamp
+from routes.cold_tier import load_cold_session
+from routes.message_codec import decode_message, get_raw_redis_connection
+from routes.unix_time import parse_unix_time
+
+
+# =================================
+#      Time-Range Message Reads
+# =================================
+#
+# Messages between two instants, from Redis (conversation ZSETs or cold
+# blobs) merged with PostgreSQL (ix_chat_messages_user_timestamp),
+# de-duplicated on the chat_messages primary key and streamed back as one
+# JSON document in timestamp order.
+#
+# Both tiers are filtered and ordered on one clock, the message 'time'
+# that rows are persisted with (see parse_message_timestamp). Scores come
+# from the Redis clock and need not agree with it, so Redis ranges are
+# cut from whole conversations (the hot window), not by score.
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_time_arg(value):
+    """
+    Parse a since/until parameter: Unix time, or "YYYY-MM-DD HH:MM:SS"
+    (local time, like message times). Returns a float or None.
+    Raises ValueError on bad input, including non-finite or out-of-range
+    Unix times.
+    """
+    if not value:
+        return None
+    try:
+        float(value)
+    except ValueError:
+        return datetime.strptime(value, TIME_FORMAT).timestamp()
+    return parse_unix_time(value)
+
+
+def redis_range(username, session_ids, since, until):
+    """
+    Messages of the given sessions held in Redis with a time in
+    [since, until], as (time, session_id, message_obj) sorted by time.
+    Also returns the sessions that had a ZSET or cold blob at all.
+    """
+    raw = get_raw_redis_connection()
+    pipe = raw.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.zrange(f"bot-{username}-{session_id}", 0, -1, withscores=True)
+    replies = pipe.execute()
+
+    entries = []
+    present = set()
+    for session_id, members in zip(session_ids, replies):
+        if not members:
+            members = load_cold_session(raw, username, session_id)
+            if members is None:
+                continue
+        present.add(session_id)
+        for member, score in members:
+            msg_obj = decode_message(member)
+            at = parse_message_timestamp(msg_obj, score).timestamp()
+            if (since is None or at >= since) and (
+                until is None or at <= until
+            ):
+                entries.append((at, session_id, msg_obj))
+    entries.sort(key=lambda entry: entry[0])
+    return entries, present
+
+
+def postgres_range(user_id, since, until, session_id=None):
+    """
+    Persisted messages of a user (or one session) with a timestamp in
+    [since, until], as (score, session_id, message_obj) in timestamp
+    order. Rows are fetched lazily, in batches.
+    """
+    query = ChatMessage.query.filter_by(user_id=user_id)
+    if session_id is not None:
+        query = query.filter_by(session_id=session_id)
+    if since is not None:
+        query = query.filter(
+            ChatMessage.timestamp >= datetime.fromtimestamp(since)
+        )
+    if until is not None:
+        query = query.filter(
+            ChatMessage.timestamp <= datetime.fromtimestamp(until)
+        )
+    query = query.order_by(ChatMessage.timestamp.asc()).yield_per(500)
+    for record in query:
+        yield (
+            record.timestamp.timestamp(),
+            record.session_id,
+            {
+                "sender": record.sender,
+                "text": record.message,
+                "time": record.timestamp.strftime(TIME_FORMAT),
+            },
+        )
+
+
+def merge_tiers(redis_entries, postgres_entries):
+    """
+    Merge both tiers in timestamp order, dropping PostgreSQL rows of
+    messages that Redis returned as well.
+    """
+    in_redis = {
+        (session_id, msg_obj.get("sender", ""), datetime.fromtimestamp(at))
+        for at, session_id, msg_obj in redis_entries
+    }
+    persisted = (
+        entry
+        for entry in postgres_entries
+        if (
+            entry[1],
+            entry[2]["sender"],
+            datetime.fromtimestamp(entry[0]),
+        )
+        not in in_redis
+    )
+    return heapq.merge(redis_entries, persisted, key=lambda entry: entry[0])
+
+
+def stream_messages(entries, with_session=False):
+    """
+    Yield {"messages": [...]} as JSON, one message at a time.
+    """
+    yield '{"messages": ['
+    for i, (_, session_id, msg_obj) in enumerate(entries):
+        item = dict(msg_obj)
+        if with_session:
+            item = {"session_id": session_id, **item}
+        yield ("," if i else "") + json.dumps(item)
+    yield "]}"
@@ -0,0 +1,26 @@
+import math
+from datetime import datetime
+
+
+# =================================
+#      Unix Times From Clients
+# =================================
+#
+# since/until parameters and page cursors carry Unix times. They end up in
+# datetime.fromtimestamp() and Redis score bounds, so only finite times a
+# datetime can hold are accepted.
+
+
+def parse_unix_time(value):
+    """
+    float(value), if it is a finite Unix time within datetime's range.
+    Raises ValueError otherwise.
+    """
+    at = float(value)
+    if not math.isfinite(at):
+        raise ValueError(value)
+    try:
+        datetime.fromtimestamp(at)
+    except (OverflowError, OSError) as e:
+        raise ValueError(value) from e
+    return at
@@ -3,6 +3,7 @@ from werkzeug.security import generate_password_hash
 
 from models import db
 from models.user import User
+from routes import invalidate_user_id
 
 
 user_api_bp = Blueprint("user", __name__)
@@ -30,6 +31,7 @@ def create_user():
     )
     db.session.add(new_user)
     db.session.commit()
+    invalidate_user_id(username)
     return jsonify({"message": "User created successfully!"}), 201
 
 
@@ -60,4 +62,5 @@ def delete_user(username):
         return jsonify({"error": "User not found."}), 404
     db.session.delete(user)
     db.session.commit()
+    invalidate_user_id(username)
     return jsonify({"message": "User deleted successfully!"})
@@ -1,14 +1,40 @@
 from flask import Flask
 import os
+import threading
 import unittest
+from unittest import mock
 from datetime import datetime, timezone
 import redis
+from sqlalchemy.exc import SQLAlchemyError
 
 from models import db
 from models.user import User
+from models.chat_message import ChatMessage
+from models.chat_session import ChatSession
+from models.active_user import ActiveUser
 from config import Config
 
-from routes.chat_message import chat_message_api_bp
+from routes import (
+    backfill_chat_sessions,
+    create_missing_indexes,
+    get_user_id,
+    sync_redis_session_to_postgres,
+    user_id_cache,
+)
+from routes.chat_message import (
+    chat_message_api_bp,
+    prefetch_user,
+    schedule_prefetch,
+)
+from routes.cold_tier import run_tiering
+from routes.heartbeats import (
+    flush_heartbeats,
+    mark_all_sessions_dirty,
+    run_inactivity_sweep,
+)
+from routes.message_codec import get_raw_redis_connection
+from routes.redis_client import CircuitBreaker
+from routes.session_index import legacy_session_scores
 
 
 # Create a robust Redis client
@@ -35,6 +61,8 @@ class TestChatMessageSystem(unittest.TestCase):
         )
         self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
         self.app.config["TESTING"] = True
+        # Heartbeats don't start background prefetches (tested explicitly)
+        self.app.config["PREFETCH_ON_HEARTBEAT"] = False
 
         # Initialize the database
         db.init_app(self.app)
@@ -197,6 +225,1587 @@ class TestChatMessageSystem(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(len(response.json["messages"]), 0)
 
+    def test_sync_session(self):
+        # Create a user
+        with self.app.app_context():
+            user = User(username="alice", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            # Create a session with two messages
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "alice", "session_name": "sync-session"},
+            )
+            for text in ("Hello", "World"):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "alice",
+                        "session_id": "sync-session",
+                        "message": text,
+                        "sender": "alice",
+                        "time": datetime.now(timezone.utc).isoformat(),
+                    },
+                )
+
+            # First sync inserts everything
+            response = self.client.post("/botchat/sync/alice/sync-session")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json["inserted"], 2)
+            self.assertEqual(response.json["skipped"], 0)
+
+            # Second sync only sees the messages past the watermark
+            response = self.client.post("/botchat/sync/alice/sync-session")
+            self.assertEqual(response.json["inserted"], 0)
+            self.assertEqual(response.json["skipped"], 0)
+
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "alice",
+                    "session_id": "sync-session",
+                    "message": "Again",
+                    "sender": "alice",
+                    "time": datetime.now(timezone.utc).isoformat(),
+                },
+            )
+            response = self.client.post("/botchat/sync/alice/sync-session")
+            self.assertEqual(response.json["inserted"], 1)
+            self.assertEqual(response.json["skipped"], 0)
+
+            self.client.delete("/botchat/delete/alice/sync-session")
+
+    def test_session_counts_grow_incrementally(self):
+        with self.app.app_context():
+            user = User(username="quinn", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "quinn", "session_name": "counted"},
+            )
+            # History persisted earlier (e.g. trimmed out of Redis)
+            row = db.session.get(ChatSession, (user.id, "counted"))
+            row.message_count = 10
+            row.last_activity = datetime(2030, 1, 1)
+            db.session.commit()
+
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "quinn",
+                    "session_id": "counted",
+                    "message": "late arrival",
+                    "time": "2024-01-01 00:00:00",
+                },
+            )
+            response = self.client.post("/botchat/sync/quinn/counted")
+            self.assertEqual(response.json["inserted"], 1)
+
+            db.session.expire_all()
+            row = db.session.get(ChatSession, (user.id, "counted"))
+            self.assertEqual(row.message_count, 11)
+            # last_activity never moves backwards
+            self.assertEqual(row.last_activity, datetime(2030, 1, 1))
+
+            self.client.delete("/botchat/delete/quinn/counted")
+
+    def test_message_behind_the_watermark_is_synced(self):
+        self.app.config["REDIS_HOT_WINDOW"] = 1
+        with self.app.app_context():
+            user = User(username="leo", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "leo", "session_name": "order"},
+            )
+
+            def send(text, sent_at):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "leo",
+                        "session_id": "order",
+                        "message": text,
+                        "time": sent_at,
+                    },
+                )
+
+            send("first", "2024-01-01 00:00:01")
+            self.client.post("/botchat/sync/leo/order")
+
+            # A sync elsewhere (a replica with a fast clock, or a send that
+            # finished first) moved the watermark past this replica's now
+            mark = float(self.app.redis.hget("bot-synced-leo", "order"))
+            self.app.redis.hset("bot-synced-leo", "order", repr(mark + 100))
+            send("second", "2024-01-01 00:00:02")
+
+            # The late message is scored above the watermark, stays dirty
+            # and reaches PostgreSQL before the hot window trims it
+            newest = get_raw_redis_connection().zrange(
+                "bot-leo-order", -1, -1, withscores=True
+            )
+            self.assertGreater(newest[0][1], mark + 100)
+            self.assertTrue(self.app.redis.sismember("bot-dirty-leo", "order"))
+            response = self.client.post("/botchat/logout/leo")
+            self.assertEqual(response.json["inserted"], 1)
+            self.assertEqual(
+                ChatMessage.query.filter_by(user_id=user.id).count(), 2
+            )
+
+            send("third", "2024-01-01 00:00:03")
+            self.client.post("/botchat/sync/leo/order")
+            self.assertEqual(self.app.redis.zcard("bot-leo-order"), 1)
+            response = self.client.get("/botchat/messages/leo/order")
+            self.assertEqual(
+                [m["text"] for m in response.json["messages"]],
+                ["first", "second", "third"],
+            )
+
+            self.client.delete("/botchat/delete/leo/order")
+
+    def test_rehydrated_conversation(self):
+        self.app.config["REDIS_REHYDRATE_WAIT"] = 0.1
+        with self.app.app_context():
+            user = User(username="nina", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "nina", "session_name": "rehyd"},
+            )
+            for i in range(3):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "nina",
+                        "session_id": "rehyd",
+                        "message": f"old{i}",
+                        "time": f"2024-01-01 00:00:0{i}",
+                    },
+                )
+            self.client.post("/botchat/sync/nina/rehyd")
+            self.app.redis.delete("bot-nina-rehyd")
+
+            def texts(url="/botchat/messages/nina/rehyd"):
+                response = self.client.get(url)
+                return [m["text"] for m in response.json["messages"]]
+
+            # Someone else is rebuilding: read PostgreSQL, don't rebuild
+            lock = self.app.redis.lock("bot-lock-bot-nina-rehyd", timeout=5)
+            lock.acquire()
+            self.assertEqual(texts(), ["old0", "old1", "old2"])
+            self.assertFalse(self.app.redis.exists("bot-nina-rehyd"))
+            lock.release()
+
+            # The rebuilt key carries the rehydration TTL
+            self.assertEqual(texts(), ["old0", "old1", "old2"])
+            self.assertGreater(self.app.redis.ttl("bot-nina-rehyd"), 0)
+
+            # Once it expired, a new message must not hide the history
+            self.app.redis.delete("bot-nina-rehyd")
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "nina",
+                    "session_id": "rehyd",
+                    "message": "new",
+                    "time": "2024-01-01 00:00:09",
+                },
+            )
+            self.assertEqual(texts(), ["old0", "old1", "old2", "new"])
+            url = "/botchat/messages/nina/rehyd?limit=2"
+            self.assertEqual(texts(url), ["old2", "new"])
+            response = self.client.get(
+                "/botchat/messages/nina?since=2024-01-01%2000:00:01"
+            )
+            self.assertEqual(
+                [m["text"] for m in response.json["messages"]],
+                ["old1", "old2", "new"],
+            )
+
+            self.client.delete("/botchat/delete/nina/rehyd")
+
+    def test_logout_syncs_only_dirty_sessions(self):
+        # Create a user
+        with self.app.app_context():
+            user = User(username="alice", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            # Drain anything left dirty by other tests
+            self.client.post("/botchat/logout/alice")
+
+            # Two sessions with one message each
+            for session_name in ("dirty-a", "dirty-b"):
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": "alice", "session_name": session_name},
+                )
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "alice",
+                        "session_id": session_name,
+                        "message": "Hello",
+                        "sender": "alice",
+                    },
+                )
+
+            # Syncing one of them clears its dirty mark
+            self.client.post("/botchat/sync/alice/dirty-a")
+
+            response = self.client.post("/botchat/logout/alice")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json["sessions"], 1)
+            self.assertEqual(response.json["inserted"], 1)
+
+            # Nothing left to sync
+            response = self.client.post("/botchat/logout/alice")
+            self.assertEqual(response.json["sessions"], 0)
+
+            for session_name in ("dirty-a", "dirty-b"):
+                self.client.delete(f"/botchat/delete/alice/{session_name}")
+
+    def test_get_messages_paginated(self):
+        # Create a user
+        with self.app.app_context():
+            user = User(username="alice", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            # Create a session with five messages
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "alice", "session_name": "paged"},
+            )
+            for i in range(5):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "alice",
+                        "session_id": "paged",
+                        "message": f"message {i}",
+                        "sender": "alice",
+                    },
+                )
+
+            # Latest page first, returned oldest first
+            response = self.client.get("/botchat/messages/alice/paged?limit=2")
+            self.assertEqual(response.status_code, 200)
+            texts = [m["text"] for m in response.json["messages"]]
+            self.assertEqual(texts, ["message 3", "message 4"])
+            cursor = response.json["next_cursor"]
+            self.assertIsNotNone(cursor)
+
+            # Walk backwards until the cursor runs out
+            response = self.client.get(
+                f"/botchat/messages/alice/paged?limit=2&before={cursor}"
+            )
+            texts = [m["text"] for m in response.json["messages"]]
+            self.assertEqual(texts, ["message 1", "message 2"])
+
+            response = self.client.get(
+                "/botchat/messages/alice/paged?limit=2&before="
+                + response.json["next_cursor"]
+            )
+            texts = [m["text"] for m in response.json["messages"]]
+            self.assertEqual(texts, ["message 0"])
+            self.assertIsNone(response.json["next_cursor"])
+
+            response = self.client.get("/botchat/messages/alice/paged?limit=0")
+            self.assertEqual(response.status_code, 400)
+
+            self.client.delete("/botchat/delete/alice/paged")
+
+    def test_pages_split_a_second_by_sender(self):
+        with self.app.app_context():
+            user = User(username="pat", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "pat", "session_name": "ties"},
+            )
+            # A user turn and a bot turn persisted in the same second
+            for sender, text in (("pat", "hi"), ("bot", "hello")):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "pat",
+                        "sender": sender,
+                        "session_id": "ties",
+                        "message": text,
+                        "time": "2024-01-01 00:00:05",
+                    },
+                )
+            self.client.post("/botchat/sync/pat/ties")
+
+            def walk(cursor=None):
+                pages = []
+                while True:
+                    url = "/botchat/messages/pat/ties?limit=1"
+                    if cursor:
+                        url += f"&before={cursor}"
+                    response = self.client.get(url)
+                    messages = response.json["messages"]
+                    pages.append([m["text"] for m in messages])
+                    cursor = response.json["next_cursor"]
+                    if cursor is None:
+                        return pages
+
+            # PostgreSQL keyset pages
+            self.app.redis.delete("bot-pat-ties")
+            self.assertEqual(walk(), [["hi"], ["hello"]])
+
+            # Redis pages of the rebuilt key
+            self.client.get("/botchat/messages/pat/ties")
+            self.assertEqual(walk(), [["hi"], ["hello"]])
+
+            # A batch read hands over to GET paging without a gap
+            self.app.redis.delete("bot-pat-ties")
+            response = self.client.post(
+                "/botchat/messages/batch",
+                json={"username": "pat", "session_ids": ["ties"], "limit": 1},
+            )
+            page = response.json["sessions"]["ties"]
+            self.assertEqual([m["text"] for m in page["messages"]], ["hi"])
+            self.assertEqual(walk(page["next_cursor"]), [["hello"]])
+
+            self.client.delete("/botchat/delete/pat/ties")
+
+    def test_search_messages(self):
+        # Create a user
+        with self.app.app_context():
+            user = User(username="alice", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            # Create a session with two messages
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "alice", "session_name": "searchable"},
+            )
+            for text in ("Ping pong!", "Pong table"):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "alice",
+                        "session_id": "searchable",
+                        "message": text,
+                        "sender": "alice",
+                    },
+                )
+
+            # Every query term has to match
+            response = self.client.get("/botchat/search/alice?query=pong")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json["results"]), 2)
+
+            response = self.client.get(
+                "/botchat/search/alice?query=ping%20pong"
+            )
+            self.assertEqual(len(response.json["results"]), 1)
+            self.assertEqual(
+                response.json["results"][0]["text"], "Ping pong!"
+            )
+
+            # The last word may be partial
+            for query, expected in (
+                ("pi", ["Ping pong!"]),
+                ("pong%20ta", ["Pong table"]),
+                ("po", ["Pong table", "Ping pong!"]),
+                ("pongs", []),
+            ):
+                response = self.client.get(
+                    f"/botchat/search/alice?query={query}"
+                )
+                self.assertEqual(
+                    [hit["text"] for hit in response.json["results"]],
+                    expected,
+                )
+
+            # Postings are scored by message, Redis ranks the newest first
+            posting = self.app.redis.zrange(
+                "bot-idx-alice-table", 0, -1, withscores=True
+            )
+            newest = get_raw_redis_connection().zrange(
+                "bot-alice-searchable", -1, -1, withscores=True
+            )
+            self.assertEqual(posting[0][1], newest[0][1])
+            response = self.client.get(
+                "/botchat/search/alice?query=pong&limit=1"
+            )
+            self.assertEqual(
+                response.json["results"][0]["text"], "Pong table"
+            )
+            self.assertIsNotNone(response.json["next_offset"])
+
+            # An evicted conversation: searches prune its postings
+            self.app.redis.delete("bot-alice-searchable")
+            response = self.client.get("/botchat/search/alice?query=pong")
+            self.assertEqual(len(response.json["results"]), 0)
+            self.assertFalse(self.app.redis.exists("bot-idx-alice-pong"))
+            self.assertTrue(self.app.redis.exists("bot-idx-alice-ping"))
+
+            # Deleting the session drops its postings
+            self.client.delete("/botchat/delete/alice/searchable")
+            self.assertFalse(self.app.redis.exists("bot-idx-alice-ping"))
+            self.assertFalse(
+                self.app.redis.exists("bot-idx-terms-alice-searchable")
+            )
+            self.app.redis.delete("bot-idx-dict-alice")
+
+    def test_search_messages_postgres_fallback(self):
+        # Create a user with some history that only lives in Postgres
+        with self.app.app_context():
+            user = User(username="alice", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            db.session.add(
+                ChatMessage(
+                    user_id=user.id,
+                    session_id="archived",
+                    sender="alice",
+                    message="Zebra stripes",
+                    timestamp=datetime(2024, 1, 1),
+                )
+            )
+            db.session.commit()
+
+            # A hot session that is also synced to Postgres
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "alice", "session_name": "hot"},
+            )
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "alice",
+                    "session_id": "hot",
+                    "message": "Zebra crossing",
+                    "sender": "alice",
+                },
+            )
+            self.client.post("/botchat/sync/alice/hot")
+
+            # Hot hit first, cold hit merged in, synced copy de-duplicated
+            response = self.client.get("/botchat/search/alice?query=zebra")
+            self.assertEqual(response.status_code, 200)
+            texts = [r["text"] for r in response.json["results"]]
+            self.assertEqual(texts, ["Zebra crossing", "Zebra stripes"])
+            self.assertIsNone(response.json["next_offset"])
+
+            response = self.client.get(
+                "/botchat/search/alice?query=zebra&limit=1"
+            )
+            self.assertEqual(len(response.json["results"]), 1)
+            self.assertEqual(response.json["next_offset"], 1)
+
+            self.client.delete("/botchat/delete/alice/hot")
+
+    def test_cold_tier_session(self):
+        # Create a user
+        with self.app.app_context():
+            user = User(username="alice", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            # A synced session with one message
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "alice", "session_name": "frozen"},
+            )
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "alice",
+                    "session_id": "frozen",
+                    "message": "Glacier",
+                    "sender": "alice",
+                },
+            )
+            self.client.post("/botchat/sync/alice/frozen")
+
+            # Nothing happens once the lease is lost
+            stats = run_tiering(
+                self.app.redis,
+                get_raw_redis_connection(),
+                idle_seconds=0,
+                keep_going=lambda: False,
+            )
+            self.assertEqual(stats["sessions"], 0)
+            self.assertTrue(self.app.redis.exists("bot-alice-frozen"))
+
+            # Compress every idle session, then read it back
+            stats = run_tiering(
+                self.app.redis, get_raw_redis_connection(), idle_seconds=0
+            )
+            self.assertGreaterEqual(stats["sessions"], 1)
+            self.assertFalse(self.app.redis.exists("bot-alice-frozen"))
+
+            response = self.client.get("/botchat/messages/alice/frozen")
+            texts = [m["text"] for m in response.json["messages"]]
+            self.assertEqual(texts, ["Glacier"])
+
+            # A new message promotes the session back to a live ZSET
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "alice",
+                    "session_id": "frozen",
+                    "message": "Thaw",
+                    "sender": "alice",
+                },
+            )
+            self.assertFalse(self.app.redis.exists("bot-cold-alice-frozen"))
+            self.assertEqual(self.app.redis.zcard("bot-alice-frozen"), 2)
+
+            self.client.delete("/botchat/delete/alice/frozen")
+
+    def test_get_sessions_details(self):
+        # Create a user
+        with self.app.app_context():
+            user = User(username="alice", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            # Two sessions, the older one gets the latest message
+            for session_name in ("meta-a", "meta-b"):
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": "alice", "session_name": session_name},
+                )
+            for session_name, text in (
+                ("meta-a", "first"),
+                ("meta-b", "second"),
+                ("meta-a", "third"),
+            ):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "alice",
+                        "session_id": session_name,
+                        "message": text,
+                        "sender": "bot",
+                    },
+                )
+
+            response = self.client.get(
+                "/botchat/sessions/alice?details=true&sort=activity"
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                response.json["sessions"][:2], ["meta-a", "meta-b"]
+            )
+            details = response.json["details"][0]
+            self.assertEqual(details["session_id"], "meta-a")
+            self.assertEqual(details["message_count"], 2)
+            self.assertEqual(details["last_message"], "third")
+            self.assertEqual(details["last_sender"], "bot")
+
+            # An empty session is looked up once, then served from the cache
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "alice", "session_name": "meta-empty"},
+            )
+            url = "/botchat/sessions/alice?details=true&sort=activity"
+            details = self.client.get(url).json["details"][0]
+            self.assertEqual(details["message_count"], 0)
+            self.assertEqual(
+                self.app.redis.hgetall("bot-meta-alice-meta-empty"),
+                {"count": "0"},
+            )
+            with mock.patch(
+                "routes.session_meta.backfill_session_meta"
+            ) as backfill:
+                self.client.get(url)
+            backfill.assert_not_called()
+
+            for session_name in ("meta-a", "meta-b", "meta-empty"):
+                self.client.delete(f"/botchat/delete/alice/{session_name}")
+            self.assertFalse(self.app.redis.exists("bot-meta-alice-meta-a"))
+
+    def test_get_sessions_paginated(self):
+        # Create a user
+        with self.app.app_context():
+            user = User(username="alice", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            names = ("page-a", "page-b", "page-c")
+            for session_name in names:
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": "alice", "session_name": session_name},
+                )
+            # Activity moves page-a to the front
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "alice",
+                    "session_id": "page-a",
+                    "message": "bump",
+                },
+            )
+
+            seen = []
+            cursor = None
+            while True:
+                url = "/botchat/sessions/alice?limit=2"
+                if cursor:
+                    url += f"&cursor={cursor}"
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(response.json["sessions"]), 2)
+                seen.extend(response.json["sessions"])
+                cursor = response.json["next_cursor"]
+                if cursor is None:
+                    break
+            ours = [sid for sid in seen if sid in names]
+            self.assertEqual(ours, ["page-a", "page-c", "page-b"])
+            self.assertEqual(len(seen), len(set(seen)))
+
+            response = self.client.get("/botchat/sessions/alice?limit=0")
+            self.assertEqual(response.status_code, 400)
+
+            for session_name in names:
+                self.client.delete(f"/botchat/delete/alice/{session_name}")
+
+    def test_session_pages_keep_ties_together(self):
+        with self.app.app_context():
+            user = User(username="tied", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            names = ["a", "b", "c", "d"]
+            at = datetime(2024, 1, 1)
+            self.app.redis.delete("bot-sessions-tied")
+            self.app.redis.zadd(
+                "bot-sessions-tied", {sid: at.timestamp() for sid in names}
+            )
+            for sid in names:
+                db.session.add(
+                    ChatSession(
+                        user_id=user.id,
+                        session_id=sid,
+                        created_at=at,
+                        last_activity=at,
+                        message_count=0,
+                    )
+                )
+            db.session.commit()
+
+            def walk():
+                pages = []
+                cursor = None
+                while True:
+                    url = "/botchat/sessions/tied?limit=2"
+                    if cursor:
+                        url += f"&cursor={cursor}"
+                    response = self.client.get(url)
+                    pages.append(response.json["sessions"])
+                    cursor = response.json["next_cursor"]
+                    if cursor is None:
+                        return pages
+
+            self.assertEqual(walk(), [["d", "c"], ["b", "a"]])
+            with mock.patch(
+                "routes.chat_message.page_sessions",
+                side_effect=redis.exceptions.ConnectionError("down"),
+            ):
+                self.assertEqual(walk(), [["d", "c"], ["b", "a"]])
+
+            response = self.client.get(
+                "/botchat/sessions/tied?limit=2&cursor=soon"
+            )
+            self.assertEqual(response.status_code, 400)
+            self.app.redis.delete("bot-sessions-tied")
+
+    def test_legacy_session_set_is_converted(self):
+        with self.app.app_context():
+            self.app.redis.delete("bot-sessions-legacy")
+            self.app.redis.sadd("bot-sessions-legacy", "old-1", "old-2")
+
+            response = self.client.get("/botchat/sessions/legacy")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json["sessions"], ["old-1", "old-2"])
+            self.assertEqual(
+                self.app.redis.type("bot-sessions-legacy"), "zset"
+            )
+            self.app.redis.delete("bot-sessions-legacy")
+
+            # A session added by an old replica mid-conversion isn't lost
+            self.app.redis.sadd("bot-sessions-legacy", "old-1")
+            scores = legacy_session_scores
+
+            def racing_scores(r, username, session_ids):
+                self.app.redis.sadd("bot-sessions-legacy", "old-3")
+                return scores(r, username, session_ids)
+
+            with mock.patch(
+                "routes.session_index.legacy_session_scores", racing_scores
+            ):
+                response = self.client.get("/botchat/sessions/legacy")
+            self.assertEqual(response.json["sessions"], ["old-1", "old-3"])
+            self.assertEqual(
+                self.app.redis.zrange("bot-sessions-legacy", 0, -1),
+                ["old-1", "old-3"],
+            )
+            self.app.redis.delete("bot-sessions-legacy")
+
+    def test_chat_sessions_table(self):
+        with self.app.app_context():
+            user = User(username="carol", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            self.app.redis.delete("bot-sessions-carol")
+
+            for session_name in ("table-busy", "table-empty"):
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": "carol", "session_name": session_name},
+                )
+            # Distinct senders: the primary key has one-second resolution
+            for sender in ("carol", "bot"):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "carol",
+                        "session_id": "table-busy",
+                        "message": f"hi from {sender}",
+                        "sender": sender,
+                    },
+                )
+            self.client.post("/botchat/sync/carol/table-busy")
+
+            row = db.session.get(ChatSession, (user.id, "table-busy"))
+            self.assertEqual(row.message_count, 2)
+            self.assertIsNotNone(
+                db.session.get(ChatSession, (user.id, "table-empty"))
+            )
+
+            # Without Redis the list comes from chat_sessions
+            self.app.redis.delete("bot-sessions-carol")
+            response = self.client.get("/botchat/sessions/carol")
+            self.assertEqual(
+                response.json["sessions"], ["table-busy", "table-empty"]
+            )
+
+            # History from before the table is backfilled
+            ChatSession.query.delete()
+            db.session.commit()
+            self.assertEqual(backfill_chat_sessions(), 1)
+            row = db.session.get(ChatSession, (user.id, "table-busy"))
+            self.assertEqual(row.message_count, 2)
+
+            self.client.delete("/botchat/delete/carol/table-busy")
+            self.assertIsNone(
+                db.session.get(ChatSession, (user.id, "table-busy"))
+            )
+            self.app.redis.delete("bot-sessions-carol")
+
+    def test_create_missing_indexes(self):
+        with self.app.app_context():
+            self.assertEqual(create_missing_indexes(), [])
+            # An index added to the model after the table was created
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(
+                    "DROP INDEX ix_chat_messages_user_timestamp"
+                )
+            self.assertEqual(
+                create_missing_indexes(), ["ix_chat_messages_user_timestamp"]
+            )
+            self.assertEqual(create_missing_indexes(), [])
+
+    def test_send_message_unknown_session(self):
+        with self.app.app_context():
+            self.app.redis.delete("bot-sessions-dave")
+            response = self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "dave",
+                    "session_id": "nowhere",
+                    "message": "lost words",
+                },
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("does not exist", response.json["error"])
+            # The script bails out before writing anything
+            self.assertFalse(self.app.redis.exists("bot-dave-nowhere"))
+            self.assertFalse(self.app.redis.exists("bot-idx-dave-lost"))
+
+            # A legacy SET index is converted and the send goes through
+            self.app.redis.sadd("bot-sessions-dave", "nowhere")
+            response = self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "dave",
+                    "session_id": "nowhere",
+                    "message": "found words",
+                },
+            )
+            self.assertEqual(response.status_code, 201)
+            meta = self.app.redis.hgetall("bot-meta-dave-nowhere")
+            self.assertEqual(meta["count"], "1")
+            self.assertEqual(meta["last_preview"], "found words")
+            self.assertTrue(
+                self.app.redis.sismember("bot-dirty-dave", "nowhere")
+            )
+            self.client.delete("/botchat/delete/dave/nowhere")
+            self.app.redis.delete("bot-sessions-dave")
+
+    def test_user_id_lookup_survives_redis_errors(self):
+        self.app.config["USER_ID_CACHE_REDIS"] = True
+        with self.app.app_context():
+            user = User(username="ulla", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            user_id_cache.invalidate("ulla")
+            with mock.patch.object(
+                self.app.redis,
+                "hget",
+                side_effect=redis.exceptions.ConnectionError("down"),
+            ):
+                self.assertEqual(get_user_id("ulla"), user.id)
+
+            # An open breaker skips the shared hash altogether
+            user_id_cache.invalidate("ulla")
+            self.app.redis.breaker = CircuitBreaker(1, 60)
+            self.app.redis.breaker.record_failure()
+            with mock.patch.object(self.app.redis, "hget") as hget:
+                self.assertEqual(get_user_id("ulla"), user.id)
+            hget.assert_not_called()
+            self.app.redis.hdel("bot-user-ids", "ulla")
+
+    def test_hot_window(self):
+        self.app.config["REDIS_HOT_WINDOW"] = 2
+        with self.app.app_context():
+            user = User(username="erin", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "erin", "session_name": "window"},
+            )
+            texts = [f"hotwin{i}" for i in range(1, 6)]
+            for i, text in enumerate(texts, start=1):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "erin",
+                        "session_id": "window",
+                        "message": text,
+                        "time": f"2024-01-01 00:00:0{i}",
+                    },
+                )
+            self.client.post("/botchat/sync/erin/window")
+
+            # Only the newest messages stay in Redis, with their postings
+            self.assertEqual(self.app.redis.zcard("bot-erin-window"), 2)
+            self.assertFalse(self.app.redis.exists("bot-idx-erin-hotwin1"))
+
+
+            # Reads stitch the trimmed history back in front
+            response = self.client.get("/botchat/messages/erin/window")
+            self.assertEqual(
+                [m["text"] for m in response.json["messages"]], texts
+            )
+
+            pages = []
+            cursor = None
+            while True:
+                url = "/botchat/messages/erin/window?limit=2"
+                if cursor:
+                    url += f"&before={cursor}"
+                response = self.client.get(url)
+                pages.append([m["text"] for m in response.json["messages"]])
+                cursor = response.json["next_cursor"]
+                if cursor is None:
+                    break
+            self.assertEqual(
+                pages,
+                [["hotwin4", "hotwin5"], ["hotwin2", "hotwin3"], ["hotwin1"]],
+            )
+
+            pages = []
+            cursor = "1"
+            while cursor:
+                response = self.client.get(
+                    f"/botchat/messages/erin/window?limit=2&after={cursor}"
+                )
+                pages.append([m["text"] for m in response.json["messages"]])
+                cursor = response.json["next_cursor"]
+            self.assertEqual(
+                pages,
+                [["hotwin1", "hotwin2"], ["hotwin3", "hotwin4"], ["hotwin5"]],
+            )
+
+            # Metadata rebuilt for a trimmed session counts what PostgreSQL
+            # holds, plus what isn't synced yet
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "erin",
+                    "session_id": "window",
+                    "message": "unsynced",
+                    "time": "2024-01-01 00:00:06",
+                },
+            )
+            self.app.redis.delete("bot-meta-erin-window")
+            response = self.client.get("/botchat/sessions/erin?details=true")
+            details = response.json["details"][0]
+            self.assertEqual(details["message_count"], 6)
+            self.assertEqual(details["last_message"], "unsynced")
+
+            self.client.delete("/botchat/delete/erin/window")
+            self.assertFalse(
+                self.app.redis.hexists("bot-trimmed-erin", "window")
+            )
+
+    def test_hot_window_with_client_clock_ahead(self):
+        # Rows carry the client 'time', scores the Redis clock: the trim
+        # boundary must not compare one against the other
+        self.app.config["REDIS_HOT_WINDOW"] = 2
+        with self.app.app_context():
+            user = User(username="skew", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "skew", "session_name": "ahead"},
+            )
+            ahead = datetime.now().timestamp() + 8 * 3600
+            texts = [f"ahead{i}" for i in range(1, 6)]
+            for i, text in enumerate(texts):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "skew",
+                        "session_id": "ahead",
+                        "message": text,
+                        "time": datetime.fromtimestamp(ahead + i).strftime(
+                            "%Y-%m-%d %H:%M:%S"
+                        ),
+                    },
+                )
+            self.client.post("/botchat/sync/skew/ahead")
+            self.assertEqual(self.app.redis.zcard("bot-skew-ahead"), 2)
+
+            response = self.client.get("/botchat/messages/skew/ahead")
+            self.assertEqual(
+                [m["text"] for m in response.json["messages"]], texts
+            )
+            response = self.client.get(
+                "/botchat/messages/skew/ahead?limit=10"
+            )
+            self.assertEqual(
+                [m["text"] for m in response.json["messages"]], texts
+            )
+
+            def walk(direction, cursor=None):
+                pages = []
+                while True:
+                    url = "/botchat/messages/skew/ahead?limit=2"
+                    if cursor:
+                        url += f"&{direction}={cursor}"
+                    response = self.client.get(url)
+                    pages.append(
+                        [m["text"] for m in response.json["messages"]]
+                    )
+                    cursor = response.json["next_cursor"]
+                    if cursor is None:
+                        return pages
+
+            self.assertEqual(
+                walk("before"),
+                [["ahead4", "ahead5"], ["ahead2", "ahead3"], ["ahead1"]],
+            )
+            self.assertEqual(
+                walk("after", "1"),
+                [["ahead1", "ahead2"], ["ahead3", "ahead4"], ["ahead5"]],
+            )
+
+            response = self.client.post(
+                "/botchat/messages/batch",
+                json={"username": "skew", "session_ids": ["ahead"]},
+            )
+            self.assertEqual(
+                [
+                    m["text"]
+                    for m in response.json["sessions"]["ahead"]["messages"]
+                ],
+                texts,
+            )
+
+    def test_messages_in_time_range(self):
+        with self.app.app_context():
+            user = User(username="frank", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            self.app.redis.delete("bot-sessions-frank")
+
+            for session_name in ("rng-a", "rng-b"):
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": "frank", "session_name": session_name},
+                )
+            # History that only PostgreSQL still has
+            db.session.add(
+                ChatMessage(
+                    user_id=user.id,
+                    session_id="rng-a",
+                    sender="frank",
+                    message="ancient",
+                    timestamp=datetime(2020, 1, 1, 10, 0, 0),
+                )
+            )
+            db.session.commit()
+            for session_name, text in (
+                ("rng-a", "newer"),
+                ("rng-b", "newest"),
+            ):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "frank",
+                        "session_id": session_name,
+                        "message": text,
+                    },
+                )
+            # Synced messages are in both tiers, returned once
+            self.client.post("/botchat/sync/frank/rng-a")
+
+            response = self.client.get(
+                "/botchat/messages/frank?since=2019-12-31 00:00:00"
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [
+                    (m["session_id"], m["text"])
+                    for m in response.json["messages"]
+                ],
+                [
+                    ("rng-a", "ancient"),
+                    ("rng-a", "newer"),
+                    ("rng-b", "newest"),
+                ],
+            )
+
+            response = self.client.get(
+                "/botchat/messages/frank?since=2019-12-31 00:00:00"
+                "&until=2020-12-31 00:00:00"
+            )
+            self.assertEqual(
+                [m["text"] for m in response.json["messages"]], ["ancient"]
+            )
+
+            # One session: recent messages straight from Redis
+            response = self.client.get(
+                "/botchat/messages/frank/rng-b?since=2021-01-01 00:00:00"
+            )
+            self.assertEqual(
+                [m["text"] for m in response.json["messages"]], ["newest"]
+            )
+
+            # Ranges are on the message time, whatever the Redis score
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "frank",
+                    "session_id": "rng-b",
+                    "message": "backdated",
+                    "time": "2021-06-01 00:00:00",
+                },
+            )
+            for url in (
+                "/botchat/messages/frank/rng-b",
+                "/botchat/messages/frank",
+            ):
+                response = self.client.get(
+                    f"{url}?since=2021-01-01 00:00:00"
+                    "&until=2021-12-31 00:00:00"
+                )
+                self.assertEqual(
+                    [m["text"] for m in response.json["messages"]],
+                    ["backdated"],
+                )
+
+            for since in ("soon", "1e20", "inf", "nan", "-1e300"):
+                response = self.client.get(
+                    f"/botchat/messages/frank?since={since}"
+                )
+                self.assertEqual(response.status_code, 400)
+            for cursor in ("before=inf", "after=nan", "before=1e20:frank"):
+                response = self.client.get(
+                    f"/botchat/messages/frank/rng-a?limit=1&{cursor}"
+                )
+                self.assertEqual(response.status_code, 400)
+            response = self.client.get(
+                "/botchat/sessions/frank?limit=1&cursor=nan"
+            )
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get("/botchat/messages/frank")
+            self.assertEqual(response.status_code, 400)
+
+            for session_name in ("rng-a", "rng-b"):
+                self.client.delete(f"/botchat/delete/frank/{session_name}")
+
+    def test_get_messages_batch(self):
+        with self.app.app_context():
+            user = User(username="grace", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            for session_name in ("tab-a", "tab-b"):
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": "grace", "session_name": session_name},
+                )
+            for i in range(1, 4):
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "grace",
+                        "session_id": "tab-a",
+                        "message": f"a{i}",
+                        "time": f"2024-01-01 00:00:0{i}",
+                    },
+                )
+            # A session only PostgreSQL holds
+            for i in range(1, 4):
+                db.session.add(
+                    ChatMessage(
+                        user_id=user.id,
+                        session_id="tab-b",
+                        sender="grace",
+                        message=f"b{i}",
+                        timestamp=datetime(2024, 1, 1, 0, 0, i),
+                    )
+                )
+            db.session.commit()
+
+            response = self.client.post(
+                "/botchat/messages/batch",
+                json={
+                    "username": "grace",
+                    "session_ids": ["tab-a", "TAB-B", "tab-none"],
+                    "limits": {"tab-b": 2},
+                },
+            )
+            self.assertEqual(response.status_code, 200)
+            sessions = response.json["sessions"]
+            self.assertEqual(
+                [m["text"] for m in sessions["tab-a"]["messages"]],
+                ["a1", "a2", "a3"],
+            )
+            self.assertIsNone(sessions["tab-a"]["next_cursor"])
+            self.assertEqual(
+                [m["text"] for m in sessions["tab-b"]["messages"]],
+                ["b2", "b3"],
+            )
+            self.assertIsNotNone(sessions["tab-b"]["next_cursor"])
+            self.assertEqual(sessions["tab-none"]["messages"], [])
+
+            # A full read is cached again, single-flight with get_messages
+            lock = self.app.redis.lock("bot-lock-bot-grace-tab-b", timeout=5)
+            lock.acquire()
+            full_read = {"username": "grace", "session_ids": ["tab-b"]}
+            response = self.client.post(
+                "/botchat/messages/batch", json=full_read
+            )
+            self.assertEqual(
+                len(response.json["sessions"]["tab-b"]["messages"]), 3
+            )
+            self.assertFalse(self.app.redis.exists("bot-grace-tab-b"))
+            lock.release()
+            self.client.post("/botchat/messages/batch", json=full_read)
+            self.assertEqual(self.app.redis.zcard("bot-grace-tab-b"), 3)
+
+            response = self.client.post(
+                "/botchat/messages/batch",
+                json={"username": "grace", "session_ids": "tab-a"},
+            )
+            self.assertEqual(response.status_code, 400)
+
+            for session_name in ("tab-a", "tab-b"):
+                self.client.delete(f"/botchat/delete/grace/{session_name}")
+
+    def test_send_messages_batch(self):
+        with self.app.app_context():
+            user = User(username="heidi", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "heidi", "session_name": "replay"},
+            )
+
+            response = self.client.post(
+                "/botchat/messages/batch-send",
+                json={
+                    "username": "heidi",
+                    "messages": [
+                        {"session_id": "replay", "message": "question one"},
+                        {
+                            "session_id": "replay",
+                            "sender": "bot",
+                            "message": "answer one",
+                        },
+                        {"session_id": "missing", "message": "nowhere"},
+                        {"session_id": "replay"},
+                    ],
+                },
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json["stored"], 2)
+            self.assertEqual(response.json["failed"], 2)
+            self.assertEqual(
+                [r["status"] for r in response.json["results"]],
+                ["stored", "stored", "error", "error"],
+            )
+
+            response = self.client.get("/botchat/messages/heidi/replay")
+            self.assertEqual(
+                [(m["sender"], m["text"]) for m in response.json["messages"]],
+                [("heidi", "question one"), ("bot", "answer one")],
+            )
+            meta = self.app.redis.hgetall("bot-meta-heidi-replay")
+            self.assertEqual(meta["count"], "2")
+            self.assertEqual(meta["last_sender"], "bot")
+            self.assertTrue(self.app.redis.exists("bot-idx-heidi-answer"))
+
+            # Any other failure of a session is reported on its own items
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "heidi", "session_name": "broken"},
+            )
+            self.app.redis.set("bot-heidi-broken", "not a conversation")
+            response = self.client.post(
+                "/botchat/messages/batch-send",
+                json={
+                    "username": "heidi",
+                    "messages": [
+                        {"session_id": "broken", "message": "lost"},
+                        {"session_id": "replay", "message": "kept"},
+                    ],
+                },
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [r["status"] for r in response.json["results"]],
+                ["error", "stored"],
+            )
+
+            self.client.delete("/botchat/delete/heidi/replay")
+            self.client.delete("/botchat/delete/heidi/broken")
+
+    def test_heartbeats_are_coalesced(self):
+        with self.app.app_context():
+            user = User(username="ivan", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            self.app.redis.delete("bot-heartbeats", "bot-heartbeats-flushed")
+
+            for _ in range(3):
+                response = self.client.post(
+                    "/botchat/update_session_expiry",
+                    json={"username": "ivan", "exp": 0},
+                )
+                self.assertEqual(response.status_code, 200)
+            response = self.client.post(
+                "/botchat/update_session_expiry",
+                json={"username": "nobody", "exp": 0},
+            )
+            self.assertEqual(response.status_code, 404)
+
+            # Heartbeats only touch Redis until the flusher runs
+            self.assertIsNotNone(
+                self.app.redis.zscore("bot-heartbeats", "ivan")
+            )
+            self.assertEqual(ActiveUser.query.count(), 0)
+            self.assertEqual(flush_heartbeats(self.app.redis), 1)
+            self.assertEqual(ActiveUser.query.count(), 1)
+
+            # Later heartbeats update the same row, even when the flushing
+            # process' clock runs ahead of the one scoring them
+            with mock.patch(
+                "routes.heartbeats.time.time", return_value=4102444800.0
+            ):
+                self.assertEqual(flush_heartbeats(self.app.redis), 0)
+            self.client.post(
+                "/botchat/update_session_expiry",
+                json={"username": "ivan", "exp": 0},
+            )
+            self.assertEqual(flush_heartbeats(self.app.redis), 1)
+            self.assertEqual(flush_heartbeats(self.app.redis), 0)
+            self.assertEqual(ActiveUser.query.count(), 1)
+
+            # Nobody is due yet
+            stats = run_inactivity_sweep(self.app.redis, 900, 1)
+            self.assertEqual(stats["users"], 0)
+            response = self.client.get("/botchat/metrics")
+            self.assertEqual(response.json["inactivity"]["lag"], 0)
+
+            # Past the deadline: forgotten in batches of one, and only
+            # while the lease is held
+            self.app.redis.zadd("bot-heartbeats", {"ghost": 1})
+            leading = iter([True, False])
+            stats = run_inactivity_sweep(
+                self.app.redis, -1, 1, keep_going=lambda: next(leading)
+            )
+            self.assertEqual(stats["users"], 1)
+            self.assertEqual(stats["batches"], 1)
+            self.assertEqual(self.app.redis.zcard("bot-heartbeats"), 1)
+            stats = run_inactivity_sweep(self.app.redis, -1, 1)
+            self.assertEqual(stats["users"], 1)
+            self.assertEqual(stats["batches"], 1)
+            self.assertGreater(stats["lag"], 0)
+            self.assertEqual(ActiveUser.query.count(), 0)
+            self.assertEqual(self.app.redis.zcard("bot-heartbeats"), 0)
+            self.app.redis.delete("bot-heartbeats", "bot-heartbeats-flushed")
+
+    def test_failed_sync_only_keeps_its_user(self):
+        with self.app.app_context():
+            for username in ("ray", "sam"):
+                db.session.add(User(username=username, password_hash="h"))
+            db.session.commit()
+            self.app.redis.delete("bot-heartbeats")
+            for username in ("ray", "sam"):
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": username, "session_name": "sweep"},
+                )
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": username,
+                        "session_id": "sweep",
+                        "message": "Hi",
+                    },
+                )
+            self.app.redis.zadd("bot-heartbeats", {"ray": 1, "sam": 2})
+
+            def sync(username, session_id):
+                if username == "ray":
+                    raise ValueError("bad row")
+                return sync_redis_session_to_postgres(username, session_id)
+
+            with mock.patch(
+                "routes.sync_executor.sync_redis_session_to_postgres", sync
+            ):
+                # ray fails first; the sweep steps over them to reach sam
+                stats = run_inactivity_sweep(self.app.redis, 900, 1)
+                self.assertEqual(stats["users"], 1)
+                self.assertEqual(stats["failed"], 1)
+                self.assertEqual(
+                    self.app.redis.zrange("bot-heartbeats", 0, -1), ["ray"]
+                )
+                self.assertFalse(self.app.redis.exists("bot-dirty-sam"))
+                self.assertTrue(self.app.redis.exists("bot-dirty-ray"))
+
+                response = self.client.post("/botchat/logout/ray")
+                self.assertEqual(response.status_code, 500)
+                self.assertEqual(response.json["failed"], 1)
+
+            # The next sweep retries ray
+            stats = run_inactivity_sweep(self.app.redis, 900, 1)
+            self.assertEqual((stats["users"], stats["failed"]), (1, 0))
+
+            for username in ("ray", "sam"):
+                self.client.delete(f"/botchat/delete/{username}/sweep")
+
+    def test_sessions_from_before_dirty_tracking_get_synced(self):
+        with self.app.app_context():
+            user = User(username="olga", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            self.app.redis.delete("bot-heartbeats")
+
+            self.client.post(
+                "/botchat/sessions",
+                json={"username": "olga", "session_name": "legacy"},
+            )
+            self.client.post(
+                "/botchat/messages",
+                json={
+                    "username": "olga",
+                    "session_id": "legacy",
+                    "message": "Hi",
+                },
+            )
+            # Written before dirty marks existed
+            self.app.redis.delete("bot-dirty-olga")
+
+            self.assertGreater(mark_all_sessions_dirty(self.app.redis), 0)
+            self.assertTrue(
+                self.app.redis.sismember("bot-dirty-olga", "legacy")
+            )
+            self.assertEqual(
+                self.app.redis.zscore("bot-heartbeats", "olga"), 0
+            )
+
+            # Due right away: the next sweep persists it
+            run_inactivity_sweep(self.app.redis, 900, 100)
+            self.assertEqual(
+                ChatMessage.query.filter_by(
+                    user_id=user.id, session_id="legacy"
+                ).count(),
+                1,
+            )
+            self.assertFalse(self.app.redis.exists("bot-dirty-olga"))
+
+            self.app.redis.delete("bot-heartbeats")
+            self.client.delete("/botchat/delete/olga/legacy")
+
+    def test_logout_syncs_sessions_in_parallel(self):
+        with self.app.app_context():
+            user = User(username="judy", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            session_names = [f"par-{i}" for i in range(4)]
+            for session_name in session_names:
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": "judy", "session_name": session_name},
+                )
+                self.client.post(
+                    "/botchat/messages",
+                    json={
+                        "username": "judy",
+                        "session_id": session_name,
+                        "message": "Hello",
+                        "sender": "judy",
+                    },
+                )
+
+            errors = self.client.get("/botchat/metrics").json["sync"]["errors"]
+            response = self.client.post("/botchat/logout/judy")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json["sessions"], 4)
+            self.assertEqual(response.json["inserted"], 4)
+            self.assertGreater(response.json["max_session_seconds"], 0)
+            self.assertEqual(
+                ChatMessage.query.filter_by(user_id=user.id).count(), 4
+            )
+
+            # Nothing left to sync; durations show up in the metrics
+            response = self.client.post("/botchat/logout/judy")
+            self.assertEqual(response.json["sessions"], 0)
+            metrics = self.client.get("/botchat/metrics").json["sync"]
+            self.assertGreaterEqual(metrics["sessions"], 4)
+            self.assertEqual(metrics["errors"], errors)
+
+            for session_name in session_names:
+                self.client.delete(f"/botchat/delete/judy/{session_name}")
+
+    def test_prefetch_recent_sessions(self):
+        self.app.config["PREFETCH_MESSAGES"] = 2
+        with self.app.app_context():
+            user = User(username="kim", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+
+            session_names = ["pre-a", "pre-b"]
+            for session_name in session_names:
+                self.client.post(
+                    "/botchat/sessions",
+                    json={"username": "kim", "session_name": session_name},
+                )
+                for i in range(1, 4):
+                    self.client.post(
+                        "/botchat/messages",
+                        json={
+                            "username": "kim",
+                            "session_id": session_name,
+                            "message": f"{session_name}-{i}",
+                            "time": f"2024-01-01 00:00:0{i}",
+                        },
+                    )
+            self.client.post("/botchat/logout/kim")
+
+            # Everything evicted from Redis
+            self.app.redis.delete(
+                "bot-sessions-kim",
+                *[f"bot-kim-{name}" for name in session_names],
+            )
+
+            stats = prefetch_user("kim")
+            self.assertEqual(stats["sessions_indexed"], 2)
+            self.assertEqual(stats["conversations_loaded"], 2)
+            self.assertEqual(self.app.redis.zcard("bot-kim-pre-a"), 2)
+            response = self.client.get("/botchat/sessions/kim")
+            self.assertEqual(response.json["sessions"], session_names)
+            # Sends check sessions in the index, so it must not expire
+            self.assertEqual(self.app.redis.ttl("bot-sessions-kim"), -1)
+            self.app.redis.delete("bot-sessions-kim")
+            self.client.get("/botchat/sessions/kim")
+            self.assertEqual(self.app.redis.ttl("bot-sessions-kim"), -1)
+            # Older messages are read back from PostgreSQL
+            response = self.client.get("/botchat/messages/kim/pre-a")
+            self.assertEqual(
+                [m["text"] for m in response.json["messages"]],
+                ["pre-a-1", "pre-a-2", "pre-a-3"],
+            )
+
+            # A failed run doesn't start the cooldown
+            self.app.redis.delete("bot-prefetched-kim")
+            with mock.patch(
+                "routes.chat_message.prefetch_user",
+                side_effect=SQLAlchemyError("database down"),
+            ):
+                self.assertIsNone(schedule_prefetch("kim").result())
+            self.assertFalse(self.app.redis.exists("bot-prefetched-kim"))
+
+            # Warm keys are left alone, and the trigger has a cooldown
+            future = schedule_prefetch("kim")
+            self.assertEqual(
+                future.result(),
+                {"sessions_indexed": 0, "conversations_loaded": 0},
+            )
+            self.assertIsNone(schedule_prefetch("kim"))
+            response = self.client.post("/botchat/prefetch/kim")
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post("/botchat/prefetch/nobody")
+            self.assertEqual(response.status_code, 404)
+
+            self.app.redis.delete("bot-prefetched-kim")
+            for session_name in session_names:
+                self.client.delete(f"/botchat/delete/kim/{session_name}")
+
+    def test_prefetch_is_dropped_when_the_pool_is_busy(self):
+        release = threading.Event()
+
+        def slow_prefetch(username):
+            release.wait(5)
+            return {"sessions_indexed": 0, "conversations_loaded": 0}
+
+        usernames = [f"busy-{i}" for i in range(3)]
+        with self.app.app_context(), mock.patch(
+            "routes.chat_message.prefetch_user", slow_prefetch
+        ):
+            self.app.redis.delete(
+                *[f"bot-prefetched-{username}" for username in usernames]
+            )
+            # PREFETCH_WORKERS (2) slots: the third prefetch doesn't queue
+            futures = [schedule_prefetch(username) for username in usernames]
+            self.assertIsNone(futures[2])
+            release.set()
+            for future in futures[:2]:
+                self.assertIsNotNone(future.result())
+            self.assertIsNotNone(schedule_prefetch(usernames[2]).result())
+            self.app.redis.delete(
+                *[f"bot-prefetched-{username}" for username in usernames]
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+import redis
+
+from config import Config
+from routes.leader_lease import LeaderLease
+
+
+class TestLeaderLease(unittest.TestCase):
+    def setUp(self):
+        self.r = redis.Redis(
+            host=Config.REDIS_HOST,
+            port=Config.REDIS_PORT,
+            db=Config.REDIS_DB,
+            decode_responses=True,
+        )
+        self.key = "bot-leader-lease-test"
+        self.r.delete(self.key)
+
+    def tearDown(self):
+        self.r.delete(self.key)
+
+    def test_single_leader_and_handover(self):
+        first = LeaderLease(self.r, self.key, 5000)
+        second = LeaderLease(self.r, self.key, 5000)
+
+        self.assertTrue(first.renew())
+        self.assertFalse(second.renew())
+        self.assertTrue(first.renew())  # renewal keeps it
+        self.assertTrue(first.is_leader)
+        self.assertFalse(second.is_leader)
+
+        first.release()
+        self.assertFalse(first.is_leader)
+        self.assertTrue(second.renew())
+        self.assertEqual(self.r.get(self.key), second.owner)
+        self.assertEqual(second.snapshot()["acquisitions"], 1)
+
+    def test_expired_lease_is_taken_over(self):
+        first = LeaderLease(self.r, self.key, 5000)
+        second = LeaderLease(self.r, self.key, 5000)
+        self.assertTrue(first.renew())
+
+        # The holder died: its key expires and the standby takes over
+        self.r.delete(self.key)
+        self.assertTrue(second.renew())
+        self.assertFalse(first.renew())
+        self.assertFalse(first.is_leader)
+
+
+if __name__ == "__main__":
+    unittest.main()
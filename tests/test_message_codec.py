@@ -0,0 +1,36 @@
+import json
+import unittest
+
+from flask import Flask
+
+from routes.message_codec import MSGPACK_V1, decode_message, encode_message
+
+
+class TestMessageCodec(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.message = {
+            "sender": "alice",
+            "text": "Hello, world!",
+            "time": "2025-01-01 12:00:00",
+        }
+
+    def test_msgpack_round_trip(self):
+        with self.app.app_context():
+            member = encode_message(self.message)
+        self.assertTrue(member.startswith(MSGPACK_V1))
+        self.assertLess(len(member), len(json.dumps(self.message)))
+        self.assertEqual(decode_message(member), self.message)
+
+    def test_legacy_json_members(self):
+        legacy = json.dumps(self.message)
+        self.assertEqual(decode_message(legacy), self.message)
+        self.assertEqual(decode_message(legacy.encode()), self.message)
+
+        self.app.config["MESSAGE_ENCODING"] = "json"
+        with self.app.app_context():
+            self.assertEqual(encode_message(self.message), legacy)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import time
+import unittest
+
+from routes.user_cache import UserIdCache
+
+
+class TestUserIdCache(unittest.TestCase):
+    def test_lru_eviction_and_counters(self):
+        cache = UserIdCache(max_size=2, ttl=60)
+        cache.set("alice", 1)
+        cache.set("bob", 2)
+        self.assertEqual(cache.get("alice"), 1)  # alice is now most recent
+
+        cache.set("carol", 3)  # evicts bob
+        self.assertIsNone(cache.get("bob"))
+        self.assertEqual(cache.get("carol"), 3)
+
+        snapshot = cache.snapshot()
+        self.assertEqual(snapshot["size"], 2)
+        self.assertEqual(snapshot["hits"], 2)
+        self.assertEqual(snapshot["misses"], 1)
+
+    def test_ttl_and_invalidate(self):
+        cache = UserIdCache(max_size=10, ttl=0.05)
+        cache.set("alice", 1)
+        cache.set("bob", 2)
+        cache.invalidate("bob")
+        self.assertIsNone(cache.get("bob"))
+
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("alice"))
+        self.assertEqual(cache.snapshot()["size"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+from flask import Flask
+import os
+import unittest
+from unittest import mock
+
+import redis
+from sqlalchemy.exc import OperationalError
+
+import app as app_module
+from app import process_write_behind_batch
+from config import Config
+from models import db
+from models.chat_message import ChatMessage
+from models.chat_session import ChatSession
+from models.user import User
+from routes.chat_message import chat_message_api_bp
+
+
+STREAM = "bot-chat-stream-test"
+DEAD_LETTER_STREAM = "bot-chat-stream-dead-test"
+GROUP = "chat-persisters-test"
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+            "TEST_FLASK_DB_URL"
+        )
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["TESTING"] = True
+        self.app.config["PREFETCH_ON_HEARTBEAT"] = False
+        self.app.config["WRITE_BEHIND_ENABLED"] = True
+        self.app.config["WRITE_BEHIND_STREAM"] = STREAM
+        self.app.config["WRITE_BEHIND_BATCH_SIZE"] = 100
+        self.app.config["WRITE_BEHIND_FLUSH_MS"] = 10
+        self.app.config["WRITE_BEHIND_CLAIM_IDLE_MS"] = 60000
+        self.app.config["WRITE_BEHIND_MAX_DELIVERIES"] = 5
+        self.app.config["WRITE_BEHIND_DEAD_LETTER_STREAM"] = DEAD_LETTER_STREAM
+
+        db.init_app(self.app)
+        with self.app.app_context():
+            db.create_all()
+        self.app.register_blueprint(chat_message_api_bp)
+        self.app.redis = redis.Redis(
+            host=Config.REDIS_HOST,
+            port=Config.REDIS_PORT,
+            db=Config.REDIS_DB,
+            decode_responses=True,
+        )
+        self.app.redis.delete(STREAM, DEAD_LETTER_STREAM)
+        self.app.redis.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            user = User(username="mia", password_hash="hash1")
+            db.session.add(user)
+            db.session.commit()
+            self.user_id = user.id
+
+    def tearDown(self):
+        self.app.redis.delete(STREAM, DEAD_LETTER_STREAM)
+        with self.app.app_context():
+            for session_id in ("wb", "wb-gone"):
+                self.client.delete(f"/botchat/delete/mia/{session_id}")
+            db.drop_all()
+
+    def send(self, session_id, text, second):
+        return self.client.post(
+            "/botchat/messages",
+            json={
+                "username": "mia",
+                "session_id": session_id,
+                "message": text,
+                "time": f"2024-01-01 00:00:{second:02d}",
+            },
+        )
+
+    def pending(self):
+        return self.app.redis.xpending(STREAM, GROUP)["pending"]
+
+    def persisted(self, session_id):
+        with self.app.app_context():
+            return ChatMessage.query.filter_by(
+                user_id=self.user_id, session_id=session_id
+            ).count()
+
+    def test_batch_is_acknowledged_after_commit(self):
+        self.client.post(
+            "/botchat/sessions", json={"username": "mia", "session_name": "wb"}
+        )
+        for second in range(3):
+            self.send("wb", f"message {second}", second)
+
+        # A failing batch is left pending, nothing is acknowledged
+        with mock.patch(
+            "app.persist_stream_entries",
+            side_effect=OperationalError("INSERT", {}, "database down"),
+        ):
+            with self.assertRaises(OperationalError):
+                process_write_behind_batch(self.app, STREAM, GROUP, "dead")
+        self.assertEqual(self.pending(), 3)
+        self.assertEqual(self.persisted("wb"), 0)
+
+        # Another consumer only takes them over once they are stalled
+        self.assertEqual(
+            process_write_behind_batch(self.app, STREAM, GROUP, "live"), 0
+        )
+        self.app.config["WRITE_BEHIND_CLAIM_IDLE_MS"] = 0
+        self.assertEqual(
+            process_write_behind_batch(self.app, STREAM, GROUP, "live"), 3
+        )
+        self.assertEqual(self.pending(), 0)
+        self.assertEqual(self.app.redis.xlen(STREAM), 0)
+        self.assertEqual(self.persisted("wb"), 3)
+
+        # Everything above the watermark came through the stream
+        self.assertFalse(self.app.redis.sismember("bot-dirty-mia", "wb"))
+        with self.app.app_context():
+            row = ChatSession.query.filter_by(
+                user_id=self.user_id, session_id="wb"
+            ).one()
+            self.assertEqual(row.message_count, 3)
+
+    def test_poison_entries_are_isolated_and_dead_lettered(self):
+        self.client.post(
+            "/botchat/sessions", json={"username": "mia", "session_name": "wb"}
+        )
+        for second, text in enumerate(["good", "poison", "also good"]):
+            self.send("wb", text, second)
+
+        persist = app_module.persist_stream_entries
+
+        def reject_poison(entries):
+            if any(fields["text"] == "poison" for _, fields in entries):
+                raise ValueError("A string literal cannot contain NUL")
+            return persist(entries)
+
+        self.app.config["WRITE_BEHIND_CLAIM_IDLE_MS"] = 0
+        self.app.config["WRITE_BEHIND_MAX_DELIVERIES"] = 2
+        with mock.patch(
+            "app.persist_stream_entries", side_effect=reject_poison
+        ):
+            # The rest of the batch goes through, the bad entry stays
+            self.assertEqual(
+                process_write_behind_batch(self.app, STREAM, GROUP, "live"),
+                2,
+            )
+            self.assertEqual(self.persisted("wb"), 2)
+            self.assertEqual(self.pending(), 1)
+
+            # Redelivered until it runs out of deliveries
+            self.assertEqual(
+                process_write_behind_batch(self.app, STREAM, GROUP, "live"),
+                0,
+            )
+            self.assertEqual(self.pending(), 1)
+            self.assertEqual(
+                process_write_behind_batch(self.app, STREAM, GROUP, "live"),
+                0,
+            )
+        self.assertEqual(self.pending(), 0)
+        self.assertEqual(self.app.redis.xlen(STREAM), 0)
+        dead = self.app.redis.xrange(DEAD_LETTER_STREAM)
+        self.assertEqual(len(dead), 1)
+        self.assertEqual(dead[0][1]["text"], "poison")
+        self.assertEqual(dead[0][1]["deliveries"], "3")
+
+    def test_messages_outside_the_stream_keep_the_watermark(self):
+        self.client.post(
+            "/botchat/sessions", json={"username": "mia", "session_name": "wb"}
+        )
+        # Sent by a replica with write-behind off
+        self.app.config["WRITE_BEHIND_ENABLED"] = False
+        self.send("wb", "not streamed", 1)
+        self.app.config["WRITE_BEHIND_ENABLED"] = True
+        self.send("wb", "streamed", 2)
+
+        self.assertEqual(
+            process_write_behind_batch(self.app, STREAM, GROUP, "live"), 1
+        )
+        self.assertFalse(self.app.redis.hexists("bot-synced-mia", "wb"))
+        self.assertTrue(self.app.redis.sismember("bot-dirty-mia", "wb"))
+
+        # The regular sync still finds the message the stream never had
+        response = self.client.post("/botchat/sync/mia/wb")
+        self.assertEqual(response.json["inserted"], 1)
+        self.assertEqual(self.persisted("wb"), 2)
+
+    def test_entries_of_deleted_sessions_are_dropped(self):
+        self.client.post(
+            "/botchat/sessions",
+            json={"username": "mia", "session_name": "wb-gone"},
+        )
+        self.send("wb-gone", "soon gone", 1)
+        self.client.delete("/botchat/delete/mia/wb-gone")
+
+        self.assertEqual(
+            process_write_behind_batch(self.app, STREAM, GROUP, "live"), 1
+        )
+        self.assertEqual(self.pending(), 0)
+        self.assertEqual(self.persisted("wb-gone"), 0)
+        with self.app.app_context():
+            self.assertIsNone(
+                ChatSession.query.filter_by(
+                    user_id=self.user_id, session_id="wb-gone"
+                ).first()
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
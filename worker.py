@@ -0,0 +1,21 @@
+import signal
+import sys
+import time
+
+from app import create_app, start_background_jobs
+
+
+# Standalone background worker: runs the periodic jobs (inactivity sweep,
+# heartbeat flush, cold tiering, migrations, write-behind) without serving
+# HTTP. Deploy it next to API replicas started with RUN_BACKGROUND_JOBS=False;
+# several workers may run, the leader lease picks the one doing the work.
+if __name__ == "__main__":
+    app = create_app(start_jobs=False)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_background_jobs(app)
+    try:
+        while True:
+            time.sleep(60)
+    finally:
+        # Hand over right away instead of after the lease expires
+        app.leader_lease.release()